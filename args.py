@@ -1,6 +1,7 @@
 import argparse
 import os
 import sys
+from backends import BACKENDS
 
 full_marking = {'1.1 completed "Running Some Code" section i.e hello_world.py':1,\
 '1.2 completed "Add README.md and LICENSE.md" section':1,\
@@ -21,37 +22,87 @@ full_marking = {'1.1 completed "Running Some Code" section i.e hello_world.py':1
 '3.5 [C]Git: committed and provided meaningful commit messages (about part 3 only)':1,\
 '4 DO NOT SUBMIT INCORRECT FILES (e.g. venv)':0}
 
-def create_parser():
+# Maximum scores returned by each ChatGPT marker, keyed by the name of its prompt file
+marker_fullmarks = {'GitM':[1,1,1,1],\
+'CODE':[1,1],\
+'REPORT':[1,1,2],\
+'PANDA':[3,1]}
+
+# Criterion numbers scored by each ChatGPT marker, in the order of its scores
+marker_criteria = {'GitM':['1.5', '1.6', '2.6', '3.5'],\
+'CODE':['3.1', '3.2'],\
+'REPORT':['2.2', '2.3', '2.4'],\
+'PANDA':['1.4', '3.4']}
+
+def parse_token_budget(value):
     """
-    Creates an argument parser for the script.
+    Parses a '--token_budget' item of the form MARKER=TOKENS, e.g. 'CODE=8000'.
 
     Returns:
-        argparse.ArgumentParser: Configured argument parser.
+        tuple: (marker name, number of tokens).
     """
-    parser = argparse.ArgumentParser(description="Process directory paths and API key for the marking system.")
+    name, _, tokens = value.partition('=')
+    if name not in marker_fullmarks or not tokens.isdigit():
+        raise argparse.ArgumentTypeError(f"expected MARKER=TOKENS with MARKER one of {', '.join(marker_fullmarks)}, got '{value}'")
+    return name, int(tokens)
+
+def parse_backend(value):
+    """
+    Parses a '--backend' item: a backend for every marker, e.g. 'mock', or for one marker (or the combined
+    request) as MARKER=BACKEND, e.g. 'PANDA=mock'.
+
+    Returns:
+        tuple: (marker name, or None for every marker, backend name).
+    """
+    name, _, backend = value.rpartition('=')
+    if (name != '' and name not in list(marker_fullmarks) + ['Combined']) or backend not in BACKENDS:
+        raise argparse.ArgumentTypeError(f"expected BACKEND or MARKER=BACKEND with BACKEND one of {', '.join(BACKENDS)} "
+                                         f"and MARKER one of {', '.join(list(marker_fullmarks) + ['Combined'])}, got '{value}'")
+    return (name if name != '' else None), backend
+
+def uses_api(args):
+    """
+    Whether a command that marks sends requests to the OpenAI API, i.e. needs an API key.
+    """
+    backends = dict(args.backend)
+    names = list(marker_fullmarks) + (['Combined'] if args.combined else [])
+    return args.batch or any(backends.get(name, backends.get(None, 'openai')) == 'openai' for name in names)
+
+def parse_split(value):
+    """
+    Parses a '--split' value: 'tutor' or a number of students per file.
+    """
+    if value == 'tutor':
+        return value
+    if not value.isdigit() or int(value) == 0:
+        raise argparse.ArgumentTypeError(f"expected 'tutor' or a positive number of students, got '{value}'")
+    return int(value)
 
-    # Adding arguments to the parser
+def add_folder_arguments(parser):
+    """
+    Adds the folders read and written by every command.
+    """
     parser.add_argument(
         '--root_dir', 
         type=str, 
         default='./Raw', 
         help='Root directory for raw submissions (default: ./Raw)'
     )
-    
+
     parser.add_argument(
         '--markdown_dir', 
         type=str, 
         default='./MarkDowns', 
         help='Directory to save markdown reports (default: ./MarkDowns)'
     )
-    
+
     parser.add_argument(
         '--prompts_dir', 
         type=str, 
         default='./prompts', 
         help='Directory containing prompt files (default: ./prompts)'
     )
-    
+
     parser.add_argument(
         '--output_dir', 
         type=str, 
@@ -59,6 +110,10 @@ def create_parser():
         help='Output directory for generated files (default: .)'
     )
 
+def add_output_arguments(parser):
+    """
+    Adds the options of the files written at the end of a run: the results store, the marking table and all.md.
+    """
     parser.add_argument(
         '--marking_table', 
         type=str, 
@@ -66,6 +121,31 @@ def create_parser():
         help='Path of the marking table (default: ./marking.xlsx)'
     )
 
+    parser.add_argument(
+        '--store', 
+        type=str, 
+        default=None, 
+        help='Path of the SQLite results store (default: results.sqlite in the output directory)'
+    )
+
+    parser.add_argument(
+        '--split', 
+        type=parse_split, 
+        default=None, 
+        help="Split all.md into one file per 'tutor' or per N students (default: a single all.md)"
+    )
+
+    parser.add_argument(
+        '--fsync_every', 
+        type=int, 
+        default=10, 
+        help='Number of students between two fsync checkpoints of marks.csv and all.md (default: 10)'
+    )
+
+def add_api_arguments(parser):
+    """
+    Adds the options of the ChatGPT API: the key, the server, the backends, batching, rate limits and retries.
+    """
     parser.add_argument(
         '--apikey', 
         type=str, 
@@ -73,11 +153,364 @@ def create_parser():
         help='API key for external services (default: None)'
     )
 
+    parser.add_argument(
+        '--base_url', 
+        type=str, 
+        default=None, 
+        help='Base URL of an OpenAI-compatible API, e.g. http://127.0.0.1:8765/v1/ for mockserver.py (default: OpenAI)'
+    )
+
+    parser.add_argument(
+        '--batch', 
+        action='store_true', 
+        help='Send all ChatGPT requests as one Batch API job instead of interactive calls'
+    )
+
+    parser.add_argument(
+        '--batch_resume', 
+        action='store_true', 
+        help='Collect the results of the batch job saved by an interrupted --batch run before submitting new ones'
+    )
+
+    parser.add_argument(
+        '--batch_poll', 
+        type=float, 
+        default=30, 
+        help='Seconds between two status checks of a batch job (default: 30)'
+    )
+
+    parser.add_argument(
+        '--concurrency', 
+        type=int, 
+        default=8, 
+        help='Maximum number of ChatGPT calls in flight at the same time (default: 8)'
+    )
+
+    parser.add_argument(
+        '--rpm', 
+        type=int, 
+        default=None, 
+        help='Maximum number of ChatGPT requests per minute (default: no limit)'
+    )
+
+    parser.add_argument(
+        '--tpm', 
+        type=int, 
+        default=None, 
+        help='Maximum number of ChatGPT tokens per minute (default: no limit)'
+    )
+
+    parser.add_argument(
+        '--combined', 
+        action='store_true', 
+        help='Ask for all the criteria of a student in one JSON request instead of one request per prompt'
+    )
+
+    parser.add_argument(
+        '--max_attempts', 
+        type=int, 
+        default=5, 
+        help='Maximum number of ChatGPT requests per criterion before it is flagged for manual review (default: 5)'
+    )
+
+    parser.add_argument(
+        '--backoff_base', 
+        type=float, 
+        default=1.0, 
+        help='Delay in seconds before the first retry, doubled on every retry (default: 1.0)'
+    )
+
+    parser.add_argument(
+        '--backoff_max', 
+        type=float, 
+        default=60.0, 
+        help='Maximum delay in seconds between retries (default: 60.0)'
+    )
+
+    parser.add_argument(
+        '--backend', 
+        type=parse_backend, 
+        nargs='*', 
+        default=[], 
+        help='LLM backend answering the markers: openai, or mock for local replies without network; BACKEND for every marker or MARKER=BACKEND for one (default: openai)'
+    )
+
+    parser.add_argument(
+        '--timeout', 
+        type=float, 
+        default=60.0, 
+        help='Seconds an API request may take before it fails and is retried (default: 60.0)'
+    )
+
+    parser.add_argument(
+        '--mock_latency', 
+        type=float, 
+        default=0.0, 
+        help='Seconds each reply of the mock backend takes (default: 0)'
+    )
+
+    parser.add_argument(
+        '--mock_script', 
+        type=str, 
+        default=None, 
+        help='JSON file mapping regular expressions found in a prompt to the reply of the mock backend (default: the example scores of each prompt)'
+    )
+
+def add_marking_arguments(parser):
+    """
+    Adds the options of marking the submissions.
+    """
+    parser.add_argument(
+        '--extract', 
+        action='store_true', 
+        help='Extract compressed submissions to disk instead of grading them straight from the archive'
+    )
+
+    parser.add_argument(
+        '--reports', 
+        type=str, 
+        choices=['full', 'compact', 'none'], 
+        default='full', 
+        help='Render reports with the files inlined, with links to the files, or not at all (default: full)'
+    )
+
+    parser.add_argument(
+        '--cprofile', 
+        type=str, 
+        default=None, 
+        help='Run under cProfile and save the statistics to this file (default: off)'
+    )
+
+    parser.add_argument(
+        '--workers', 
+        type=int, 
+        default=os.cpu_count() or 1, 
+        help='Number of processes reading and parsing the submission folders (default: number of CPUs)'
+    )
+
+    parser.add_argument(
+        '--token_budget', 
+        type=parse_token_budget, 
+        nargs='*', 
+        default=[('CODE', 12000), ('PANDA', 12000)], 
+        help='Maximum number of code tokens sent by a marker, as MARKER=TOKENS (default: CODE=12000 PANDA=12000)'
+    )
+
+    parser.add_argument(
+        '--no_rules', 
+        action='store_true', 
+        help='Send every criterion to ChatGPT instead of deciding the clear-cut ones with the rules of Rules.json in the prompts directory'
+    )
+
+def add_cache_arguments(parser):
+    """
+    Adds the options of the ChatGPT response cache.
+    """
+    parser.add_argument(
+        '--cache_dir', 
+        type=str, 
+        default='./.cache', 
+        help='Directory of the ChatGPT response cache (default: ./.cache)'
+    )
+
+    parser.add_argument(
+        '--no_cache', 
+        action='store_true', 
+        help='Bypass the ChatGPT response cache and always call the API'
+    )
+
+    parser.add_argument(
+        '--clear_cache', 
+        action='store_true', 
+        help='Remove all cached ChatGPT responses before marking'
+    )
+
+    parser.add_argument(
+        '--cache_max_age', 
+        type=float, 
+        default=30, 
+        help='Evict cached responses older than this many days (default: 30)'
+    )
+
+    parser.add_argument(
+        '--cache_max_size', 
+        type=float, 
+        default=500, 
+        help='Trim the cache to this many megabytes, oldest first (default: 500)'
+    )
+
+    parser.add_argument(
+        '--analysis_dir', 
+        type=str, 
+        default='./.analysis', 
+        help='Directory caching the features of the Python files and the git histories across runs, kept apart from the response cache (default: ./.analysis)'
+    )
+
+def add_queue_arguments(parser):
+    """
+    Adds the options of the shared work queue.
+    """
+    parser.add_argument(
+        '--queue', 
+        type=str, 
+        default=None, 
+        help='Path of the SQLite work queue of the enqueue, worker and merge commands (default: queue.sqlite in the output directory)'
+    )
+
+    parser.add_argument(
+        '--lease', 
+        type=float, 
+        default=300, 
+        help='Seconds a worker keeps the folders it claimed without a heartbeat before another worker may take them (default: 300)'
+    )
+
+    parser.add_argument(
+        '--claim_size', 
+        type=int, 
+        default=8, 
+        help='Number of folders a worker claims at a time (default: 8)'
+    )
+
+def add_duplicate_arguments(parser):
+    """
+    Adds the threshold of the near-duplicate check.
+    """
+    parser.add_argument(
+        '--duplicate_threshold', 
+        type=float, 
+        default=0.9, 
+        help='Minimum similarity (0-1) of the code or report of two students to flag them as near-duplicates (default: 0.9)'
+    )
+
+def add_watch_arguments(parser):
+    """
+    Adds the options of the watch command.
+    """
+    parser.add_argument(
+        '--debounce', 
+        type=float, 
+        default=5, 
+        help='Seconds a student folder must stay unchanged before it is marked, so that uploads and extractions in progress are not marked (default: 5)'
+    )
+
+    parser.add_argument(
+        '--poll', 
+        action='store_true', 
+        help='Look for changes by scanning root_dir instead of using inotify, e.g. on a network filesystem'
+    )
+
+    parser.add_argument(
+        '--poll_interval', 
+        type=float, 
+        default=2, 
+        help='Seconds between two scans of root_dir when polling (default: 2)'
+    )
+
+    parser.add_argument(
+        '--backlog', 
+        type=int, 
+        default=16, 
+        help='Number of settled folders waiting to be marked before the watcher stops taking new ones; also the largest batch marked at once (default: 16)'
+    )
+
+# Commands of marking.py, each validated by `check` and run by its own function in marking.py
+COMMANDS = ['scan', 'grade', 'report', 'export', 'enqueue', 'worker', 'merge', 'watch']
+
+def create_parser():
+    """
+    Creates an argument parser for the script, with one subcommand per command of COMMANDS.
+
+    Returns:
+        argparse.ArgumentParser: Configured argument parser.
+    """
+    parser = argparse.ArgumentParser(description="Process directory paths and API key for the marking system.")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    scan = commands.add_parser('scan', help='List the submission folders and what they hold, without marking them (no API key needed)')
+    add_folder_arguments(scan)
+
+    grade = commands.add_parser('grade', help='Mark the submissions in this process (the default command)')
+    add_folder_arguments(grade)
+    add_output_arguments(grade)
+    add_duplicate_arguments(grade)
+    add_marking_arguments(grade)
+    grade.add_argument(
+        '--incremental', 
+        action='store_true', 
+        help='Only process folders that changed since the last run and only re-run markers whose prompt changed'
+    )
+    add_api_arguments(grade)
+    add_cache_arguments(grade)
+
+    report = commands.add_parser('report', help='Render all.md, or the reports of some students, from the results store')
+    add_folder_arguments(report)
+    add_output_arguments(report)
+    report.add_argument('--run', type=int, default=None, help='Run to render (default: the last finished run)')
+    report.add_argument('--student', type=str, nargs='*', default=None, help='Only render the reports of these student IDs, to markdown_dir/<ID>.md')
+    report.add_argument('--compact', action='store_true', help='Link to the source files instead of inlining them')
+
+    export = commands.add_parser('export', help='Fill the marking table from the results store')
+    add_folder_arguments(export)
+    add_output_arguments(export)
+    export.add_argument('--run', type=int, default=None, help='Run to export (default: the last finished run)')
+
+    # Marking the cohort on several processes or machines through a shared queue: enqueue the folders of root_dir,
+    # run any number of workers, then merge their results into the output files. The three commands take the same
+    # options, so that the same command line runs on every machine.
+    queue_commands = {}
+    for name, help in [('enqueue', 'Add the folders of root_dir to the work queue'),
+                       ('worker', 'Mark the folders claimed from the work queue until it is empty'),
+                       ('merge', 'Write the results of the workers to marks.csv, all.md, the store and the marking table')]:
+        queue_commands[name] = commands.add_parser(name, help=help)
+        add_folder_arguments(queue_commands[name])
+        add_output_arguments(queue_commands[name])
+        add_duplicate_arguments(queue_commands[name])
+        add_marking_arguments(queue_commands[name])
+        add_api_arguments(queue_commands[name])
+        add_cache_arguments(queue_commands[name])
+        add_queue_arguments(queue_commands[name])
+
+    watch = commands.add_parser('watch', help='Mark the folders of root_dir again whenever they change, until interrupted')
+    add_folder_arguments(watch)
+    add_output_arguments(watch)
+    add_duplicate_arguments(watch)
+    add_marking_arguments(watch)
+    add_api_arguments(watch)
+    add_cache_arguments(watch)
+    add_watch_arguments(watch)
+
+    parser.commands = dict(scan=scan, grade=grade, report=report, export=export, watch=watch, **queue_commands)
     return parser
 
+def parse_args(argv=None):
+    """
+    Parses the command line. The command may also come after the options, as in
+    `python marking.py --root_dir ./Raw worker`; without a command, the options are those of `grade`, so that
+    `python marking.py --root_dir ./Raw` marks the cohort as before.
+    """
+    parser = create_parser()
+    argv = list(sys.argv[1:] if argv is None else argv)
+    # Options taking no value, after which a command name is the command rather than the value of the option
+    flags = set(option for action in parser._actions + [action for command in parser.commands.values() for action in command._actions]
+                if action.nargs == 0 for option in action.option_strings)
+    for i, token in enumerate(argv):
+        if token in COMMANDS and (i == 0 or not argv[i - 1].startswith('-') or argv[i - 1] in flags):
+            argv.insert(0, argv.pop(i))
+            break
+    if len(argv) == 0 or argv[0] not in COMMANDS + ['-h', '--help']:
+        argv.insert(0, 'grade')
+    return parser.parse_args(argv)
+
+def store_path(args):
+    """
+    Returns the path of the results store: --store, or results.sqlite in the output directory.
+    """
+    return args.store if args.store is not None else os.path.join(args.output_dir, 'results.sqlite')
+
 def check(args):
     """
-    Checks the existence of necessary files and directories, as well as the API key validity.
+    Checks the existence of the files and directories needed by the command, and the API key of the commands
+    calling ChatGPT (grade, worker and watch) unless all their markers use the mock backend.
 
     Args:
         args: The parsed command-line arguments.
@@ -85,8 +518,25 @@ def check(args):
     Raises:
         SystemExit: If any of the checks fail.
     """
+    if args.command in ('scan', 'grade', 'enqueue', 'watch') and not os.path.isdir(args.root_dir):
+        print(f"Error: The root directory '{args.root_dir}' does not exist.")
+        sys.exit(1)
+
+    if args.command in ('report', 'export'):
+        store = store_path(args)
+        if not os.path.isfile(store):
+            print(f"Error: no results store at '{store}'")
+            sys.exit(1)
+    if args.command == 'export' and not os.path.isfile(args.marking_table):
+        print(f"Error: no marking table at '{args.marking_table}'")
+        sys.exit(1)
+
     # Check for necessary prompt files
-    prompt_files = ['CODE.txt', 'GitM.txt', 'PANDA.txt', 'REPORT.txt', 'MarkdownReport.txt']
+    prompt_files = []
+    if args.command in ('grade', 'worker', 'watch'):
+        prompt_files = ['CODE.txt', 'GitM.txt', 'PANDA.txt', 'REPORT.txt', 'MarkdownReport.txt']
+    elif args.command == 'report':
+        prompt_files = ['MarkdownReport.txt']
     missing_files = [file for file in prompt_files if not os.path.isfile(os.path.join(args.prompts_dir, file))]
 
     if missing_files:
@@ -94,7 +544,7 @@ def check(args):
         sys.exit(1)
 
     # Check if markdown_dir exists, if not, create it
-    if not os.path.exists(args.markdown_dir):
+    if args.command in ('grade', 'worker', 'watch', 'report') and not os.path.exists(args.markdown_dir):
         os.makedirs(args.markdown_dir)
         print(f"Created directory: {args.markdown_dir}")
 
@@ -103,6 +553,9 @@ def check(args):
         os.makedirs(args.output_dir)
         print(f"Created directory: {args.output_dir}")
 
+    if args.command not in ('grade', 'worker', 'watch') or not uses_api(args):
+        return
+
     # Check if APIkey.txt exists and is not empty
     api_key_file = os.path.join(args.prompts_dir, 'APIkey.txt')
     if os.path.isfile(api_key_file):
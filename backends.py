@@ -0,0 +1,183 @@
+import re
+import json
+import time
+import threading
+from retry import retry_after
+
+# The prompts end with an example such as "simply return: 0,1,1,1." which has the right number of scores
+EXAMPLE_RE = re.compile(r'simply return:\s*\'?(\d+(?:\s*,\s*\d+)*)')
+# The combined prompt gives an example of its JSON answer, e.g. 'for example {"GitM": [0, 0]}.'
+JSON_EXAMPLE_RE = re.compile(r'for example (\{.*?\})\.')
+
+def example_reply(messages):
+    """
+    Default reply of the stand-in backends: the example scores given in the prompt, which are always valid.
+
+    Parameters:
+        messages (list): The chat messages of the request.
+
+    Returns:
+        str: The reply text.
+    """
+    match = EXAMPLE_RE.search(messages[-1]['content'])
+    return match.group(1).replace(' ', '') if match else '0'
+
+class BackendError(Exception):
+    def __init__(self, message, retry_after=None):
+        """
+        A request that failed but may succeed when sent again, e.g. a timeout, a rate limit or a server error.
+
+        Args:
+            message (str): What went wrong.
+            retry_after (float): Seconds the server asked to wait before retrying, None if it gave no hint.
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class OpenAIBackend:
+    name = 'openai'
+
+    def __init__(self, api_key=None, base_url=None, timeout=60.0, connections=8, keepalive=30.0):
+        """
+        Sends chat completions to the OpenAI API, or to an OpenAI-compatible server, through one client whose
+        pool of keep-alive connections is shared by every marker using the backend.
+
+        The client does not retry on its own: failed requests raise BackendError and are retried by the marker,
+        which counts them and follows its RetryPolicy.
+
+        Args:
+            api_key (str): The API key (default: the OPENAI_API_KEY environment variable).
+            base_url (str): Base URL of an OpenAI-compatible API (default: OpenAI).
+            timeout (float): Seconds a request may take before it fails (default: 60).
+            connections (int): Number of pooled connections, i.e. of requests in flight at once (default: 8).
+            keepalive (float): Seconds an idle connection is kept open for the next request (default: 30).
+        """
+        import openai  # Imported here so that the commands and backends that do not call the API never pay for it
+        try:
+            import httpx
+        except ImportError:
+            import httpx2 as httpx  # The HTTP library of recent openai releases
+        self.openai = openai
+        self.timeout = timeout
+        http_client = openai.DefaultHttpxClient(
+            timeout=timeout, limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections, keepalive_expiry=keepalive))
+        self.client = openai.OpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0, http_client=http_client)
+
+    def key(self, model):
+        """
+        Names the model in the keys of the response cache and the manifest.
+        """
+        return model
+
+    def complete(self, model, messages, **options):
+        """
+        Sends one chat completion request.
+
+        Args:
+            model (str): The chat model.
+            messages (list): The chat messages.
+            **options: Extra arguments of the request, e.g. response_format.
+
+        Returns:
+            tuple: (reply text, prompt tokens, completion tokens); the token counts are None when unknown.
+        """
+        try:
+            response = self.client.chat.completions.create(model=model, messages=messages, timeout=self.timeout, **options)
+        except (self.openai.AuthenticationError, self.openai.PermissionDeniedError):
+            raise  # Retrying cannot fix a wrong API key
+        except self.openai.OpenAIError as e:
+            raise BackendError(str(e), retry_after(e))
+        usage = getattr(response, 'usage', None)
+        return (response.choices[0].message.content or '', getattr(usage, 'prompt_tokens', None),
+                getattr(usage, 'completion_tokens', None))
+
+    def close(self):
+        self.client.close()
+
+class MockBackend:
+    name = 'mock'
+
+    def __init__(self, latency=0.0, script=None):
+        """
+        Answers chat completions locally, for offline runs and throughput tests. Replies are deterministic: the
+        first rule of `script` whose pattern is found in the user message gives the reply, otherwise the example
+        scores at the end of the prompt are returned (the example JSON object for a combined request).
+
+        Args:
+            latency (float): Seconds each reply takes (default: 0).
+            script (list): (pattern, reply) rules tried in order, e.g. read by `load_script`.
+        """
+        self.latency = latency
+        self.script = [(re.compile(pattern), reply) for pattern, reply in (script or [])]
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def key(self, model):
+        # Replies of the stand-in must never be taken for real marks by a later run
+        return 'mock/' + model
+
+    def complete(self, model, messages, **options):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+        content = messages[-1]['content']
+        for pattern, reply in self.script:
+            if pattern.search(content):
+                return reply, None, None
+        if options.get('response_format', {}).get('type') == 'json_object':
+            match = JSON_EXAMPLE_RE.search(content)
+            if match:
+                return match.group(1), None, None
+        return example_reply(messages), None, None
+
+    def close(self):
+        pass
+
+BACKENDS = {'openai': OpenAIBackend, 'mock': MockBackend}
+
+def load_script(path):
+    """
+    Reads the rules of a MockBackend from a JSON object mapping regular expressions to replies, e.g.
+    {"Section GitM": "{\"GitM\": [1, 1]}", "walking_panda": "1,0,2"}.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        return list(json.load(f).items())
+
+def create_backends(specs, api_key=None, base_url=None, timeout=60.0, connections=8, mock_latency=0.0, mock_script=None):
+    """
+    Creates the backend of each marker from the --backend items. Markers choosing the same kind of backend
+    share one instance, and so one connection pool.
+
+    Parameters:
+        specs (list): (marker name or None for every marker, backend kind) pairs; later items win.
+        api_key, base_url, timeout, connections: As for OpenAIBackend.
+        mock_latency (float): Latency of the MockBackend.
+        mock_script (str): Path of the rules of the MockBackend, see `load_script`.
+
+    Returns:
+        dict: The backend of each marker named in `specs`, and of all the others under None.
+    """
+    kinds = dict(specs)
+    kinds.setdefault(None, 'openai')
+    shared = {}
+    for kind in set(kinds.values()):
+        if kind == 'openai':
+            shared[kind] = OpenAIBackend(api_key, base_url, timeout, connections)
+        else:
+            shared[kind] = MockBackend(mock_latency, load_script(mock_script) if mock_script is not None else None)
+    return {name: shared[kind] for name, kind in kinds.items()}
+
+# Backend of the markers created without one, opened on their first request
+DEFAULT_BACKEND = []
+DEFAULT_LOCK = threading.Lock()
+
+def default_backend():
+    """
+    Returns the OpenAIBackend shared by the markers created without a backend, which reads its key from the
+    OPENAI_API_KEY environment variable.
+    """
+    with DEFAULT_LOCK:
+        if len(DEFAULT_BACKEND) == 0:
+            DEFAULT_BACKEND.append(OpenAIBackend())
+    return DEFAULT_BACKEND[0]
@@ -0,0 +1,179 @@
+import os
+import json
+import time
+from concurrent.futures import Future
+from grading import RateLimiter, completed
+from retry import RetryPolicy, CircuitBreaker
+from utils import SYSTEM_MESSAGE, MarkerResult, parse_scores
+from payload import count_tokens
+from cache import ResponseCache
+
+class BatchEngine:
+    def __init__(self, client, work_dir, poll_interval=30, retry_policy=None, resume=False):
+        """
+        Initializes an engine that sends all GPTMarker requests of a run as one job to the Batch API.
+
+        `submit` only records the rendered requests; `drain` uploads them as a JSONL file, waits for the job,
+        validates every reply with the same rules as GPTMarker and re-queues the invalid ones in a new job,
+        up to `retry_policy.max_attempts` jobs. The ids of the running jobs are saved in `work_dir`, so an
+        interrupted run can be resumed without submitting the requests again; requests that the saved jobs do
+        not cover are sent in a new job alongside them.
+
+        Args:
+            client (openai.OpenAI): The API client.
+            work_dir (str): Directory for the batch input files and the saved job state.
+            poll_interval (float): Seconds between two status checks of a job.
+            retry_policy (RetryPolicy): Gives the maximum number of jobs per request (default: RetryPolicy()).
+            resume (bool): Collect the results of the job saved by a previous run before submitting a new one.
+        """
+        self.client = client
+        self.work_dir = work_dir
+        self.state_path = os.path.join(work_dir, 'batch_state.json')
+        self.poll_interval = poll_interval
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.resume = resume
+        self.deferred = True  # Results only arrive once `drain` has run
+        # GPTMarker expects these from an engine; a batch job is not rate limited per request
+        self.limiter = RateLimiter()
+        self.breaker = CircuitBreaker()
+        self.requests = {}   # custom_id -> {'marker', 'content', 'futures'}
+        os.makedirs(work_dir, exist_ok=True)
+
+    def submit(self, marker, message):
+        """
+        Records a marker call for the next batch job.
+
+        Args:
+            marker (GPTMarker): The marker whose prompt is rendered.
+            message (dict): The assessment information passed to the marker.
+
+        Returns:
+            concurrent.futures.Future: A future holding the marker's scores once `drain` has run.
+        """
+        marker._count(calls=1)
+        content = marker.render(message)
+        # The content address of the request doubles as its custom_id, so identical requests are sent once
+        # and the results of a saved job can be matched to the requests of a resumed run
+        custom_id = ResponseCache.key(marker.model_key(), SYSTEM_MESSAGE, content, marker.fullmark)
+        if marker.cache is not None:
+            cached = marker.cache.get(custom_id)
+            if cached is not None:
+                return completed(MarkerResult(cached))
+        future = Future()
+        request = self.requests.setdefault(custom_id, {'marker': marker, 'content': content, 'futures': []})
+        request['futures'].append(future)
+        return future
+
+    def drain(self):
+        """
+        Runs batch jobs until every recorded request has a valid reply or has used up its attempts.
+        """
+        todo = dict(self.requests)
+        self.requests = {}
+        if len(todo) == 0:
+            return
+        saved = self._load_state() if self.resume else None
+        for attempt in range(1, self.retry_policy.max_attempts + 1):
+            jobs = [job for job in (saved or []) if any(custom_id in todo for custom_id in job['custom_ids'])]
+            for job in jobs:
+                print('Resuming batch job {}'.format(job['job_id']))
+            covered = set(custom_id for job in jobs for custom_id in job['custom_ids'])
+            uncovered = {custom_id: request for custom_id, request in todo.items() if custom_id not in covered}
+            if len(uncovered) != 0:
+                # Requests missing from the saved jobs are sent now instead of being counted as invalid replies
+                jobs.append(self._create_job(uncovered, attempt))
+                self._save_state(jobs)
+            saved = None
+            replies = {}
+            for job in jobs:
+                replies.update(self._wait_for_job(job['job_id']))
+            for custom_id, request in list(todo.items()):
+                marker = request['marker']
+                content = replies.get(custom_id)
+                scores = parse_scores(content, marker.fullmark) if content is not None else None
+                if scores is None:
+                    marker._count(invalid_replies=1)
+                    continue
+                if marker.cache is not None:
+                    marker.cache.put(custom_id, scores)
+                self._resolve(request, scores, False)
+                del todo[custom_id]
+            if len(todo) == 0:
+                break
+            print('{} batch replies were invalid or missing, re-queueing them'.format(len(todo)))
+            for request in todo.values():
+                request['marker']._count(retries=1)
+
+        for request in todo.values():
+            print('No valid score after {} batch jobs; flagged for manual review'.format(self.retry_policy.max_attempts))
+            request['marker']._count(manual_reviews=1)
+            self._resolve(request, [0] * len(request['marker'].fullmark), True)
+        if os.path.isfile(self.state_path):
+            os.remove(self.state_path)
+
+    def shutdown(self):
+        """
+        Nothing to release; present so that BatchEngine can be used in place of GradingEngine.
+        """
+        pass
+
+    def _resolve(self, request, scores, manual_review):
+        tokens = count_tokens(SYSTEM_MESSAGE + request['content'])
+        for future in request['futures']:
+            result = MarkerResult(scores)
+            result.manual_review = manual_review
+            result.tokens = tokens
+            future.set_result(result)
+
+    def _create_job(self, todo, attempt):
+        input_path = os.path.join(self.work_dir, 'batch_input_{}.jsonl'.format(attempt))
+        with open(input_path, 'w', encoding='utf-8') as f:
+            for custom_id, request in todo.items():
+                marker = request['marker']
+                marker._count(requests=1, prompt_tokens=count_tokens(SYSTEM_MESSAGE + request['content']))
+                f.write(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions',
+                                    'body': {'model': marker.chatmodel,
+                                             'messages': [{'role': 'system', 'content': SYSTEM_MESSAGE},
+                                                          {'role': 'user', 'content': request['content']}]}}) + '\n')
+        with open(input_path, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose='batch')
+        job = self.client.batches.create(input_file_id=input_file.id, endpoint='/v1/chat/completions', completion_window='24h')
+        print('Submitted batch job {} with {} requests'.format(job.id, len(todo)))
+        return {'job_id': job.id, 'custom_ids': list(todo)}
+
+    def _save_state(self, jobs):
+        with open(self.state_path, 'w', encoding='utf-8') as f:
+            json.dump({'jobs': jobs}, f)
+
+    def _load_state(self):
+        """
+        Returns the jobs saved by a previous run, each {'job_id', 'custom_ids'}, or None.
+        """
+        if not os.path.isfile(self.state_path):
+            print('No saved batch job to resume in {}'.format(self.work_dir))
+            return None
+        with open(self.state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        return state['jobs'] if 'jobs' in state else [state]  # State files of one job
+
+    def _wait_for_job(self, job_id):
+        """
+        Polls a job until it ends and returns {custom_id: reply text} of its successful requests.
+        """
+        while True:
+            job = self.client.batches.retrieve(job_id)
+            if job.status in ('completed', 'failed', 'expired', 'cancelled'):
+                break
+            time.sleep(self.poll_interval)
+        print('Batch job {} {}'.format(job_id, job.status))
+        replies = {}
+        if job.output_file_id is None:
+            return replies
+        for line in self.client.files.content(job.output_file_id).text.splitlines():
+            if line.strip() == '':
+                continue
+            record = json.loads(line)
+            response = record.get('response') or {}
+            if record.get('error') is None and response.get('status_code') == 200:
+                replies[record['custom_id']] = response['body']['choices'][0]['message']['content']
+        return replies
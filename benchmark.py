@@ -0,0 +1,315 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import tarfile
+import zipfile
+import argparse
+import resource
+import subprocess
+from glob import glob
+from openpyxl import Workbook
+import marking
+from grading import GradingEngine
+from retry import RetryPolicy
+from writers import ResultWriter
+from exporter import DEFAULT_ROWS, export_marks
+from mockserver import MockOpenAI, serve
+from backends import OpenAIBackend
+from profiler import PROFILE
+
+WORDS = ['git', 'commit', 'branch', 'python', 'panda', 'scene', 'model', 'window', 'tool', 'markdown', 'report',
+         'version', 'control', 'virtual', 'environment', 'the', 'a', 'and', 'to', 'of', 'in', 'i', 'used', 'new']
+
+MESSAGES = ['hello world', 'Add README and LICENSE', 'Add panda3d to requirements', 'Open a window', 'Add some scenery',
+            'Add a walking panda', 'Add report', 'Update report', 'Add command line arguments', 'Add sound', 'Fix typo']
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+def submission_files(i, rng, venv_files=0):
+    """
+    Builds the files of one synthetic student repository.
+
+    Parameters:
+        i (int): The number of the student.
+        rng (random.Random): The random generator.
+        venv_files (int): Number of files of a committed virtual environment to add (default: none).
+
+    Returns:
+        dict: {path inside the repository: text}.
+    """
+    paragraphs = []
+    for heading in ['Tools I used before', 'New tools', 'How they will change my practice']:
+        paragraphs.append('## ' + heading + '\n\n' + ' '.join(sentence(rng, rng.randint(8, 20)) for _ in range(rng.randint(3, 8))))
+    report = '# Report\n\n' + '\n\n'.join(paragraphs) + '\n\n- git\n- markdown\n\n[Panda3D](https://www.panda3d.org)\n'
+
+    options = rng.randint(0, 5)
+    code = ['import argparse', 'from direct.showbase.ShowBase import ShowBase', 'from direct.actor.Actor import Actor', '',
+            '# Based on the Panda3D manual', 'parser = argparse.ArgumentParser()']
+    code += ['parser.add_argument("--option{}", action="store_true")'.format(k) for k in range(options)]
+    code += ['args = parser.parse_args()', '', 'class WalkingPanda(ShowBase):', '    def __init__(self):',
+             '        ShowBase.__init__(self)', '        self.scene = self.loader.loadModel("models/environment")',
+             '        self.pandaActor = Actor("models/panda-model", {"walk": "models/panda-walk4"})']
+    if rng.random() < 0.5:
+        code.append('        self.music = self.loader.loadMusic("music.ogg")')
+    code += ['        self.x = {}'.format(rng.random()) for _ in range(rng.randint(0, 40))]
+
+    stamp = 1700000000 + i * 1000
+    head = ''.join('{} {} Student {} <s{}@uni.edu> {} +0000\tcommit: {}\n'.format(
+        '%040x' % rng.getrandbits(160), '%040x' % rng.getrandbits(160), i, i, stamp + k * 60, rng.choice(MESSAGES))
+        for k in range(rng.randint(1, 12)))
+
+    files = {'README.md': '# Walking Panda\n\n' + sentence(rng, 12) + '\n\nRun `python walking_panda.py --help`.\n',
+             'LICENSE.md': 'MIT License\n\nCopyright (c) 2024 Student {}\n'.format(i),
+             'requirements.txt': 'panda3d==1.10.14\n',
+             'hello_world.py': 'print("Hello World")\n',
+             'walking_panda.py': '\n'.join(code) + '\n',
+             'main.py': 'from walking_panda import WalkingPanda\n\nWalkingPanda().run()\n',
+             'doc/report.md': report,
+             '.git/logs/HEAD': head,
+             '.git/HEAD': 'ref: refs/heads/main\n'}
+    for k in range(venv_files):
+        files['venv/lib/python3.11/site-packages/pkg{}/module{}.py'.format(k // 20, k)] = 'x = {}\n'.format(k) * 20
+    return files
+
+def write_submission(dirn, i, rng, archive, venv_files=0):
+    """
+    Writes one synthetic student folder in the Raw layout: StudInfo.txt next to the repository, which is
+    either a plain folder or a zip/tar archive.
+
+    Parameters:
+        dirn (str): The student folder to create.
+        i (int): The number of the student.
+        rng (random.Random): The random generator.
+        archive (str): 'zip', 'tar' or 'none'.
+        venv_files (int): Number of virtual environment files to add (default: none).
+    """
+    os.makedirs(dirn)
+    student_id = '24{:07d}'.format(i)
+    with open(os.path.join(dirn, 'StudInfo.txt'), 'w') as f:
+        f.write('Student {} ({})\nEmail: s{}@uni.edu\nTutor: Tutor {}\n'.format(i, student_id, i, i % 5))
+    files = submission_files(i, rng, venv_files)
+    prefix = 'walking-panda-{}/'.format(student_id)
+    if archive == 'zip':
+        with zipfile.ZipFile(os.path.join(dirn, 'submission.zip'), 'w', zipfile.ZIP_DEFLATED) as z:
+            for path, text in files.items():
+                z.writestr(prefix + path, text)
+    elif archive == 'tar':
+        with tarfile.open(os.path.join(dirn, 'submission.tar.gz'), 'w:gz') as t:
+            for path, text in files.items():
+                data = text.encode('utf-8')
+                info = tarfile.TarInfo(prefix + path)
+                info.size = len(data)
+                t.addfile(info, io.BytesIO(data))
+    else:
+        for path, text in files.items():
+            file_path = os.path.join(dirn, prefix, path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'w') as f:
+                f.write(text)
+
+def generate_cohort(root, students, archive='mixed', venv_ratio=0.1, venv_files=200, seed=0):
+    """
+    Generates a synthetic cohort of submissions in the Raw layout.
+
+    Parameters:
+        root (str): The folder to create the submissions in; it is emptied first.
+        students (int): Number of submissions.
+        archive (str): 'zip', 'tar', 'none' or 'mixed' to cycle through the three (default: 'mixed').
+        venv_ratio (float): Fraction of the submissions that commit a virtual environment (default: 0.1).
+        venv_files (int): Number of files in a committed virtual environment (default: 200).
+        seed (int): Seed of the random generator, so that the cohort is reproducible (default: 0).
+
+    Returns:
+        list: The sorted student folders.
+    """
+    shutil.rmtree(root, ignore_errors=True)
+    rng = random.Random(seed)
+    kinds = ['zip', 'tar', 'none'] if archive == 'mixed' else [archive]
+    for i in range(students):
+        bloat = venv_files if rng.random() < venv_ratio else 0
+        write_submission(os.path.join(root, '24{:07d}'.format(i)), i, rng, kinds[i % len(kinds)], bloat)
+    return sorted(glob(os.path.join(root, '*')))
+
+def make_marking_table(path, students):
+    """
+    Creates an empty marking sheet with a column for each student, laid out like the one handed out to the markers.
+    """
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = 'Marking'
+    for key, row in DEFAULT_ROWS.items():
+        sheet.cell(row=row, column=1, value=key)
+    for i in range(students):
+        sheet.cell(row=1, column=2 + 2 * i, value='Number:')
+    workbook.save(path)
+
+def import_seconds(stderr):
+    """
+    Sums the self times of the modules listed by `python -X importtime` on stderr.
+    """
+    total = 0
+    for line in stderr.splitlines():
+        if line.startswith('import time:'):
+            microseconds = line.split('|')[0].split(':')[1].strip()
+            total += int(microseconds) if microseconds.isdigit() else 0
+    return total / 1e6
+
+def measure_startup(dirns, work_dir, prompts_dir, base_url):
+    """
+    Runs each command of marking.py in a new interpreter, as a marker would, and measures its wall time and the
+    time spent importing modules: grade marks the first student against the stand-in server (which is where
+    openai and pandas are loaded), report and export work from the store it wrote and scan reads the whole cohort.
+
+    Returns:
+        dict: {command: {'wall': seconds, 'imports': seconds}}.
+    """
+    root = os.path.join(work_dir, 'StartupRaw')
+    output_dir = os.path.join(work_dir, 'startup')
+    for folder in [root, output_dir]:
+        shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(root)
+    shutil.copytree(dirns[0], os.path.join(root, os.path.basename(dirns[0])))
+    table = os.path.join(output_dir, 'marking.xlsx')
+    folders = ['--output_dir', output_dir, '--markdown_dir', os.path.join(output_dir, 'MarkDowns'), '--prompts_dir', prompts_dir]
+    commands = [('grade', ['--root_dir', root, '--apikey', 'benchmark', '--base_url', base_url, '--workers', '1', '--no_cache',
+                           '--marking_table', table]),
+                ('report', ['--marking_table', table]),
+                ('export', ['--marking_table', table]),
+                ('scan', ['--root_dir', os.path.dirname(dirns[0])])]
+    os.makedirs(output_dir)
+    make_marking_table(table, 1)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'marking.py')
+    startup = {}
+    for command, options in commands:
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime', script, command] + folders + options,
+                                 capture_output=True, text=True)
+        startup[command] = {'wall': time.perf_counter() - start, 'imports': import_seconds(process.stderr)}
+        if process.returncode != 0:
+            print('marking.py {} failed:\n{}'.format(command, process.stdout[-2000:]))
+    return startup
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process and of its finished worker processes, in megabytes.
+    """
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS, KB on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return own, children
+
+def run_benchmark(args):
+    """
+    Generates a cohort, marks it against the local stand-in server and exports the marks.
+
+    Parameters:
+        args: The parsed command-line arguments of the benchmark.
+
+    Returns:
+        dict: The measurements of the run.
+    """
+    root = os.path.join(args.work_dir, 'Raw')
+    output_dir = os.path.join(args.work_dir, 'output')
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+    stages = {}
+
+    start = time.perf_counter()
+    dirns = generate_cohort(root, args.students, args.archive, args.venv_ratio, args.venv_files, args.seed)
+    stages['generate'] = time.perf_counter() - start
+
+    # Step 1 on its own, to separate the folder parsing from the API calls
+    start = time.perf_counter()
+    for _ in marking.extract_stage(dirns, args.workers, False, None):
+        pass
+    stages['scan'] = time.perf_counter() - start
+    PROFILE.reset()
+
+    state = MockOpenAI(latency=args.latency, error_rate=args.error_rate, malformed_rate=args.malformed_rate, seed=args.seed)
+    server, base_url = serve(state=state)
+    # The OpenAI backend talks to the stand-in over HTTP, so that the client and its connection pool are measured too
+    backend = OpenAIBackend('benchmark', base_url, connections=args.concurrency)
+
+    marking.prompts_dir = args.prompts_dir
+    marking.markdown_dir = os.path.join(output_dir, 'MarkDowns')
+    marking.output_dir = output_dir
+    os.makedirs(marking.markdown_dir)
+    engine = GradingEngine(concurrency=args.concurrency,
+                           retry_policy=RetryPolicy(max_attempts=args.max_attempts, base_delay=0.05, max_delay=1.0))
+    writer = ResultWriter(output_dir)
+    start = time.perf_counter()
+    asstable = marking.marking(dirns, engine, workers=args.workers, token_budgets={'CODE': 12000, 'PANDA': 12000}, writer=writer,
+                               backends={None: backend})
+    stages['marking'] = time.perf_counter() - start
+    writer.close()
+    engine.shutdown()
+    backend.close()
+    startup = measure_startup(dirns, args.work_dir, args.prompts_dir, base_url)
+    server.shutdown()
+
+    table = os.path.join(output_dir, 'marking.xlsx')
+    make_marking_table(table, len(dirns))
+    start = time.perf_counter()
+    export_marks(table, asstable.to_dict('records'))
+    stages['export'] = time.perf_counter() - start
+    profile = PROFILE.write(output_dir)
+
+    own, children = peak_rss_mb()
+    return {'students': len(dirns), 'archive': args.archive, 'workers': args.workers, 'concurrency': args.concurrency,
+            'latency': args.latency, 'error_rate': args.error_rate, 'malformed_rate': args.malformed_rate,
+            'wall_time': sum(stages.values()) - stages['generate'], 'stages': stages,
+            'requests': state.requests, 'injected_errors': state.errors, 'malformed_replies': state.malformed,
+            'requests_per_second': state.requests / stages['marking'] if stages['marking'] > 0 else 0.0,
+            'students_per_second': len(dirns) / stages['marking'] if stages['marking'] > 0 else 0.0,
+            'peak_rss_mb': own, 'peak_worker_rss_mb': children,
+            'marking_stages': {name: stage['total'] for name, stage in profile['stages'].items()},
+            'api_latency': profile['api']['all'], 'startup': startup}
+
+def print_report(result):
+    print('Students: {students} ({archive}), {workers} workers, {concurrency} calls in flight'.format(**result))
+    print('Mock server: {latency}s latency, {error_rate} error rate, {malformed_rate} malformed rate'.format(**result))
+    for stage, seconds in result['stages'].items():
+        print('  {:<10}{:>10.2f}s'.format(stage, seconds))
+    print('Inside marking (summed over students and workers):')
+    for stage, seconds in sorted(result['marking_stages'].items(), key=lambda item: -item[1]):
+        print('  {:<10}{:>10.2f}s'.format(stage, seconds))
+    print('API latency: p50 {p50:.3f}s, p90 {p90:.3f}s, p99 {p99:.3f}s'.format(**result['api_latency']))
+    print('Wall time (without generation): {:.2f}s'.format(result['wall_time']))
+    print('Requests: {requests} ({injected_errors} errors, {malformed_replies} malformed), '
+          '{requests_per_second:.1f} requests/s, {students_per_second:.2f} students/s'.format(**result))
+    print('Peak RSS: {:.1f} MB (workers: {:.1f} MB)'.format(result['peak_rss_mb'], result['peak_worker_rss_mb']))
+    print('Startup of marking.py (wall / imports):')
+    for command, times in result['startup'].items():
+        print('  {:<10}{:>8.2f}s{:>8.2f}s'.format(command, times['wall'], times['imports']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark marking.py on a synthetic cohort against a local stand-in server.")
+    parser.add_argument('--students', type=int, nargs='+', default=[50], help='Cohort sizes to run, e.g. 50 500 2000 (default: 50)')
+    parser.add_argument('--archive', type=str, default='mixed', choices=['zip', 'tar', 'none', 'mixed'], help='Format of the submissions (default: mixed)')
+    parser.add_argument('--venv_ratio', type=float, default=0.1, help='Fraction of the submissions committing a venv (default: 0.1)')
+    parser.add_argument('--venv_files', type=int, default=200, help='Number of files in a committed venv (default: 200)')
+    parser.add_argument('--latency', type=float, default=0.2, help='Mean delay in seconds of a chat completion (default: 0.2)')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of chat completions failing with 429/500 (default: 0)')
+    parser.add_argument('--malformed_rate', type=float, default=0.0, help='Fraction of replies holding no scores (default: 0)')
+    parser.add_argument('--max_attempts', type=int, default=5, help='Maximum number of requests per criterion (default: 5)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of processes running Step 1 (default: number of CPUs)')
+    parser.add_argument('--concurrency', type=int, default=8, help='Maximum number of ChatGPT calls in flight (default: 8)')
+    parser.add_argument('--prompts_dir', type=str, default='./prompts', help='Directory containing prompt files (default: ./prompts)')
+    parser.add_argument('--work_dir', type=str, default='./bench', help='Directory for the cohort and the outputs (default: ./bench)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the cohort and of the injected faults (default: 0)')
+    parser.add_argument('--json', type=str, default=None, help='Append the results as JSON lines to this file')
+    args = parser.parse_args()
+
+    sizes = args.students
+    for students in sizes:
+        args.students = students
+        result = run_benchmark(args)
+        print_report(result)
+        if args.json is not None:
+            with open(args.json, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(result) + '\n')
@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+class ResponseCache:
+    def __init__(self, cache_dir, max_age_days=None, max_size_mb=None):
+        """
+        Initializes a persistent cache of ChatGPT scores stored as one JSON file per entry.
+
+        Args:
+            cache_dir (str): The directory holding the cache entries.
+            max_age_days (float): Entries older than this are evicted, None to keep them forever.
+            max_size_mb (float): The cache is trimmed (oldest first) to this size, None for no limit.
+        """
+        self.cache_dir = cache_dir
+        self.max_age_days = max_age_days
+        self.max_size_mb = max_size_mb
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(chatmodel, system, content, fullmark):
+        """
+        Builds the content address of a request.
+
+        Parameters:
+            chatmodel (str): The name of the model.
+            system (str): The system message.
+            content (str): The rendered prompt.
+            fullmark (list): The maximum score of each criterion.
+
+        Returns:
+            str: The SHA-256 hex digest identifying the request.
+        """
+        payload = json.dumps([chatmodel, system, content, fullmark], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, key):
+        """
+        Looks up the scores of a request.
+
+        Parameters:
+            key (str): The key returned by `ResponseCache.key`.
+
+        Returns:
+            list: The cached scores, or None on a miss.
+        """
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                reply = json.load(f)['reply']
+        except (OSError, ValueError, KeyError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return reply
+
+    def put(self, key, reply):
+        """
+        Stores the scores of a request. The file is written under a temporary name and then renamed,
+        so concurrent markers and interrupted runs never leave a half-written entry.
+
+        Parameters:
+            key (str): The key returned by `ResponseCache.key`.
+            reply (list): The validated scores.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'reply': list(reply), 'time': time.time()}, f)
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        """
+        Removes every entry of the cache.
+        """
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        print(f"Cleared cache: {self.cache_dir}")
+
+    def evict(self):
+        """
+        Removes entries older than `max_age_days`, then the oldest entries until the cache fits in `max_size_mb`.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        entries = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()  # Oldest first
+
+        removed = 0
+        total_size = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, path in entries:
+            too_old = self.max_age_days is not None and now - mtime > self.max_age_days * 86400
+            too_big = self.max_size_mb is not None and total_size > self.max_size_mb * 1024 * 1024
+            if not (too_old or too_big):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+            removed += 1
+        return removed
+
+    def summary(self):
+        """
+        Returns a one-line description of the cache usage of this run.
+        """
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total else 0
+        return f"Cache: {self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate)"
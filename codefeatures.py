@@ -0,0 +1,209 @@
+import io
+import os
+import re
+import ast
+import json
+import tokenize
+from manifest import hash_text
+
+PANDA_MODULES = ('panda3d', 'direct')
+# Methods of panda3d objects worth reporting when a file imports panda3d
+PANDA_METHODS = {'loadModel', 'loadSfx', 'loadMusic', 'loadTexture', 'reparentTo', 'setPos', 'setHpr', 'setScale',
+                 'loop', 'play', 'posInterval', 'hprInterval', 'scaleInterval', 'accept', 'doMethodLater', 'run'}
+ARGUMENT_RE = re.compile(r'^[^#]*\.add_argument\(\s*([\'"][^\'"]*[\'"])?')
+MAX_COMMENTS = 200  # Comments and docstrings kept per submission for the prompts
+
+def file_features(text):
+    """
+    Parses one Python file with `ast` and `tokenize` and extracts its features.
+
+    Files that do not parse (e.g. Python 2 code) fall back to a line scan, so that their comments and
+    argparse options are still counted.
+
+    Parameters:
+        text (str): The Python source.
+
+    Returns:
+        dict: 'functions', 'classes', 'imports', 'options' (argparse option names), 'panda3d' (panda3d names and
+        methods used), 'comment_lines', 'docstrings', 'docstring_lines', 'code_lines', 'comments' and 'syntax_error'.
+    """
+    features = {'functions': 0, 'classes': 0, 'imports': [], 'options': [], 'panda3d': [], 'comment_lines': 0,
+                'docstrings': 0, 'docstring_lines': 0, 'code_lines': 0, 'comments': [], 'syntax_error': False}
+    lines = text.splitlines()
+    comment_rows = set()
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(text).readline):
+            if token.type == tokenize.COMMENT and not token.string.startswith('#!'):
+                comment_rows.add(token.start[0])
+                features['comments'].append(token.string.lstrip('#').strip())
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        comment_rows = set(i + 1 for i, line in enumerate(lines) if line.lstrip().startswith('#'))
+        features['comments'] = [lines[i - 1].lstrip().lstrip('#').strip() for i in sorted(comment_rows)]
+    features['comment_lines'] = len(comment_rows)
+    features['comments'] = [comment for comment in features['comments'] if comment != '']
+    features['code_lines'] = sum(1 for i, line in enumerate(lines)
+                                 if line.strip() != '' and not (i + 1 in comment_rows and line.lstrip().startswith('#')))
+
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        features['syntax_error'] = True
+        for line in lines:
+            match = ARGUMENT_RE.match(line)
+            if match:
+                features['options'].append(match.group(1).strip('\'"') if match.group(1) else '?')
+        return features
+
+    imports = set()
+    panda_names = {}    # Local name -> name imported from panda3d/direct
+    used = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            features['functions'] += 1
+        elif isinstance(node, ast.ClassDef):
+            features['classes'] += 1
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                imports.add(alias.name)
+                if alias.name.split('.')[0] in PANDA_MODULES:
+                    panda_names[(alias.asname or alias.name).split('.')[0]] = alias.name.split('.')[-1]
+        elif isinstance(node, ast.ImportFrom):
+            module = '.' * node.level + (node.module or '')
+            imports.add(module)
+            if module.split('.')[0] in PANDA_MODULES:
+                for alias in node.names:
+                    panda_names[alias.asname or alias.name] = alias.name
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            if node.func.attr == 'add_argument':
+                names = [arg.value for arg in node.args if isinstance(arg, ast.Constant) and isinstance(arg.value, str)]
+                long_names = [name for name in names if name.startswith('--')]
+                features['options'].append((long_names or names or ['?'])[0])
+            elif node.func.attr in PANDA_METHODS:
+                used.add(node.func.attr)
+        if isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+            docstring = ast.get_docstring(node)
+            if docstring:
+                features['docstrings'] += 1
+                features['docstring_lines'] += len(docstring.splitlines())
+                features['comments'].append(docstring.strip())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id in panda_names:
+            used.add(panda_names[node.id])
+    features['imports'] = sorted(imports)
+    features['panda3d'] = sorted(used) if len(panda_names) != 0 else []
+    return features
+
+# Caches of this process, keyed by directory, so that each worker process keeps its own in-memory cache
+CACHES = {}
+
+def feature_cache(cache_dir=None):
+    """
+    Returns the FeatureCache of this process for a directory (None for an in-memory cache only).
+    """
+    if cache_dir not in CACHES:
+        CACHES[cache_dir] = FeatureCache(cache_dir)
+    return CACHES[cache_dir]
+
+class FeatureCache:
+    def __init__(self, cache_dir=None):
+        """
+        Caches the features of Python files by content hash, in memory and optionally on disk, so that files
+        shared by several submissions (templates, copies) and unchanged files of later runs are parsed once.
+
+        Args:
+            cache_dir (str): Directory of the on-disk cache, None to only cache in memory.
+        """
+        self.cache_dir = cache_dir
+        self.memory = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, digest):
+        return os.path.join(self.cache_dir, digest[:2], digest + '.json')
+
+    def features(self, text):
+        """
+        Returns the features of a Python file, parsing it only if its content was not seen before.
+        """
+        digest = hash_text(text)
+        if digest in self.memory:
+            return self.memory[digest]
+        features = None
+        if self.cache_dir is not None and os.path.isfile(self._path(digest)):
+            try:
+                with open(self._path(digest), 'r', encoding='utf-8') as f:
+                    features = json.load(f)
+            except (OSError, ValueError):
+                features = None
+        if features is None:
+            features = file_features(text)
+            if self.cache_dir is not None:
+                os.makedirs(os.path.dirname(self._path(digest)), exist_ok=True)
+                with open(self._path(digest), 'w', encoding='utf-8') as f:
+                    json.dump(features, f)
+        self.memory[digest] = features
+        return features
+
+def code_features(pyfiles, cache=None):
+    """
+    Combines the features of the Python files of a submission into one record. Identical files are counted once.
+
+    Parameters:
+        pyfiles (list): (path, source) pairs of the Python files.
+        cache (FeatureCache): The cache of file features (default: a new in-memory cache).
+
+    Returns:
+        dict: 'files', 'functions', 'classes', 'imports', 'options' (distinct argparse options), 'panda3d',
+        'comment_lines', 'docstrings', 'code_lines', 'density' (comment and docstring lines per code line),
+        'syntax_errors' and 'comments' ((path, comment) pairs).
+    """
+    cache = cache if cache is not None else FeatureCache()
+    record = {'files': 0, 'functions': 0, 'classes': 0, 'imports': set(), 'options': [], 'panda3d': set(),
+              'comment_lines': 0, 'docstrings': 0, 'docstring_lines': 0, 'code_lines': 0, 'syntax_errors': 0, 'comments': []}
+    seen = set()
+    for path, text in pyfiles:
+        digest = hash_text(text)
+        if digest in seen:
+            continue
+        seen.add(digest)
+        features = cache.features(text)
+        record['files'] += 1
+        for key in ['functions', 'classes', 'comment_lines', 'docstrings', 'docstring_lines', 'code_lines']:
+            record[key] += features[key]
+        record['syntax_errors'] += int(features['syntax_error'])
+        record['imports'].update(features['imports'])
+        record['panda3d'].update(features['panda3d'])
+        record['options'] += [option for option in features['options'] if option == '?' or option not in record['options']]
+        record['comments'] += [(path, comment) for comment in features['comments']]
+    record['imports'] = sorted(record['imports'])
+    record['panda3d'] = sorted(record['panda3d'])
+    record['density'] = (record['comment_lines'] + record['docstring_lines']) / record['code_lines'] if record['code_lines'] else 0.0
+    return record
+
+def describe_features(record):
+    """
+    Formats a feature record as the short text sent to ChatGPT in place of the code.
+    """
+    lines = ['Python files: {}{}'.format(record['files'], ' ({} not parsable)'.format(record['syntax_errors']) if record['syntax_errors'] else ''),
+             'Functions: {}, classes: {}'.format(record['functions'], record['classes']),
+             'Imports: {}'.format(', '.join(record['imports']) or 'none'),
+             'panda3d API used: {}'.format(', '.join(record['panda3d']) or 'none'),
+             'Command-line options: {}'.format(', '.join(record['options']) or 'none'),
+             'Comment lines: {}, docstrings: {}, code lines: {} (comment density {:.2f})'.format(
+                 record['comment_lines'], record['docstrings'], record['code_lines'], record['density'])]
+    return '\n'.join(lines)
+
+def describe_comments(record, limit=MAX_COMMENTS):
+    """
+    Lists the comments and docstrings of a submission, grouped by file, up to `limit` of them.
+    """
+    lines = []
+    path = None
+    for file_path, comment in record['comments'][:limit]:
+        if file_path != path:
+            lines.append('# Path:' + file_path)
+            path = file_path
+        lines.append(comment)
+    if len(record['comments']) > limit:
+        lines.append('... {} more comments'.format(len(record['comments']) - limit))
+    return '\n'.join(lines) if lines else 'No comments'
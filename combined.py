@@ -0,0 +1,172 @@
+import re
+import json
+import time
+from concurrent.futures import Future
+from utils import GPTMarker, MarkerResult, SYSTEM_MESSAGE, parse_scores
+from payload import truncate_to_tokens
+
+CODE_PLACEHOLDER = '[The code is given once in the CODE section at the end of this message.]'
+
+COMBINED_INSTRUCTIONS = """You are given {count} independent marking tasks, one per section below. Each section asks for comma-separated scores; \
+instead, answer all sections at once with ONE JSON object that maps each section name to the list of integer scores for that section, \
+for example {example}. RETURN ONLY THE JSON OBJECT, WITHOUT ANY EXTRA INFORMATION."""
+
+class CombinedMarker(GPTMarker):
+    def __init__(self, markers, chatmodel = "gpt-4o", limiter = None, cache = None, retry_policy = None, breaker = None, backend = None):
+        """
+        Initializes a marker that asks for the scores of several GPTMarkers in one structured-output request.
+
+        The code blob used by several prompts is sent only once, and the system prompt is paid once per student
+        instead of once per marker. Each section of the JSON reply is validated against its own full marks, and
+        only the sections that fail are asked again.
+
+        Args:
+            markers (dict): The GPTMarker of each prompt, keyed by the prompt name.
+            chatmodel, limiter, cache, retry_policy, breaker, backend: As for GPTMarker.
+        """
+        super().__init__(None, {name: marker.fullmark for name, marker in markers.items()}, chatmodel,
+                         limiter=limiter, cache=cache, retry_policy=retry_policy, breaker=breaker, name='Combined', backend=backend)
+        self.markers = markers
+
+    def render(self, message, names=None):
+        """
+        Builds one prompt holding a section per marker and the code once.
+
+        Args:
+            message (dict): The assessment information of the student.
+            names (list): The markers to include (default: all).
+
+        Returns:
+            str: The prompt to send.
+        """
+        names = names if names is not None else list(self.markers)
+        sections = []
+        code_budgets = []
+        for name in names:
+            marker = self.markers[name]
+            if '{CODE}' in marker.prompt:
+                code_budgets.append(marker.budgets.get('CODE'))
+                sections.append('## Section {}\n{}'.format(name, marker.render(dict(message, CODE=CODE_PLACEHOLDER))))
+            else:
+                sections.append('## Section {}\n{}'.format(name, marker.render(message)))
+        example = json.dumps({name: [0] * len(self.markers[name].fullmark) for name in names})
+        content = COMBINED_INSTRUCTIONS.format(count=len(names), example=example) + '\n\n' + '\n\n'.join(sections)
+        if len(code_budgets) != 0:
+            code = str(message['CODE'])
+            if None not in code_budgets:
+                code = truncate_to_tokens(code, max(code_budgets))
+            content += '\n\n## CODE\n' + code
+        return content
+
+    def parse(self, text, names):
+        """
+        Validates each section of a JSON reply with the same rules as GPTMarker.
+
+        Args:
+            text (str): The reply text.
+            names (list): The markers that were asked.
+
+        Returns:
+            dict: The valid scores, keyed by marker name; failed sections are left out.
+        """
+        text = re.sub(r'^```(?:json)?\s*|\s*```$', '', text.strip())
+        try:
+            reply = json.loads(text)
+        except ValueError:
+            return {}
+        if not isinstance(reply, dict):
+            return {}
+        scores = {}
+        for name in names:
+            values = reply.get(name)
+            if not isinstance(values, list):
+                continue
+            parsed = parse_scores(','.join(str(value) for value in values), self.markers[name].fullmark)
+            if parsed is not None:
+                scores[name] = parsed
+        return scores
+
+    def __call__(self, message, names=None):
+        """
+        Scores a student for several markers at once.
+
+        Args:
+            message (dict): The assessment information of the student.
+            names (list): The markers to score (default: all).
+
+        Returns:
+            dict: A MarkerResult per marker, keyed by marker name.
+        """
+        names = list(names) if names is not None else list(self.markers)
+        self._count(calls=1)
+        results = {}
+
+        # Reuse the scores each marker would have got on its own from a previous run
+        keys = {}
+        for name in names:
+            marker = self.markers[name]
+            if self.cache is not None:
+                # Keyed by the backend answering the combined request, which may differ from the marker's own
+                keys[name] = self.cache.key(self.backend.key(marker.chatmodel) if self.backend is not None else marker.chatmodel,
+                                            SYSTEM_MESSAGE, marker.render(message), marker.fullmark)
+                cached = self.cache.get(keys[name])
+                if cached is not None:
+                    results[name] = MarkerResult(cached)
+        todo = [name for name in names if name not in results]
+
+        policy = self.retry_policy
+        for attempt in range(1, policy.max_attempts + 1):
+            if len(todo) == 0:
+                break
+            if attempt > 1:
+                self._count(retries=1)
+            text, tokens, hint = self.ask(self.render(message, todo), response_format={'type': 'json_object'})
+            if text is not None:
+                scores = self.parse(text, todo)
+                print('ChatGPT is marking: {}'.format(json.dumps(scores)))
+                for name, reply in scores.items():
+                    if self.cache is not None:
+                        self.cache.put(keys[name], reply)
+                    results[name] = MarkerResult(reply)
+                    results[name].tokens = tokens // len(todo)  # The request is shared by the sections it holds
+                if len(scores) != len(todo):
+                    self._count(invalid_replies=1)
+                todo = [name for name in todo if name not in scores]
+            if len(todo) != 0 and attempt < policy.max_attempts:
+                delay = policy.delay(attempt, hint)
+                self._count(backoff_seconds=delay)
+                time.sleep(delay)
+
+        # Give up on the sections that never got a valid answer and let a human check them
+        for name in todo:
+            print('ChatGPT gave no valid {} score after {} attempts; flagged for manual review'.format(name, policy.max_attempts))
+            self._count(manual_reviews=1)
+            results[name] = MarkerResult([0] * len(self.markers[name].fullmark))
+            results[name].manual_review = True
+        return results
+
+def split_future(future, names):
+    """
+    Turns the future of a CombinedMarker call into one future per marker.
+
+    Parameters:
+        future (concurrent.futures.Future): The future holding the dict returned by CombinedMarker.
+        names (list): The markers included in the call.
+
+    Returns:
+        dict: A future per marker name.
+    """
+    futures = {name: Future() for name in names}
+
+    def resolve(done):
+        try:
+            results = done.result()
+        except Exception as e:
+            for name in names:
+                futures[name].set_exception(e)
+            return
+        for name in names:
+            futures[name].set_result(results[name])
+
+    future.add_done_callback(resolve)
+    return futures
@@ -0,0 +1,165 @@
+import os
+import re
+import csv
+import json
+import zlib
+from manifest import hash_text
+
+# Fields rendered into the ChatGPT prompts; submissions agreeing on all of them get the same scores
+MARKER_FIELDS = ['GitM', 'CODE', 'CODEFeatures', 'CODEComments', 'README', 'REPORT', 'DSD']
+# Fields compared for near-duplicates
+SKETCH_FIELDS = ['CODE', 'REPORT']
+
+TOKEN_RE = re.compile(r'\w+|[^\w\s]')
+EMPTY_BIN = 0xFFFFFFFF
+
+def normalize(text, dirn):
+    """
+    Removes the submission folder from the paths quoted in a field, so that copies in different folders match.
+    """
+    if not isinstance(text, str):
+        return text
+    return text.replace(os.path.normpath(dirn), '')
+
+def sketch(text, num_perm=64, shingle=5):
+    """
+    Computes a MinHash sketch of the token shingles of a text with one-permutation hashing: every shingle is
+    hashed once and the minimum hash of each of the `num_perm` bins is kept.
+
+    Parameters:
+        text (str): The text to sketch.
+        num_perm (int): Number of bins of the sketch (default: 64).
+        shingle (int): Number of consecutive tokens per shingle (default: 5).
+
+    Returns:
+        tuple: The sketch, or None if the text has no shingle.
+    """
+    tokens = TOKEN_RE.findall(text.lower())
+    if len(tokens) < shingle:
+        return None
+    bins = [EMPTY_BIN] * num_perm
+    for i in range(len(tokens) - shingle + 1):
+        value = zlib.crc32(' '.join(tokens[i:i + shingle]).encode('utf-8'))
+        slot = value % num_perm
+        if value < bins[slot]:
+            bins[slot] = value
+    return tuple(bins)
+
+def similarity(a, b):
+    """
+    Estimates the Jaccard similarity of the shingles of two texts from their sketches.
+    """
+    used = [(x, y) for x, y in zip(a, b) if x != EMPTY_BIN or y != EMPTY_BIN]
+    if len(used) == 0:
+        return 0.0
+    return sum(1 for x, y in used if x == y) / len(used)
+
+class DuplicateIndex:
+    def __init__(self, threshold=0.9, num_perm=64, bands=16):
+        """
+        Finds identical and similar submissions without comparing every pair.
+
+        Each submission gets a content hash of the fields sent to ChatGPT, and a content hash plus a MinHash
+        sketch of its CODE and REPORT. The sketches are split into `bands` bands that are stored in an inverted
+        index, so only submissions sharing a band are compared.
+
+        Args:
+            threshold (float): Minimum estimated similarity of a CODE or REPORT to be flagged (default: 0.9).
+            num_perm (int): Number of bins of the sketches (default: 64).
+            bands (int): Number of bands of the inverted index; `num_perm` must be a multiple of it (default: 16).
+        """
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.rows = num_perm // bands
+        self.bands = bands
+        self.ids = {}            # Position -> student ID
+        self.keys = {}           # Position -> content hash of the marker fields
+        self.by_key = {}         # Content hash of the marker fields -> first position
+        self.fields = {}         # Position -> {field: (content hash, sketch)}
+        self.buckets = {}        # (field, band, band values) -> positions
+        self.exact = {}          # (field, content hash) -> positions
+
+    def add(self, position, dirn, assinfo):
+        """
+        Fingerprints a submission.
+
+        Parameters:
+            position (int): The position of the folder in the run.
+            dirn (str): The directory path containing the student submission.
+            assinfo (dict): The assessment information of the student.
+
+        Returns:
+            int: The position of an earlier-added submission whose marker fields are identical, or None.
+        """
+        self.ids[position] = assinfo['ID']
+        key = hash_text(json.dumps([normalize(assinfo.get(field), dirn) for field in MARKER_FIELDS]))
+        self.keys[position] = key
+        original = self.by_key.setdefault(key, position)
+
+        self.fields[position] = {}
+        for field in SKETCH_FIELDS:
+            text = normalize(assinfo.get(field), dirn)
+            if not isinstance(text, str):
+                continue
+            digest = hash_text(text)
+            signature = sketch(text, self.num_perm)
+            self.fields[position][field] = (digest, signature)
+            self.exact.setdefault((field, digest), []).append(position)
+            if signature is not None:
+                for band in range(self.bands):
+                    values = signature[band * self.rows:(band + 1) * self.rows]
+                    self.buckets.setdefault((field, band, values), []).append(position)
+        return original if original != position else None
+
+    def matches(self, position, earlier_only=True):
+        """
+        Lists the submissions whose CODE or REPORT is identical or similar to that of a submission.
+
+        Parameters:
+            position (int): The position of the submission.
+            earlier_only (bool): Only return submissions at an earlier position, so that a pair is reported
+                once and the result does not depend on the order the folders were processed in (default: True).
+
+        Returns:
+            list: (student ID, field, similarity) sorted by position then field.
+        """
+        found = []
+        for field, (digest, signature) in self.fields.get(position, {}).items():
+            candidates = set(self.exact[(field, digest)])
+            if signature is not None:
+                for band in range(self.bands):
+                    values = signature[band * self.rows:(band + 1) * self.rows]
+                    candidates.update(self.buckets[(field, band, values)])
+            for other in candidates:
+                if other == position or (earlier_only and other > position):
+                    continue
+                other_digest, other_signature = self.fields[other][field]
+                if other_digest == digest:
+                    score = 1.0
+                elif signature is None or other_signature is None:
+                    continue
+                else:
+                    score = similarity(signature, other_signature)
+                if score >= self.threshold:
+                    found.append((other, field, score))
+        return [(self.ids[other], field, score) for other, field, score in sorted(found)]
+
+def describe(matches):
+    """
+    Formats the matches of a submission for marks.csv and the report, e.g. '240000001 CODE 0.95'.
+    """
+    return '; '.join('{} {} {:.2f}'.format(student, field, score) for student, field, score in matches)
+
+def write_pairs(path, pairs):
+    """
+    Writes the flagged pairs of the cohort to a CSV file.
+
+    Parameters:
+        path (str): The path of the CSV file.
+        pairs (list): (student ID, other student ID, field, similarity) of every flagged pair.
+    """
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ID', 'SimilarTo', 'Field', 'Similarity'])
+        for student, other, field, score in pairs:
+            writer.writerow([student, other, field, '{:.2f}'.format(score)])
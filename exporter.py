@@ -0,0 +1,156 @@
+import re
+from args import full_marking
+
+# Rows of each criterion in the marking sheet handed out to the markers, used when the sheet has no label
+# for a criterion. Parts 1, 2 and 3 start on rows 5, 13 and 21; criterion 4 is on row 27.
+DEFAULT_ROWS = dict(zip(full_marking, [5, 6, 7, 8, 9, 10, 13, 14, 15, 16, 17, 18, 21, 22, 23, 24, 25, 27]))
+ID_ROW = 1
+NAME_ROW = 2
+
+CRITERION_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\b')
+
+def criterion_number(label):
+    """
+    Returns the number at the start of a criterion label, e.g. '2.2' for '2.2 [C]Good use of markdown e.g. headings'.
+
+    Parameters:
+        label: The text of a cell.
+
+    Returns:
+        str: The criterion number, or None if the label does not start with one.
+    """
+    match = CRITERION_RE.match(label) if isinstance(label, str) else None
+    return match.group(1) if match else None
+
+def same_value(old, new):
+    """
+    Compares a cell value with the value about to be written; numbers are compared by value and IDs read
+    back as text match the integers written before.
+    """
+    if old is None or new is None:
+        return old is new
+    try:
+        return float(old) == float(new)
+    except (TypeError, ValueError):
+        return str(old) == str(new)
+
+class MarkingTable:
+    def __init__(self, path, sheet='Marking'):
+        """
+        Opens the marking sheet and indexes it once: the row of each criterion of `full_marking` and the
+        column of each student.
+
+        Every student has a 'Number:' cell in row 1; their marks go in that column and their ID and name go
+        in row 1 and 2 of the next column. Criterion rows are found from their labels (a cell left of the first
+        student starting with the criterion number, e.g. '1.4'), falling back to DEFAULT_ROWS.
+
+        Args:
+            path (str): Path of the marking table.
+            sheet (str): Name of the worksheet (default: 'Marking').
+        """
+        from openpyxl import load_workbook
+        self.path = path
+        self.workbook = load_workbook(filename=path)
+        self.sheet = self.workbook[sheet]
+        self.changed = 0
+        self._index()
+
+    def _index(self):
+        self.slots = []      # Marks column of every student slot, left to right
+        self.columns = {}    # Student ID -> marks column
+        for cell in self.sheet[ID_ROW]:
+            if cell.value == 'Number:':
+                self.slots.append(cell.column)
+                student = self.sheet.cell(row=ID_ROW, column=cell.column + 1).value
+                if student is not None and str(student).strip() != '':
+                    self.columns[str(student).strip()] = cell.column
+        self.free = [column for column in self.slots if column not in self.columns.values()]
+
+        numbers = {criterion_number(key): key for key in full_marking}
+        self.rows = {}       # full_marking key -> row
+        last_label_column = (self.slots[0] - 1) if self.slots else self.sheet.max_column
+        for row in self.sheet.iter_rows(min_row=NAME_ROW + 1, max_col=max(1, last_label_column)):
+            for cell in row:
+                key = numbers.get(criterion_number(cell.value))
+                if key is not None and key not in self.rows:
+                    self.rows[key] = cell.row
+                    break
+        for key in full_marking:
+            self.rows.setdefault(key, DEFAULT_ROWS[key])
+
+    def column_of(self, student):
+        """
+        Returns the marks column of a student, giving them the next free slot if they are not in the sheet yet.
+
+        Parameters:
+            student: The student ID.
+
+        Returns:
+            int: The column index, or None if the sheet has no free slot left.
+        """
+        student = str(student).strip()
+        if student not in self.columns:
+            if len(self.free) == 0:
+                return None
+            self.columns[student] = self.free.pop(0)
+        return self.columns[student]
+
+    def _set(self, row, column, value):
+        cell = self.sheet.cell(row=row, column=column)
+        if not same_value(cell.value, value):
+            cell.value = value
+            return True
+        return False
+
+    def update(self, rows, students=None):
+        """
+        Writes the marks of several students; only cells whose value changed are touched.
+
+        Parameters:
+            rows (list): The results of each student as dicts with 'Name', 'ID' and a mark per key of `full_marking`.
+            students (set): Optional IDs of the students to write; the other rows are skipped (default: all).
+
+        Returns:
+            int: The number of students whose column changed.
+        """
+        changed = 0
+        for row in rows:
+            if students is not None and str(row['ID']) not in students:
+                continue
+            column = self.column_of(row['ID'])
+            if column is None:
+                print('No free column left in the marking table for {} ({})'.format(row['Name'], row['ID']))
+                continue
+            touched = self._set(ID_ROW, column + 1, row['ID'])
+            touched = self._set(NAME_ROW, column + 1, row['Name']) or touched
+            for key, criterion_row in self.rows.items():
+                if key in row:
+                    touched = self._set(criterion_row, column, row[key]) or touched
+            changed += touched
+        self.changed += changed
+        return changed
+
+    def save(self):
+        """
+        Saves the workbook if any cell changed since it was opened.
+        """
+        if self.changed > 0:
+            self.workbook.save(self.path)
+            self.changed = 0
+
+def export_marks(path, rows, students=None):
+    """
+    Writes the marks of a run into the marking table.
+
+    Parameters:
+        path (str): Path of the marking table.
+        rows (list): The results of each student, as returned in the rows of `marking`.
+        students (set): Optional IDs of the students to write (default: all).
+
+    Returns:
+        int: The number of students whose column changed.
+    """
+    table = MarkingTable(path)
+    changed = table.update(rows, students)
+    table.save()
+    return changed
@@ -0,0 +1,435 @@
+import os
+import json
+import zlib
+import heapq
+import struct
+import time
+from collections import OrderedDict
+
+OBJECT_TYPES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+OFS_DELTA = 6
+REF_DELTA = 7
+MAX_PATHS = 200      # Paths listed per commit; a commit adding a whole venv stops there
+BASE_CACHE = 256     # Delta bases kept per repository
+MAX_HISTORIES = 128  # Histories kept in memory per process
+
+class GitError(Exception):
+    """
+    Raised when a repository cannot be read, e.g. a missing object or an unsupported format.
+    """
+
+class Pack:
+    def __init__(self, index, data):
+        """
+        A packfile and its version 1 or 2 index, both held as buffers (memory-mapped files or bytes).
+        """
+        self.index = index
+        self.data = data
+        if index[:4] == b'\xfftOc':
+            if struct.unpack_from('>I', index, 4)[0] != 2:
+                raise GitError('Unsupported pack index version')
+            self.version = 2
+            self.fanout = struct.unpack_from('>256I', index, 8)
+        else:
+            self.version = 1
+            self.fanout = struct.unpack_from('>256I', index, 0)
+        self.count = self.fanout[255]
+
+    def _sha(self, i):
+        if self.version == 2:
+            start = 8 + 1024 + 20 * i
+        else:
+            start = 1024 + 24 * i + 4
+        return bytes(self.index[start:start + 20])
+
+    def _offset(self, i):
+        if self.version == 1:
+            return struct.unpack_from('>I', self.index, 1024 + 24 * i)[0]
+        base = 8 + 1024 + 24 * self.count
+        offset = struct.unpack_from('>I', self.index, base + 4 * i)[0]
+        if offset & 0x80000000:
+            # Offsets beyond 2 GB are stored in the large offset table
+            large = base + 4 * self.count
+            offset = struct.unpack_from('>Q', self.index, large + 8 * (offset & 0x7fffffff))[0]
+        return offset
+
+    def find(self, sha):
+        """
+        Looks an object up by binary search within its fan-out bucket.
+
+        Returns:
+            int: The offset of the object in the pack, or None.
+        """
+        first = sha[0]
+        low = self.fanout[first - 1] if first > 0 else 0
+        high = self.fanout[first]
+        while low < high:
+            middle = (low + high) // 2
+            value = self._sha(middle)
+            if value == sha:
+                return self._offset(middle)
+            if value < sha:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+def inflate(data, start, size):
+    """
+    Decompresses a zlib stream starting at `start` of a buffer, reading it in growing chunks.
+    """
+    decompressor = zlib.decompressobj()
+    parts = []
+    chunk = max(4096, size + 64)
+    position = start
+    while not decompressor.eof and position < len(data):
+        parts.append(decompressor.decompress(bytes(data[position:position + chunk])))
+        position += chunk
+        chunk *= 2
+    if not decompressor.eof:
+        raise GitError('Truncated object')
+    return b''.join(parts)
+
+def read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+def apply_delta(base, delta):
+    """
+    Rebuilds an object from its delta base and a git delta (copy and insert instructions).
+    """
+    _, position = read_varint(delta, 0)
+    size, position = read_varint(delta, position)
+    result = bytearray()
+    while position < len(delta):
+        op = delta[position]
+        position += 1
+        if op & 0x80:
+            offset = 0
+            length = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[position] << (8 * i)
+                    position += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    length |= delta[position] << (8 * i)
+                    position += 1
+            result += base[offset:offset + (length or 0x10000)]
+        elif op:
+            result += delta[position:position + op]
+            position += op
+        else:
+            raise GitError('Invalid delta')
+    if len(result) != size:
+        raise GitError('Delta result has the wrong size')
+    return bytes(result)
+
+class GitRepository:
+    def __init__(self, git_dir, fs):
+        """
+        Reads the objects of a .git folder without git: loose objects and packfiles, whose indexes are
+        binary-searched in place. Files on disk are memory-mapped; members of an archive are read into memory.
+
+        Args:
+            git_dir (str): The path of the .git folder.
+            fs (SubmissionFS): The view of the submission holding it.
+        """
+        self.git_dir = git_dir
+        self.fs = fs
+        self.buffers = []
+        self.packs = None
+        self.bases = {}
+
+    def _path(self, *parts):
+        return os.path.join(self.git_dir, *parts)
+
+    def _map(self, path):
+        buffer = self.fs.map(path)
+        self.buffers.append(buffer)
+        return buffer
+
+    def _load_packs(self):
+        self.packs = []
+        folder = self._path('objects', 'pack')
+        for name, is_dir in self.fs.scandir(folder):
+            if not is_dir and name.endswith('.idx') and self.fs.isfile(os.path.join(folder, name[:-4] + '.pack')):
+                self.packs.append(Pack(self._map(os.path.join(folder, name)), self._map(os.path.join(folder, name[:-4] + '.pack'))))
+
+    def close(self):
+        for buffer in self.buffers:
+            if hasattr(buffer, 'close'):
+                buffer.close()
+        self.buffers = []
+
+    def head(self):
+        """
+        Resolves HEAD to a commit id through loose refs and packed-refs.
+
+        Returns:
+            str: The commit id, or None if the branch has no commits (or its ref is missing).
+        """
+        ref = self.fs.read_text(self._path('HEAD')).strip()
+        for _ in range(10):
+            if not ref.startswith('ref:'):
+                return ref if len(ref) == 40 else None
+            name = ref[4:].strip()
+            if self.fs.isfile(self._path(*name.split('/'))):
+                ref = self.fs.read_text(self._path(*name.split('/'))).strip()
+                continue
+            ref = None
+            if self.fs.isfile(self._path('packed-refs')):
+                for line in self.fs.read_text(self._path('packed-refs')).splitlines():
+                    if line.endswith(' ' + name) and not line.startswith(('#', '^')):
+                        ref = line.split(' ')[0]
+            if ref is None:
+                return None
+        raise GitError('Symbolic ref loop')
+
+    def read(self, sha):
+        """
+        Reads an object by its hex id.
+
+        Returns:
+            tuple: (type, content bytes).
+        """
+        loose = self._path('objects', sha[:2], sha[2:])
+        if self.fs.isfile(loose):
+            data = zlib.decompress(self.fs.read_bytes(loose))
+            header, _, content = data.partition(b'\0')
+            return header.split(b' ')[0].decode(), content
+        if self.packs is None:
+            self._load_packs()
+        binary = bytes.fromhex(sha)
+        for pack in self.packs:
+            offset = pack.find(binary)
+            if offset is not None:
+                return self._unpack(pack, offset)
+        raise GitError('Object not found: {}'.format(sha))
+
+    def _unpack(self, pack, offset):
+        key = (id(pack), offset)
+        if key in self.bases:
+            return self.bases[key]
+        data = pack.data
+        byte = data[offset]
+        kind = (byte >> 4) & 7
+        size = byte & 15
+        shift = 4
+        position = offset + 1
+        while byte & 0x80:
+            byte = data[position]
+            position += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+        if kind == OFS_DELTA:
+            byte = data[position]
+            position += 1
+            distance = byte & 0x7f
+            while byte & 0x80:
+                byte = data[position]
+                position += 1
+                distance = ((distance + 1) << 7) | (byte & 0x7f)
+            base_type, base = self._unpack(pack, offset - distance)
+            result = (base_type, apply_delta(base, inflate(data, position, size)))
+        elif kind == REF_DELTA:
+            base_type, base = self.read(bytes(data[position:position + 20]).hex())
+            result = (base_type, apply_delta(base, inflate(data, position + 20, size)))
+        elif kind in OBJECT_TYPES:
+            result = (OBJECT_TYPES[kind], inflate(data, position, size))
+        else:
+            raise GitError('Unknown object type {}'.format(kind))
+        if result[0] != 'blob':
+            if len(self.bases) >= BASE_CACHE:
+                self.bases.pop(next(iter(self.bases)))
+            self.bases[key] = result
+        return result
+
+    def commit(self, sha):
+        """
+        Parses a commit.
+
+        Returns:
+            dict: 'tree', 'parents', 'author', 'time' (author time, seconds since the epoch) and 'message'.
+        """
+        kind, content = self.read(sha)
+        if kind != 'commit':
+            raise GitError('{} is a {}, not a commit'.format(sha, kind))
+        header, _, message = content.decode('utf-8', errors='replace').partition('\n\n')
+        commit = {'tree': None, 'parents': [], 'author': '', 'time': 0, 'message': message.strip()}
+        for line in header.splitlines():
+            key, _, value = line.partition(' ')
+            if key == 'tree':
+                commit['tree'] = value
+            elif key == 'parent':
+                commit['parents'].append(value)
+            elif key == 'author':
+                name, _, rest = value.partition(' <')
+                commit['author'] = name
+                fields = rest.split('> ')[-1].split(' ')
+                commit['time'] = int(fields[0]) if fields[0].isdigit() else 0
+        return commit
+
+    def tree(self, sha):
+        """
+        Parses a tree into {name: (is_dir, id)}.
+        """
+        kind, content = self.read(sha)
+        if kind != 'tree':
+            raise GitError('{} is a {}, not a tree'.format(sha, kind))
+        entries = {}
+        position = 0
+        while position < len(content):
+            space = content.index(b' ', position)
+            end = content.index(b'\0', space)
+            mode = content[position:space]
+            name = content[space + 1:end].decode('utf-8', errors='replace')
+            entries[name] = (mode == b'40000', content[end + 1:end + 21].hex())
+            position = end + 21
+        return entries
+
+    def changed_paths(self, old, new, prefix='', paths=None):
+        """
+        Lists the paths that differ between two trees (either may be None), skipping identical subtrees.
+        """
+        paths = paths if paths is not None else []
+        if old == new or len(paths) >= MAX_PATHS:
+            return paths
+        old_entries = self.tree(old) if old else {}
+        new_entries = self.tree(new) if new else {}
+        for name in sorted(set(old_entries) | set(new_entries)):
+            before = old_entries.get(name)
+            after = new_entries.get(name)
+            if before == after:
+                continue
+            if (before and before[0]) or (after and after[0]):
+                self.changed_paths(before[1] if before and before[0] else None,
+                                   after[1] if after and after[0] else None, prefix + name + '/', paths)
+                if (before and not before[0]) or (after and not after[0]):
+                    paths.append(prefix + name)
+            else:
+                paths.append(prefix + name)
+            if len(paths) >= MAX_PATHS:
+                break
+        return paths
+
+    def history(self, head, max_commits=500):
+        """
+        Walks the history from a commit, newest first, following every parent.
+
+        Returns:
+            list: One record per commit, oldest first: 'id' (abbreviated), 'time', 'author', 'message',
+            'parents' (number of parents) and 'paths' (changed against the first parent).
+
+        Raises:
+            GitError: If the commit `head` itself cannot be read; only missing parents are tolerated.
+        """
+        commits = {}
+        queue = []
+        pushed = [0]    # Commits of the same time come out in the order they were reached, children first
+
+        def push(sha):
+            if sha in commits:
+                return
+            try:
+                commits[sha] = self.commit(sha)
+            except GitError:
+                return  # Parents missing from a shallow clone end the walk there
+            pushed[0] += 1
+            heapq.heappush(queue, (-commits[sha]['time'], pushed[0], sha))
+
+        commits[head] = self.commit(head)  # Without its first commit the repository is unreadable, not empty
+        pushed[0] += 1
+        heapq.heappush(queue, (-commits[head]['time'], pushed[0], head))
+        records = []
+        while queue and len(records) < max_commits:
+            _, _, sha = heapq.heappop(queue)
+            commit = commits[sha]
+            parent_tree = None
+            if commit['parents']:
+                push(commit['parents'][0])
+                parent_tree = commits[commit['parents'][0]]['tree'] if commit['parents'][0] in commits else None
+            for parent in commit['parents'][1:]:
+                push(parent)
+            records.append({'id': sha[:7], 'time': commit['time'], 'author': commit['author'], 'message': commit['message'],
+                            'parents': len(commit['parents']), 'paths': self.changed_paths(parent_tree, commit['tree'])})
+        records.reverse()
+        return records
+
+# Histories recently read by this process, keyed by HEAD id, least recently used first. Bounded, as a long
+# watch reads a new history for every push
+HISTORIES = OrderedDict()
+
+def remember(head, records):
+    HISTORIES[head] = records
+    HISTORIES.move_to_end(head)
+    while len(HISTORIES) > MAX_HISTORIES:
+        HISTORIES.popitem(last=False)
+    return records
+
+def read_history(git_dir, fs, cache_dir=None, max_commits=500):
+    """
+    Reads the commit history of a repository, cached by the id of HEAD in memory and in `cache_dir`, so that a
+    repository is parsed once however many times it is marked.
+
+    Parameters:
+        git_dir (str): The path of the .git folder.
+        fs (SubmissionFS): The view of the submission holding it.
+        cache_dir (str): Directory of the on-disk cache, None to only cache in memory.
+        max_commits (int): Maximum number of commits read (default: 500).
+
+    Returns:
+        list: The commit records, oldest first (see GitRepository.history).
+
+    Raises:
+        GitError: If the repository cannot be read, e.g. it has no commits or its objects are missing.
+    """
+    repository = GitRepository(git_dir, fs)
+    try:
+        if not fs.isfile(os.path.join(git_dir, 'HEAD')):
+            raise GitError('No HEAD file')
+        head = repository.head()
+        if head is None:
+            raise GitError('HEAD does not name a commit')
+        if head in HISTORIES:
+            return remember(head, HISTORIES[head])
+        path = os.path.join(cache_dir, head + '.json') if cache_dir is not None else None
+        if path is not None and os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                return remember(head, json.load(f))
+        try:
+            records = repository.history(head, max_commits)
+        except (zlib.error, struct.error, IndexError, ValueError) as e:
+            raise GitError('Corrupt repository: {}'.format(e))
+    finally:
+        repository.close()
+    remember(head, records)
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(records, f)
+    return records
+
+def format_commits(records, max_paths=8):
+    """
+    Formats commit records for the GitM prompt and the report, one line per commit, e.g.
+    'commit: Add a panda (2024-10-01 14:03, walking_panda.py, models/panda.egg)'.
+    """
+    lines = []
+    for record in records:
+        subject = record['message'].splitlines()[0] if record['message'] else ''
+        paths = record['paths'][:max_paths]
+        if len(record['paths']) > max_paths:
+            paths.append('+{} more'.format(len(record['paths']) - max_paths))
+        details = [time.strftime('%Y-%m-%d %H:%M', time.gmtime(record['time']))]
+        if record['parents'] > 1:
+            details.append('merge')
+        lines.append('commit: {} ({})'.format(subject, ', '.join(details + paths)))
+    return '\n'.join(lines)
@@ -0,0 +1,119 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from retry import RetryPolicy, CircuitBreaker
+
+def estimate_tokens(text):
+    """
+    Gives a rough token count for a piece of text (about four characters per token).
+
+    Parameters:
+        text (str): The text that will be sent to the model.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    return len(text) // 4 + 1
+
+class RateLimiter:
+    def __init__(self, rpm=None, tpm=None):
+        """
+        Initializes a limiter that keeps requests and tokens within per-minute budgets.
+
+        Args:
+            rpm (int): Maximum number of requests per minute, None or 0 for no limit.
+            tpm (int): Maximum number of tokens per minute, None or 0 for no limit.
+        """
+        self.rpm = rpm
+        self.tpm = tpm
+        self.lock = threading.Lock()
+        self.events = deque()  # (timestamp, tokens) of the requests sent in the last minute
+        self.window_tokens = 0
+
+    def acquire(self, tokens=0):
+        """
+        Blocks until a request of the given size fits in the current one-minute window.
+
+        Args:
+            tokens (int): The estimated number of tokens of the request.
+
+        Returns:
+            float: The number of seconds spent waiting.
+        """
+        if not self.rpm and not self.tpm:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                # Drop the requests that have left the window
+                while self.events and now - self.events[0][0] >= 60:
+                    self.window_tokens -= self.events.popleft()[1]
+                fits_requests = not self.rpm or len(self.events) < self.rpm
+                # A single request larger than the whole budget is let through on an empty window
+                fits_tokens = not self.tpm or not self.events or self.window_tokens + tokens <= self.tpm
+                if fits_requests and fits_tokens:
+                    self.events.append((now, tokens))
+                    self.window_tokens += tokens
+                    return waited
+                delay = 60 - (now - self.events[0][0])
+            time.sleep(delay)
+            waited += delay
+
+def completed(value):
+    """
+    Wraps a value that is already known in a finished future.
+
+    Parameters:
+        value: The result of the future.
+
+    Returns:
+        concurrent.futures.Future: A future whose result is `value`.
+    """
+    future = Future()
+    future.set_result(value)
+    return future
+
+class GradingEngine:
+    def __init__(self, concurrency=8, rpm=None, tpm=None, retry_policy=None, breaker=None):
+        """
+        Initializes a thread pool that runs GPTMarker calls concurrently.
+
+        Args:
+            concurrency (int): Maximum number of marker calls in flight at the same time.
+            rpm (int): Maximum number of requests per minute shared by all markers.
+            tpm (int): Maximum number of tokens per minute shared by all markers.
+            retry_policy (RetryPolicy): How the markers retry failed calls (default: RetryPolicy()).
+            breaker (CircuitBreaker): Breaker shared by all markers (default: CircuitBreaker()).
+        """
+        self.concurrency = max(1, concurrency)
+        self.limiter = RateLimiter(rpm, tpm)
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='marker')
+
+    def submit(self, marker, message):
+        """
+        Schedules a marker call.
+
+        Args:
+            marker (callable): The marker to call, e.g. a GPTMarker instance.
+            message (dict): The assessment information passed to the marker.
+
+        Returns:
+            concurrent.futures.Future: A future holding the marker's scores.
+        """
+        return self.executor.submit(marker, message)
+
+    def drain(self):
+        """
+        Hook called once all calls have been submitted. Thread pool calls are already running, so there is nothing to do.
+        """
+        pass
+
+    def shutdown(self):
+        """
+        Waits for the running calls and releases the worker threads.
+        """
+        self.executor.shutdown(wait=True)
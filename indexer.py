@@ -0,0 +1,136 @@
+import os
+from fnmatch import fnmatch
+from vfs import SubmissionFS
+
+# Folders that are never part of a student's own work; they are counted but not walked
+SKIP_DIRS = ('node_modules', '__pycache__', 'site-packages')
+
+class SubmissionIndex:
+    def __init__(self, root, fs=None):
+        """
+        Walks a submission folder once with os.scandir and records every file by name, suffix and parent folder.
+        With a SubmissionFS, the members of mounted archives are indexed as if they had been extracted.
+
+        Hidden entries are left out like glob does, except that the location of `.git` folders is remembered.
+        Virtual environments (folders whose name contains 'venv' or that hold a pyvenv.cfg) and the folders in
+        SKIP_DIRS are not walked; only the number of entries directly inside them is recorded.
+
+        Args:
+            root (str): The submission folder.
+            fs (SubmissionFS): The view of the folder to walk (default: the files on disk).
+        """
+        self.root = root
+        self.fs = fs if fs is not None else SubmissionFS(root)
+        self.files = []        # Paths of all indexed files, in walk order
+        self.by_name = {}      # File name -> paths
+        self.by_suffix = {}    # Extension (e.g. '.md') -> paths
+        self.by_parent = {}    # Name of the parent folder -> paths
+        self.children = {}     # Folder path -> sorted list of (name, is_dir) of its visible entries
+        self.skipped = {}      # Path of a folder that was not walked -> number of entries inside it
+        self.venvs = []        # Paths of the virtual environments found
+        self.git_heads = []    # Paths of the .git/logs/HEAD files found
+        self.git_dirs = []     # Paths of the .git folders found (holding HEAD or logs/HEAD)
+        self.file_count = 0    # Number of files seen, including hidden ones and the entries of skipped folders
+        self._walk()
+
+    def _walk(self):
+        stack = [self.root]
+        while stack:
+            directory = stack.pop()
+            try:
+                entries = self.fs.scandir(directory)
+            except OSError:
+                continue
+
+            names = set(name for name, _ in entries)
+            name = os.path.basename(directory)
+            if directory != self.root and ('venv' in name or 'pyvenv.cfg' in names or name in SKIP_DIRS):
+                self.skipped[directory] = len(entries)
+                self.file_count += len(entries)
+                if name not in SKIP_DIRS:
+                    self.venvs.append(directory)
+                continue
+
+            visible = []
+            subdirs = []
+            for entry_name, is_dir in entries:
+                path = os.path.join(directory, entry_name)
+                if entry_name.startswith('.'):
+                    if is_dir and entry_name == '.git':
+                        if self.fs.isfile(os.path.join(path, 'logs', 'HEAD')):
+                            self.git_heads.append(os.path.join(path, 'logs', 'HEAD'))
+                        if self.fs.isfile(os.path.join(path, 'HEAD')) or self.git_heads[-1:] == [os.path.join(path, 'logs', 'HEAD')]:
+                            self.git_dirs.append(path)
+                    elif not is_dir:
+                        self.file_count += 1
+                    continue
+                visible.append((entry_name, is_dir))
+                if is_dir:
+                    subdirs.append(path)
+                else:
+                    self._add_file(path, entry_name, name)
+            self.children[directory] = visible
+            # Push in reverse so that folders are walked in name order
+            stack.extend(reversed(subdirs))
+
+    def _add_file(self, path, name, parent):
+        self.files.append(path)
+        self.file_count += 1
+        self.by_name.setdefault(name, []).append(path)
+        self.by_suffix.setdefault(os.path.splitext(name)[1], []).append(path)
+        self.by_parent.setdefault(parent, []).append(path)
+
+    def find(self, suffix):
+        """
+        Finds files like `find_files_with_suffix`, i.e. the matches of the glob '**/*suffix', without touching the disk.
+
+        Parameters:
+            suffix (str): The file suffix to search for (e.g. '.py', 'README.md' or 'doc/*.md').
+
+        Returns:
+            list: A list containing the paths of all matching files.
+        """
+        if '/' in suffix:
+            # e.g. 'doc/*.md': the last folder name must end with 'doc' and the file name must match '*.md'
+            parent_pattern, name_pattern = suffix.rsplit('/', 1)
+            parents = [p for p in self.by_parent if fnmatch(p, '*' + parent_pattern)]
+            return [path for p in parents for path in self.by_parent[p]
+                    if fnmatch(os.path.basename(path), name_pattern) and os.path.dirname(path) != self.root]
+        if suffix.startswith('.') and suffix.count('.') == 1:
+            return list(self.by_suffix.get(suffix, []))
+        return [path for name, paths in self.by_name.items() if name.endswith(suffix) for path in paths]
+
+    def has_venv(self):
+        """
+        Returns True if the submission contains a non-empty virtual environment.
+        """
+        return any(self.skipped[path] > 0 for path in self.venvs)
+
+    def directory_structure(self):
+        """
+        Generates the directory structure diagram of `get_directory_structure` from the index.
+        Virtual environments are left out; other skipped folders are shown with their number of entries.
+
+        Returns:
+            str: A formatted string representing the directory structure.
+        """
+        structure = []
+
+        def traverse(directory, prefix=""):
+            items = [(name, is_dir) for name, is_dir in self.children.get(directory, []) if 'venv' not in name]
+            for index, (item, is_dir) in enumerate(items):
+                path = os.path.join(directory, item)
+                label = item
+                if path in self.skipped:
+                    label = '{} ({} entries, not listed)'.format(item, self.skipped[path])
+                if index == len(items) - 1:
+                    structure.append(f"{prefix}└── {label}  ")
+                    next_prefix = prefix + "    "
+                else:
+                    structure.append(f"{prefix}├── {label}  ")
+                    next_prefix = prefix + "│   "
+                if is_dir and path in self.children:
+                    traverse(path, next_prefix)
+
+        traverse(self.root)
+        return "\n".join(structure)
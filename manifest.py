@@ -0,0 +1,179 @@
+import os
+import json
+import hashlib
+
+def hash_text(text):
+    """
+    Returns the SHA-256 hex digest of a string.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def hash_file(file_path, chunk_size=1 << 20):
+    """
+    Returns the SHA-256 hex digest of a file's content, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def folder_fingerprint(dirn):
+    """
+    Fingerprints a submission folder so that a later run can tell whether it changed.
+
+    Every file contributes its relative path, size and modification time. The files directly inside the folder
+    (the downloaded submission and StudInfo.txt) also contribute their content hash. Virtual environments,
+    node_modules and .git are not walked; only their own modification time is used.
+
+    Parameters:
+        dirn (str): The directory path containing the student submission.
+
+    Returns:
+        str: The fingerprint.
+    """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(dirn):
+        dirs.sort()
+        for name in list(dirs):
+            if 'venv' in name or name in ('node_modules', '.git'):
+                dirs.remove(name)
+                stat = os.stat(os.path.join(root, name))
+                digest.update('{}|dir|{}\n'.format(os.path.relpath(os.path.join(root, name), dirn), stat.st_mtime_ns).encode('utf-8'))
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            line = '{}|{}|{}'.format(os.path.relpath(path, dirn), stat.st_size, stat.st_mtime_ns)
+            if root == dirn:
+                line += '|' + hash_file(path)
+            digest.update((line + '\n').encode('utf-8'))
+    return digest.hexdigest()
+
+class RunManifest:
+    def __init__(self, output_dir, incremental=False):
+        """
+        Initializes the manifest of marking runs stored in `output_dir`.
+
+        The manifest records the fingerprint of every folder and the hashes of the prompts and of `full_marking`
+        used to mark it. The assessment information and ChatGPT scores of each folder are kept in a state file,
+        so that an incremental run can skip unchanged folders and only re-run markers whose prompt changed.
+
+        Args:
+            output_dir (str): The output directory holding manifest.json and the state folder.
+            incremental (bool): Reuse the results of unchanged folders instead of processing every folder.
+        """
+        self.path = os.path.join(output_dir, 'manifest.json')
+        self.state_dir = os.path.join(output_dir, 'state')
+        self.incremental = incremental
+        self.previous = {'prompts': {}, 'full_marking': None, 'extraction': None, 'folders': {}}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.previous = json.load(f)
+        self.prompts = {}
+        self.full_marking = None
+        self.extraction = None
+        self.changed_markers = set()
+        self.folders = {}
+        self.fingerprints = {}
+
+    def begin(self, prompt_hashes, full_marking, extraction=None):
+        """
+        Records the prompts and marking scheme of this run and works out which markers changed since the last run.
+
+        Parameters:
+            prompt_hashes (dict): Hash of each marker's prompt, full marks and model, keyed by marker name.
+            full_marking (dict): The full score of each criterion.
+            extraction (dict): The options shaping the assessment information of Step 1, e.g. the code budget.
+        """
+        self.prompts = prompt_hashes
+        self.full_marking = hash_text(json.dumps(full_marking, sort_keys=True))
+        self.extraction = hash_text(json.dumps(extraction or {}, sort_keys=True))
+        self.changed_markers = set(name for name, value in prompt_hashes.items() if self.previous['prompts'].get(name) != value)
+        if self.incremental and len(self.changed_markers) != 0:
+            print('Prompts changed since the last run: {}'.format(', '.join(sorted(self.changed_markers))))
+        if self.incremental and self.previous['full_marking'] not in (None, self.full_marking):
+            print('full_marking changed since the last run; all marks are recomputed')
+        elif self.incremental and self.previous.get('extraction') not in (None, self.extraction):
+            print('Step 1 options changed since the last run; every folder is processed again')
+
+    def _state_path(self, dirn):
+        return os.path.join(self.state_dir, hash_text(os.path.abspath(dirn))[:32] + '.json')
+
+    def lookup(self, dirn):
+        """
+        Returns the stored results of a folder that has not changed since the last run. The fingerprint of the
+        folder is taken here, before it is processed, and is the one `record` stores: a folder edited while it
+        is being marked is then marked again by the next run.
+
+        Parameters:
+            dirn (str): The directory path containing the student submission.
+
+        Returns:
+            tuple: (assessment information, {marker name: {'scores', 'manual_review'}}), or None if the folder
+            must be processed again, e.g. because it, `full_marking` or the options of Step 1 changed.
+        """
+        key = os.path.abspath(dirn)
+        fingerprint = self.fingerprints[key] = folder_fingerprint(dirn)
+        if (not self.incremental or self.previous['full_marking'] != self.full_marking
+                or self.previous.get('extraction') != self.extraction):
+            return None
+        entry = self.previous['folders'].get(key)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return None
+        try:
+            with open(self._state_path(dirn), 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return state['assinfo'], state['marks']
+
+    def reusable_marks(self, marks):
+        """
+        Selects the stored ChatGPT scores that are still valid: same prompt and not waiting for manual review.
+
+        Parameters:
+            marks (dict): {marker name: {'scores', 'manual_review'}} as returned by `lookup`.
+
+        Returns:
+            dict: {marker name: scores} of the markers that do not need to be called again.
+        """
+        return {name: mark['scores'] for name, mark in marks.items()
+                if name not in self.changed_markers and not mark['manual_review']}
+
+    def record(self, dirn, assinfo, marks):
+        """
+        Stores the results of a folder processed in this run.
+
+        Parameters:
+            dirn (str): The directory path containing the student submission.
+            assinfo (dict): The assessment information produced by Step 1.
+            marks (dict): The scores returned by each ChatGPT marker, keyed by marker name.
+        """
+        os.makedirs(self.state_dir, exist_ok=True)
+        state = {'assinfo': assinfo,
+                 'marks': {name: {'scores': list(scores), 'manual_review': getattr(scores, 'manual_review', False)}
+                           for name, scores in marks.items()}}
+        path = self._state_path(dirn)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+        key = os.path.abspath(dirn)
+        # The fingerprint taken by `lookup` before the folder was processed
+        fingerprint = self.fingerprints.pop(key) if key in self.fingerprints else folder_fingerprint(dirn)
+        self.folders[key] = {'fingerprint': fingerprint}
+
+    def save(self):
+        """
+        Writes manifest.json. Folders that were not part of this run are dropped.
+        """
+        manifest = {'prompts': self.prompts, 'full_marking': self.full_marking, 'extraction': self.extraction,
+                    'folders': self.folders}
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+        # A manifest kept for several runs (the watch command) compares the next run with this one
+        self.previous = dict(manifest, folders=dict(self.previous['folders'], **self.folders))
+        self.fingerprints = {}
@@ -1,235 +1,969 @@
 import os
+import csv
+import json
+import time
+import threading
 from glob import glob 
-import pandas as pd
-from bs4 import BeautifulSoup
+from queue import Queue, Empty, Full
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from utils import *
 from args import *
-import markdown
-from openpyxl import load_workbook
-from openpyxl.utils import column_index_from_string, get_column_letter
+from grading import GradingEngine, completed
+from cache import ResponseCache
+from retry import RetryPolicy
+from indexer import SubmissionIndex
+from vfs import SubmissionFS, ARCHIVE_SUFFIXES
+from manifest import RunManifest, hash_text
+from payload import build_code_payload
+from codefeatures import code_features, describe_features, describe_comments, feature_cache
+from batch import BatchEngine
+from combined import CombinedMarker, split_future
+from writers import ResultWriter, ReportStream
+from reports import load_template, render_report
+from mdstats import analyze_markdown, markdown_precheck
+from profiler import PROFILE, start_cprofile, stop_cprofile
+from duplicates import DuplicateIndex, MARKER_FIELDS, describe, write_pairs
+from store import ResultStore
+from rules import RuleEngine, overlay_future
+from gitreader import read_history, format_commits, GitError
+from workqueue import WorkQueue, QueueWriter, Heartbeat, worker_name
+from backends import create_backends
+from watcher import FolderWatcher, WatchWriter
+
+def collect_assinfo(dirn, extract=False, code_budget=None, analysis_dir=None):
+    """
+    Extracts all the information needed for marking from a student's submission folder.
+
+    A folder holding only a compressed submission is read straight from the archive: its members are indexed
+    and read on demand, so nothing is written to disk. With `extract=True` the archive is extracted first.
+
+    Parameters:
+        dirn (str): The directory path containing the student submission.
+        extract (bool): Extract compressed submissions to disk instead of reading them in place.
+        code_budget (int): Maximum number of tokens of the CODE payload, None for no limit.
+        analysis_dir (str): Directory caching the analysis of the submission across runs: the features of the
+            Python files by content hash in features/ and the git histories by HEAD in git/. None to only cache
+            them in memory.
+
+    Returns:
+        dict: The assessment information of the student, or None if the folder has nothing to mark.
+    """
+    print('Processing Folder: {}'.format(dirn))
+    student = os.path.basename(os.path.normpath(dirn))
+    with PROFILE.stage('step1', student):
+        return _collect_assinfo(dirn, student, extract, code_budget, analysis_dir)
+
+def _collect_assinfo(dirn, student, extract, code_budget, analysis_dir):
+    # Extract files if neccessary
+    with PROFILE.stage('index', student):
+        index = SubmissionIndex(dirn)
+        if index.file_count < 5:
+            all_fns = [os.path.join(dirn, name) for name, is_dir in index.children.get(dirn, [])]
+            non_txt_fns = [f for f in all_fns if not f.endswith('.txt')]
+            if len(non_txt_fns) == 0:
+                return None
+            if extract or not non_txt_fns[0].endswith(ARCHIVE_SUFFIXES):
+                with PROFILE.stage('extract', student):
+                    extract_file(non_txt_fns[0])
+                index = SubmissionIndex(dirn)
+            else:
+                try:
+                    index = SubmissionIndex(dirn, SubmissionFS(dirn, [non_txt_fns[0]]))
+                except Exception as e:
+                    print(f"Could not open {non_txt_fns[0]}: {e}")
+    fs = index.fs
+
+    studinfo = parse_student_info(index.find('StudInfo.txt')[0], fs)
+    print('Student Name: {} ({})'.format(studinfo['Name'], studinfo['ID']))
+
+    # The following are handling markdown files
+    mdfiles = index.find('.md')
+    mdfilesplit = [os.path.split(x)[1] for x in mdfiles]
+
+    if 'LICENSE.md' in mdfilesplit:
+        LICENSEmd = read_text_file(index.find('LICENSE.md')[0], fs)
+    else:
+        LICENSEmd = -1
+        print('LICENSE.md Not Found')
+
+    if 'README.md' in mdfilesplit:
+        READMEmd = read_text_file(index.find('README.md')[0], fs)
+    else:
+        READMEmd = -1
+        print('README.md Not Found')  
+
+    mdfilesplit = [x for x in mdfilesplit if (x != 'LICENSE.md') and (x != 'README.md') and (x != 'CODE_OF_CONDUCT.md')]
+
+    markdown_start = time.perf_counter()
+    if len(mdfilesplit) == 1:
+        REPORTmd = read_text_file(index.find(mdfilesplit[0])[0], fs)
+    elif len(mdfilesplit) == 0:
+        REPORTmd = -1
+    else:
+        REPORTind = [x for x in mdfilesplit if 'report' in x.lower()]
+        if len(REPORTind) == 0:
+            REPORTmd = -2
+        else:
+            REPORTmd = read_text_file(index.find(REPORTind[0])[0], fs)
+    # Word count and markdown structure in one pass over the raw text
+    REPORTStats = analyze_markdown(REPORTmd if isinstance(REPORTmd, str) else '')
+    REPORTCount = REPORTStats['words']
+    InDoc = 1 if len(index.find('doc/*.md')) != 0 else 0
+    PROFILE.record('markdown', time.perf_counter() - markdown_start, student)
+
+    # Check requirements.txt
+    reqfs = index.find('requirements.txt')
+    REQ = 0
+    REQS = -1
+    if len(reqfs) != 0:
+        REQS = read_text_file(reqfs[0], fs)
+        for reqf in reqfs:
+            if 'panda3d' in read_text_file(reqf, fs):
+                REQ = 1
+                REQS = read_text_file(reqf, fs)
+                break
+
+    # Git Commit Messages
+    GitM = -1
+    if len(index.git_dirs) != 0:
+        with PROFILE.stage('git', student):
+            try:
+                GitM = format_commits(read_history(index.git_dirs[0], fs, os.path.join(analysis_dir, 'git') if analysis_dir else None))
+            except (GitError, OSError) as e:
+                # Repositories without their objects (or unreadable ones) fall back to the reflog
+                head = os.path.join(index.git_dirs[0], 'logs', 'HEAD')
+                print('Cannot read the git objects of {} ({}), using the reflog'.format(dirn, e))
+                GitM = '\n'.join(extract_commit_info(head, fs)) if fs.isfile(head) else -1
+
+    # Code (virtual environments are not part of the index)
+    code_start = time.perf_counter()
+    pypath = index.find('walking_panda.py')[0] if len(index.find('walking_panda.py')) != 0 else -1
+    pyfiles = [(path, read_text_file(path, fs)) for path in index.find('.py')]
+    pyfiles = [(path, text) for path, text in pyfiles if text is not None]
+    CODE, _ = build_code_payload(pyfiles, code_budget)
+    PROFILE.record('code', time.perf_counter() - code_start, student)
+    with PROFILE.stage('features', student):
+        features = code_features(pyfiles, feature_cache(os.path.join(analysis_dir, 'features') if analysis_dir else None))
+    ARGUCount = len(features['options'])
+
+    # Directory Structure
+    dirstru = index.directory_structure()
+    VENV = -1 if index.has_venv() else 0
+    fs.close()
+
+    assinfo = {'Name':studinfo['Name'],\
+              'ID':studinfo['ID'],\
+              'Email':studinfo['Email'],\
+              'Tutor':studinfo['Tutor'],\
+               'PythonPath':pypath,\
+               'LICENSE':LICENSEmd,\
+              'README':READMEmd,\
+              'REPORT':REPORTmd,\
+               'REPORTWORDCount':REPORTCount,\
+               'REPORTHeadings':REPORTStats['headings'],\
+               'REPORTLists':REPORTStats['lists'],\
+               'REPORTLinks':REPORTStats['links'],\
+               'REPORTImages':REPORTStats['images'],\
+               'REPORTCodeBlocks':REPORTStats['code_blocks'],\
+               'REPORTMarkdownCheck':markdown_precheck(REPORTStats) if isinstance(REPORTmd, str) else None,\
+              'REQUIREMENTS':REQS,\
+              'InREQ':REQ,\
+               'InDoc':InDoc,\
+              'GitM':GitM,\
+               'CODE':CODE,\
+               'ARGUCount':ARGUCount,\
+               'CODEFunctions':features['functions'],\
+               'CODECommentLines':features['comment_lines'] + features['docstring_lines'],\
+               'CODECommentDensity':round(features['density'], 3),\
+               'CODEImports':', '.join(features['imports']),\
+               'CODEPanda3D':', '.join(features['panda3d']),\
+               'CODEFeatures':describe_features(features),\
+               'CODEComments':describe_comments(features),\
+              'VENV':VENV,\
+              'DSD':dirstru}
+    return assinfo
+
+def profiled_collect(dirn, extract=False, code_budget=None, analysis_dir=None):
+    """
+    Runs `collect_assinfo` in a worker process and returns its result with the timings recorded there.
+    """
+    assinfo = collect_assinfo(dirn, extract, code_budget, analysis_dir)
+    return assinfo, PROFILE.take()
+
+def extract_stage(dirns, workers=1, extract=False, code_budget=None, analysis_dir=None):
+    """
+    Runs Step 1 (archive reading, tree walks, markdown and regex parsing) for every folder.
+
+    With more than one worker the folders are processed by a process pool and yielded as soon as each one
+    finishes, so the grading stage can start sending ChatGPT requests while other folders are still parsed.
+    At most two folders per worker are submitted to the pool at a time; the next folder is submitted as each
+    one is yielded, so the pool never runs far ahead of the grading stage.
+
+    Parameters:
+        dirns (list): A list of directory paths containing student submissions.
+        workers (int): Number of worker processes, 1 to process the folders in this process.
+        extract (bool): Extract compressed submissions to disk instead of grading them from the archive.
+        code_budget (int): Maximum number of tokens of the CODE payload, None for no limit.
+        analysis_dir (str): Directory caching the Python file features and git histories, None to only cache them in memory.
+
+    Yields:
+        tuple: (position of the folder in `dirns`, folder, assessment information or None).
+    """
+    if workers <= 1:
+        for i, dirn in enumerate(dirns):
+            yield i, dirn, collect_assinfo(dirn, extract, code_budget, analysis_dir)
+        return
+    window = 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}    # Future -> position of its folder
+        pending = set()
+        submitted = 0
+        while submitted < len(dirns) or len(pending) != 0:
+            # Top up the window of folders submitted to the pool
+            while submitted < len(dirns) and len(pending) < window:
+                future = pool.submit(profiled_collect, dirns[submitted], extract, code_budget, analysis_dir)
+                futures[future] = submitted
+                pending.add(future)
+                submitted += 1
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                # Drop the future, so that its result is only held until the grading stage has taken it
+                i = futures.pop(future)
+                try:
+                    assinfo, profile = future.result()
+                    PROFILE.merge(profile)
+                except Exception:
+                    print('Processing failed: {}'.format(dirns[i]))
+                    raise
+                yield i, dirns[i], assinfo
+
+def load_markers(engine, cache=None, token_budgets=None, backends=None):
+    """
+    Creates the ChatGPT markers from the prompt files.
+
+    Parameters:
+        engine (GradingEngine): The engine whose rate limiter, retry policy and circuit breaker the markers share.
+        cache (ResponseCache): Optional persistent cache shared by all markers.
+        token_budgets (dict): Maximum number of CODE tokens sent by each marker, keyed by marker name.
+        backends (dict): The LLM backend of each marker, keyed by marker name, with the backend of the others
+            under None (default: the OpenAI API).
+
+    Returns:
+        dict: The GPTMarker of each prompt, keyed by the prompt name.
+    """
+    backends = backends if backends is not None else {}
+    markers = {}
+    for name, fullmark in marker_fullmarks.items():
+        prompt = read_text_file(os.path.join(prompts_dir, '{}.txt'.format(name)))
+        budgets = {'CODE': token_budgets[name], 'CODEComments': token_budgets[name]} if token_budgets and name in token_budgets else None
+        markers[name] = GPTMarker(prompt, fullmark, limiter=engine.limiter, cache=cache,
+                                  retry_policy=engine.retry_policy, breaker=engine.breaker, budgets=budgets, name=name,
+                                  backend=backends.get(name, backends.get(None)))
+    return markers
+
+def submit_markers(engine, markers, assinfo, reuse=None, combined=None, rules=None):
+    """
+    Sends the ChatGPT marker calls of one student to the grading engine.
+
+    Parameters:
+        engine (GradingEngine): The engine running the marker calls.
+        markers (dict): The GPTMarker of each prompt, keyed by the prompt name.
+        assinfo (dict): The assessment information of the student.
+        reuse (dict): Scores from a previous run that are still valid, keyed by marker name; these markers are not called.
+        combined (CombinedMarker): Optional marker asking for all the remaining criteria in a single request.
+        rules (RuleEngine): Optional rules deciding the clear-cut criteria; a marker whose criteria are all decided
+            is not called, and the decided criteria override the scores of the others.
+
+    Returns:
+        dict: A future for each marker that applies to the submission; the others get zero scores.
+    """
+    needed = {'GitM': assinfo['GitM'] != -1,
+              'CODE': (assinfo['README'] != -1) and (assinfo['CODE'] != -1),
+              'REPORT': assinfo['REPORT'] != -1,
+              'PANDA': assinfo['CODE'] != -1}
+    reuse = reuse if reuse is not None else {}
+    futures = {}
+    decided = {}
+    for name, marker in markers.items():
+        if name in reuse:
+            futures[name] = completed(MarkerResult(reuse[name]))
+            continue
+        elif not needed[name]:
+            futures[name] = completed([0] * len(marker_fullmarks[name]))
+            continue
+        decided[name] = rules.decide(name, assinfo) if rules is not None else [None] * len(marker_fullmarks[name])
+        if None not in decided[name]:
+            futures[name] = completed(MarkerResult(decided[name]))
+        elif combined is None:
+            futures[name] = engine.submit(marker, assinfo)
+    names = [name for name in markers if name not in futures]
+    if len(names) != 0:
+        futures.update(split_future(engine.submit(partial(combined, names=names), assinfo), names))
+    for name, scores in decided.items():
+        if None in scores and any(score is not None for score in scores):
+            futures[name] = overlay_future(futures[name], scores)
+    return futures
+
+def score_submission(assinfo, GitMmark, CODEmark, REPORTmark, PANDAmark):
+    """
+    Combines the ChatGPT scores with the rule-based checks into the marks of every criterion.
+
+    Parameters:
+        assinfo (dict): The assessment information of the student.
+        GitMmark, CODEmark, REPORTmark, PANDAmark (list): The scores returned by each ChatGPT marker.
 
-def marking(dirns):
+    Returns:
+        dict: The score of each criterion, keyed as in full_marking.
+    """
+    marking = {}
+    marking['1.1 completed "Running Some Code" section i.e hello_world.py'] = 1
+    marking['1.2 completed "Add README.md and LICENSE.md" section'] = 1 if (assinfo['README'] != -1) and (assinfo['LICENSE'] != -1) else 0
+    marking['1.3 completed "Adding a Dependency" section i.e. added panda3D to requirements.txt'] = 1 if assinfo['InREQ'] == 1 else 0
+    marking['1.4 [C]completed 3 panda related sections i.e. visual/window, scenery and panda (3 marks)'] = PANDAmark[0]
+    marking['1.5 [C]Git: At least 4 commits i.e. hello_world, README/LICENCE, add some scenery, add a panda'] = GitMmark[0]
+    marking['1.6 [C]Provided meaningful commit messages (about part 1 only)'] = GitMmark[1]
+
+    marking['2.1 Report as a markdown file, found in doc directory'] = assinfo['InDoc']
+    marking['2.2 [C]Good use of markdown e.g. headings'] = int(REPORTmark[0])
+    marking['2.3 [C]Describe whether you have used any of the tools or equivalent tools in the past'] = REPORTmark[1]
+    marking['2.4 [C]Describe how you think the tools new to you will change your development practice'] = REPORTmark[2]
+    marking['2.5 Report should be between 300-500 words (+10% allowed)'] = 1 if assinfo['REPORTWORDCount'] > 250 else 0
+    marking['2.6 [C]Git: committed and provided meaningful commit messages (about part 2 only)'] = GitMmark[2]
+
+    marking['3.1 [C]Updated README.md'] = CODEmark[0]
+    marking['3.2 [C]Included comments in code (e.g. referenced external code)'] = CODEmark[1]
+    ARGUCount = assinfo['ARGUCount']
+    if ARGUCount > 4:
+        marking['3.3 a) Argument Implementation (2 marks, 0.5 per option)'] = 2
+    elif ARGUCount < 0:
+        marking['3.3 a) Argument Implementation (2 marks, 0.5 per option)'] = 0
+    else:
+        marking['3.3 a) Argument Implementation (2 marks, 0.5 per option)'] = ARGUCount / 2
+    marking['3.4 [C]A Multi-Media experience (1 mark)'] = PANDAmark[1]
+    marking['3.5 [C]Git: committed and provided meaningful commit messages (about part 3 only)'] = GitMmark[3]
+
+    marking['4 DO NOT SUBMIT INCORRECT FILES (e.g. venv)'] = assinfo['VENV']
+    return marking
+
+def marking(dirns, engine=None, cache=None, extract=False, workers=1, manifest=None, token_budgets=None, combined=False, writer=None,
+            duplicate_threshold=0.9, reports='full', rules=True, analysis_dir=None, backends=None):
     """
     Grades student submissions in specified directories.
 
+    The ChatGPT calls of every student are sent to the grading engine as soon as the folder has been
+    processed, so calls for different criteria and different students run at the same time. Results
+    are collected in the order of `dirns`, which keeps the output deterministic, and each student is
+    written to marks.csv and all.md as soon as it is finished.
+
     Parameters:
         dirns (list): A list of directory paths containing student submissions.
+        engine (GradingEngine): The engine running the ChatGPT calls (default: one call at a time), or a
+            BatchEngine that sends them all as one Batch API job.
+        cache (ResponseCache): Optional cache of ChatGPT scores reused across runs.
+        extract (bool): Extract compressed submissions to disk instead of grading them from the archive.
+        workers (int): Number of processes running Step 1 (default: 1).
+        manifest (RunManifest): Optional manifest recording this run; in incremental mode unchanged folders
+            reuse their previous results and only markers whose prompt changed are called again.
+        token_budgets (dict): Maximum number of CODE tokens sent by each marker, keyed by marker name
+            (default: no limit).
+        combined (bool): Ask for all the criteria of a student in one structured-output request instead of
+            one request per marker (not supported by the BatchEngine).
+        writer (ResultWriter): The writer of marks.csv and all.md (default: a new writer in `output_dir`).
+        duplicate_threshold (float): Minimum similarity of the CODE or REPORT of two students to flag them in the
+            Duplicates column and in duplicates.csv, None to turn duplicate detection off (default: 0.9).
+            Students whose ChatGPT inputs are identical to an earlier student reuse their scores.
+        reports (str): 'full' to render the reports with the files inlined, 'compact' to link to the files
+            instead, 'none' to only store the results and render the reports later with reports.py (default: 'full').
+        rules (bool): Decide the clear-cut criteria with the rules of Rules.json in the prompts directory instead of
+            asking ChatGPT (default: True).
+        analysis_dir (str): Directory caching the features of the Python files and the git histories across runs
+            (default: only cached in memory).
+        backends (dict): The LLM backend of each marker, as for `load_markers` (default: the OpenAI API).
 
     Returns:
-        tuple: A tuple containing:
-            - pd.DataFrame: A DataFrame with assessment information for each student.
-            - str: A concatenated string of markdown content for all students.
-    """
-    promptGitM = read_text_file(os.path.join(prompts_dir, 'GitM.txt'))
-    promptCODE = read_text_file(os.path.join(prompts_dir, 'CODE.txt'))
-    promptREPORT = read_text_file(os.path.join(prompts_dir, 'REPORT.txt'))
-    promptPANDA = read_text_file(os.path.join(prompts_dir, 'PANDA.txt'))
-    GitMMarker = GPTMarker(promptGitM, [1,1,1,1])
-    CODEMarker = GPTMarker(promptCODE, [1,1])
-    REPORTMarker = GPTMarker(promptREPORT, [1,1,2])
-    PANDAMarker = GPTMarker(promptPANDA, [3,1])
-    MarkdownReport = read_text_file(os.path.join(prompts_dir, 'MarkdownReport.txt'))
+        pd.DataFrame: A DataFrame with assessment information for each student, with the bulky text fields
+        replaced by the paths of the files holding them.
+    """
+    own_engine = engine is None
+    if own_engine:
+        engine = GradingEngine(concurrency=1)
+    backends = backends if backends is not None else {}
+    markers = load_markers(engine, cache, token_budgets, backends)
+    rule_engine = RuleEngine.load(os.path.join(prompts_dir, 'Rules.json'), marker_criteria, marker_fullmarks) if rules else None
+    code_budget = max(token_budgets.values()) if token_budgets else None
+    combined_marker = None
+    if combined:
+        combined_marker = CombinedMarker(markers, limiter=engine.limiter, cache=cache, retry_policy=engine.retry_policy,
+                                         breaker=engine.breaker, backend=backends.get('Combined', backends.get(None)))
+    MarkdownReport = load_template(prompts_dir, reports == 'compact')
+    
+    if manifest is not None:
+        manifest.begin({name: hash_text(json.dumps([marker.model_key(), SYSTEM_MESSAGE, marker.prompt, marker.fullmark, marker.budgets,
+                                                    rule_engine.config_of(name) if rule_engine is not None else None]))
+                        for name, marker in markers.items()}, full_marking, {'code_budget': code_budget})
+
+    ### Step 1: Extract all neccessary information from the folders and queue the ChatGPT markers
+    # Students are finished in folder order as soon as their markers are done, so that only the students in
+    # flight are held in memory. `results` maps the position of a folder to its pending work (None if skipped).
+    own_writer = writer is None
+    if own_writer:
+        writer = ResultWriter(output_dir)
+    results = {}
+    submitted = {}   # Folder -> time its markers were queued
+    duplicates = DuplicateIndex(duplicate_threshold) if duplicate_threshold is not None else None
+    shared = {}      # Position -> (futures, ID) of the students whose markers were sent
+    copies = {}      # Position -> ID of the student whose scores it reuses
+    pairs = []
+    rows = []
+    next_position = 0
+    max_pending = 4 * getattr(engine, 'concurrency', 16)
+
+    def finish_ready(block):
+        # Finish the students at the head of the queue; without `block`, stop at the first one still in flight
+        nonlocal next_position
+        while next_position in results:
+            entry = results[next_position]
+            if entry is not None:
+                dirn, assinfo, futures = entry
+                if not block and not all(future.done() for future in futures.values()):
+                    return
+                rows.append(finish(next_position, dirn, assinfo, futures))
+            del results[next_position]
+            next_position += 1
+
+    def finish(i, dirn, assinfo, futures):
+        student = os.path.basename(os.path.normpath(dirn))
+        with PROFILE.stage('wait', student):
+            for future in futures.values():
+                future.result()
+        PROFILE.record('in_flight', time.perf_counter() - submitted.pop(dirn), student)
+        similar = duplicates.matches(i) if duplicates is not None else []
+        pairs.extend((assinfo['ID'], other, field, score) for other, field, score in similar)
+        with PROFILE.stage('step3', student):
+            return finish_submission(dirn, assinfo, futures, MarkdownReport, writer, manifest, similar, copies.pop(i, None), reports)
+
+    def submit(i, dirn, assinfo, reuse=None):
+        # Students whose ChatGPT inputs are identical to a student already sent share their scores
+        if duplicates is not None:
+            original = duplicates.add(i, dirn, assinfo)
+            if original is not None and original in shared and reuse is None:
+                futures, copies[i] = shared[original]
+                PROFILE.count(duplicate_submissions=1)
+                print('Identical to {}: reusing its ChatGPT scores'.format(copies[i]))
+                return futures
+        futures = submit_markers(engine, markers, assinfo, reuse, combined_marker, rule_engine)
+        if duplicates is not None:
+            shared[i] = (futures, assinfo['ID'])
+        return futures
+
+    def add_result(i, dirn, assinfo, futures):
+        nonlocal next_position
+        results[i] = None if assinfo is None else (dirn, assinfo, futures)
+        if assinfo is not None:
+            submitted[dirn] = time.perf_counter()   # Popped by `finish`, which skipped folders never reach
+        finish_ready(block=False)
+        # Backpressure: wait for the oldest student rather than let parsed folders pile up in memory.
+        # A deferred engine (batch mode) only answers once everything has been submitted, so it cannot wait.
+        while not getattr(engine, 'deferred', False) and len(results) > max_pending and next_position in results:
+            entry = results.pop(next_position)
+            if entry is not None:
+                rows.append(finish(next_position, *entry))
+            next_position += 1
+            finish_ready(block=False)
+
+    todo = []
+    for i, dirn in enumerate(dirns):
+        stored = manifest.lookup(dirn) if manifest is not None else None
+        if stored is None:
+            todo.append(i)
+            continue
+        assinfo, marks = stored
+        print('Unchanged since the last run: {}'.format(dirn))
+        add_result(i, dirn, assinfo, submit(i, dirn, assinfo, manifest.reusable_marks(marks)))
+
+    for j, dirn, assinfo in extract_stage([dirns[i] for i in todo], workers, extract, code_budget, analysis_dir):
+        futures = submit(todo[j], dirn, assinfo) if assinfo is not None else None
+        add_result(todo[j], dirn, assinfo, futures)
+    engine.drain()
+    finish_ready(block=True)
+    if duplicates is not None and writer.pairs_file is not None:
+        if len(pairs) != 0:
+            print('{} similar pairs of submissions, see {}'.format(len(pairs), writer.pairs_file))
+        write_pairs(os.path.join(writer.output_dir, writer.pairs_file), pairs)
+
+    if own_writer:
+        writer.close()
+    if own_engine:
+        engine.shutdown()
+    for name, marker in markers.items():
+        print('{} marker: {}'.format(name, marker.summary()))
+        PROFILE.markers[name] = dict(marker.stats)
+    if combined_marker is not None:
+        print('Combined marker: {}'.format(combined_marker.summary()))
+        PROFILE.markers['Combined'] = dict(combined_marker.stats)
+    if rule_engine is not None:
+        print('\n'.join(rule_engine.summary()))
+        PROFILE.rules = dict(rule_engine.stats)
+    if manifest is not None:
+        manifest.save()
     
-    assinfos = []
-    markdowns = []
-    for dirn in dirns:
+    import pandas as pd  # Only loaded by the commands that mark
+    asstable = pd.DataFrame(rows)
+    
+    return asstable
 
-        ### Step 1: Extract all neccessary information from the folder
+def finish_submission(dirn, assinfo, futures, MarkdownReport, writer, manifest=None, similar=None, copy_of=None, reports='full'):
+    """
+    Runs Steps 2 and 3 for a student whose ChatGPT markers have been queued: waits for the scores,
+    computes the marks, saves the markdown report and streams the results to the output files.
 
-        print('Processing Folder: {}'.format(dirn))
+    Parameters:
+        dirn (str): The directory path containing the student submission.
+        assinfo (dict): The assessment information of the student.
+        futures (dict): The future of each ChatGPT marker, keyed by marker name.
+        MarkdownReport (str): The template of the markdown report.
+        writer (ResultWriter): The writer of marks.csv and all.md.
+        manifest (RunManifest): Optional manifest recording the results of this run.
+        similar (list): (student ID, field, similarity) of the earlier students with a similar CODE or REPORT.
+        copy_of (str): ID of the student whose ChatGPT scores were reused, if the submissions are identical.
+        reports (str): 'full', 'compact' or 'none', as for `marking`.
 
-        # Extract files if neccessary
-        if count_files_in_directory(dirn) < 5:
-            all_fns = glob(os.path.join(dirn, '*'))
-            non_txt_fns = [f for f in all_fns if not f.endswith('.txt')]
-            if len(non_txt_fns) == 0:
+    Returns:
+        dict: The row written to marks.csv.
+    """
+    ### Step 2: Marking
+    marks = {name: future.result() for name, future in futures.items()}
+    if manifest is not None:
+        manifest.record(dirn, assinfo, marks)
+    marking = score_submission(assinfo, marks['GitM'], marks['CODE'], marks['REPORT'], marks['PANDA'])
+
+    ### Step 3: Generate reports and update
+    studinfo = {key: assinfo[key] for key in ['Name', 'ID', 'Email', 'Tutor']}
+    marking['All_marks'] = generate_markdown_report_string(marking, full_marking, studinfo, assinfo, dirn)
+    review = [name for name, mark in marks.items() if getattr(mark, 'manual_review', False)]
+    if len(review) != 0:
+        marking['All_marks'] += '**Needs manual review, ChatGPT gave no valid scores for: {}**  \n'.format(', '.join(review))
+    similar = similar if similar is not None else []
+    if copy_of is not None:
+        marking['All_marks'] += '**Identical to the submission of {}; its ChatGPT scores were reused**  \n'.format(copy_of)
+    if len(similar) != 0:
+        marking['All_marks'] += '**Similar to other submissions (ID, part, similarity): {}**  \n'.format(describe(similar))
+
+    assinfo.update(marking)
+    assinfo['ManualReview'] = ', '.join(review)
+    assinfo['Duplicates'] = describe(similar)
+    for name, mark in marks.items():
+        assinfo['{}Tokens'.format(name)] = getattr(mark, 'tokens', 0) if copy_of is None else 0
+    report_path = os.path.join(markdown_dir, '{}.md'.format(studinfo['ID']))
+    if reports == 'full':
+        mdreport = MarkdownReport.format(**assinfo)
+        save_txt_file(mdreport, report_path)
+        return writer.write(dirn, assinfo, mdreport)
+
+    # Compact reports link to the saved text files, relative to where each report is written
+    row = writer.slim(dirn, assinfo)
+    mdreport = None
+    if reports == 'compact':
+        save_txt_file(render_report(MarkdownReport, row, True, markdown_dir), report_path)
+        mdreport = render_report(MarkdownReport, row, True, writer.output_dir)
+    return writer.write(dirn, assinfo, mdreport, row)
+
+def work(queue, worker, claim_size=8, **options):
+    """
+    Runs a marking worker: claims folders from the queue until none is left, marks them and records the
+    results in the queue. The leases of the claimed folders are renewed by a heartbeat while they are marked,
+    and the worker only stops once no other worker holds a lease, so that the folders of a worker that dies
+    are taken over.
+
+    Parameters:
+        queue (WorkQueue): The queue shared by the workers.
+        worker (str): The name of this worker.
+        claim_size (int): Number of folders claimed at a time; their ChatGPT calls run concurrently (default: 8).
+        **options: Arguments of `marking` (engine, cache, extract, workers, ...).
+
+    Returns:
+        int: The number of folders marked by this worker.
+    """
+    marked = 0
+    with Heartbeat(queue, worker):
+        while True:
+            batch = queue.claim(worker, claim_size)
+            if len(batch) == 0:
+                if queue.counts()['leased'] == 0:
+                    break
+                # Other workers are still marking: stand by to take over their folders if their leases run out
+                time.sleep(min(10, queue.lease_seconds / 3))
                 continue
-            extract_file(non_txt_fns[0])
+            marked += mark_batch(queue, worker, batch, **options)
+            print('Queue: {}'.format(', '.join('{} {}'.format(count, status) for status, count in queue.counts().items())))
+    queue.record_calls(worker, PROFILE.requests)
+    return marked
 
-        marking = {}
-        studinfo = parse_student_info(find_files_with_suffix('StudInfo.txt', dirn)[0])
-        print('Student Name: {} ({})'.format(studinfo['Name'], studinfo['ID']))
+def mark_batch(queue, worker, batch, **options):
+    """
+    Marks claimed folders and records their results in the queue. When the batch fails, its folders are
+    marked one at a time so that a single broken folder does not fail the others; that folder is handed
+    back to the queue with the error.
+    """
+    writer = QueueWriter(queue, worker, output_dir)
+    try:
+        marking(batch, writer=writer, **options)
+    except Exception as e:
+        if len(batch) > 1:
+            return sum(mark_batch(queue, worker, [dirn], **options) for dirn in batch if dirn not in writer.written)
+        print('Marking failed: {} ({})'.format(batch[0], e))
+        queue.release(batch[0], worker, repr(e))
+        return 0
+    # Folders with nothing to mark are finished without a result
+    for dirn in batch:
+        if dirn not in writer.written:
+            queue.complete(dirn, worker, None, None)
+    return len(batch)
+
+def merge_queue(queue, writer, duplicate_threshold=0.9):
+    """
+    Writes the results recorded by the workers to marks.csv, all.md and the store, in folder order.
 
-        # The following are handling markdown files
-        mdfiles = find_files_with_suffix('.md', dirn)
-        mdfilesplit = [os.path.split(x)[1] for x in mdfiles]
+    Workers only compare the submissions they marked together, so the near-duplicates are looked up again
+    across the whole cohort for the Duplicates column and duplicates.csv.
 
-        if 'LICENSE.md' in mdfilesplit:
-            LICENSEmd = read_text_file(find_files_with_suffix('LICENSE.md', dirn)[0])
-        else:
-            LICENSEmd = -1
-            print('LICENSE.md Not Found')
+    Parameters:
+        queue (WorkQueue): The queue filled by the workers.
+        writer (ResultWriter): The writer of the output files.
+        duplicate_threshold (float): As for `marking`, None to keep the Duplicates column of the workers.
 
-        if 'README.md' in mdfilesplit:
-            READMEmd = read_text_file(find_files_with_suffix('README.md', dirn)[0])
-        else:
-            READMEmd = -1
-            print('README.md Not Found')  
-
-        mdfilesplit = [x for x in mdfilesplit if (x != 'LICENSE.md') and (x != 'README.md') and (x != 'CODE_OF_CONDUCT.md')]
-
-        if len(mdfilesplit) == 1:
-            REPORTmd = read_text_file(find_files_with_suffix(mdfilesplit[0], dirn)[0])
-            html = markdown.markdown(REPORTmd)
-            soup = BeautifulSoup(html, 'html.parser')
-            plain_text = soup.get_text()
-            REPORTCount = len(plain_text.split())
-        elif len(mdfilesplit) == 0:
-            REPORTmd = -1
-        else:
-            REPORTind = [x for x in mdfilesplit if 'report' in x.lower()]
-            if len(REPORTind) == 0:
-                REPORTmd = -2
-            else:
-                REPORTmd = read_text_file(find_files_with_suffix(REPORTind[0], dirn)[0])
-                html = markdown.markdown(REPORTmd)
-                soup = BeautifulSoup(html, 'html.parser')
-                plain_text = soup.get_text()
-                REPORTCount = len(plain_text.split())
-        InDoc = 1 if len(find_files_with_suffix('doc/*.md', dirn)) != 0 else 0
-
-        # Check requirements.txt
-        reqfs = find_files_with_suffix('requirements.txt', dirn)
-        REQ = 0
-        REQS = -1
-        if len(reqfs) != 0:
-            REQS = read_text_file(reqfs[0])
-            for reqf in reqfs:
-                if 'panda3d' in read_text_file(reqf):
-                    REQ = 1
-                    REQS = read_text_file(reqf)
+    Returns:
+        int: The number of students written.
+    """
+    duplicates = DuplicateIndex(duplicate_threshold) if duplicate_threshold is not None else None
+    if duplicates is not None:
+        for i, (dirn, row, _) in enumerate(queue.results()):
+            duplicates.add(i, dirn, dict(row, **{field: read_saved_text(row.get(field)) for field in MARKER_FIELDS}))
+    pairs = []
+    count = 0
+    for i, (dirn, row, report) in enumerate(queue.results()):
+        if duplicates is not None:
+            similar = duplicates.matches(i)
+            pairs.extend((row['ID'], other, field, score) for other, field, score in similar)
+            row['Duplicates'] = describe(similar)
+        writer.write(dirn, row, report, row)
+        count += 1
+    if duplicates is not None:
+        write_pairs(os.path.join(writer.output_dir, writer.pairs_file), pairs)
+    for dirn, attempts, error in queue.failures():
+        print('Failed after {} attempts: {} ({})'.format(attempts, dirn, error))
+    return count
+
+def watch(watcher, writer, backlog=16, **options):
+    """
+    Marks the folders handed out by the watcher as they settle, until interrupted with Ctrl+C.
+
+    The watcher runs on its own thread and puts the folders in a queue of `backlog` folders; when the queue is
+    full the watcher waits, so that a burst of uploads does not pile up. Each round marks the folders waiting
+    together (at most `backlog`), then publishes their results through the writer.
+
+    Parameters:
+        watcher (FolderWatcher): The watcher of root_dir.
+        writer (WatchWriter): The writer publishing the results.
+        backlog (int): Number of folders waiting to be marked before the watcher is held back (default: 16).
+        **options: Arguments of `marking` (engine, cache, manifest, extract, workers, ...).
+
+    Returns:
+        int: The number of folders marked.
+    """
+    pending = Queue(maxsize=backlog)
+    queued = set()      # Folders in `pending`, which are not queued twice
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    def produce():
+        for dirn in watcher.changes(stopped):
+            with lock:
+                if dirn in queued:
+                    continue
+                queued.add(dirn)
+            while not stopped.is_set():
+                try:
+                    pending.put(dirn, timeout=1)
                     break
+                except Full:
+                    continue
+
+    threading.Thread(target=produce, daemon=True).start()
+    marked = 0
+    try:
+        while True:
+            batch = [pending.get()]
+            while len(batch) < backlog:
+                try:
+                    batch.append(pending.get_nowait())
+                except Empty:
+                    break
+            with lock:
+                queued.difference_update(batch)
+            # A failed round is marked again without the folders it wrote, so only count those of this round
+            writer.written.clear()
+            marked += mark_changes(batch, writer, **options)
+            writer.sync()
+            print('Marked {} folders; {} waiting'.format(marked, pending.qsize()))
+    except KeyboardInterrupt:
+        print('Stopped watching')
+    stopped.set()
+    return marked
+
+def mark_changes(batch, writer, **options):
+    """
+    Marks the folders of one round of `watch`. As in `mark_batch`, a failed round is marked again one folder at a
+    time, and a folder that still fails is left as it was until it changes again.
+    """
+    options = dict(options, workers=min(options.get('workers', 1), len(batch)))
+    try:
+        marking(batch, writer=writer, **options)
+    except Exception as e:
+        if len(batch) > 1:
+            return sum(mark_changes([dirn], writer, **options) for dirn in batch if dirn not in writer.written)
+        print('Marking failed: {} ({})'.format(batch[0], e))
+        return 0
+    return len(batch)
+
+def read_saved_text(value):
+    """
+    Reads a bulky field saved by ResultWriter.slim back from its text file; other values are returned as they are.
+    """
+    if isinstance(value, str) and os.path.isfile(value):
+        return read_text_file(value)
+    return value
 
-        # Git Commit Messages
-        gitm = glob(os.path.join(dirn,'**','.git','logs','HEAD'))
-        if len(gitm) == 0:
-            GitM = -1
-        else:
-            GitM = extract_commit_info(gitm[0])
-            GitM = '\n'.join(GitM)
-
-        # Code
-        pypath = find_files_with_suffix('walking_panda.py', dirn)[0] if len(find_files_with_suffix('walking_panda.py', dirn)) != 0 else -1
-        CODE = ' '.join(['\n# Path:' + path + '\n' + read_text_file(path) for path in find_files_with_suffix('.py', dirn) if 'venv' not in path])
-        ARGUCount = CODE.count('parser.add_argument')
-
-        # Directory Structure
-        dirstru = get_directory_structure(dirn)
-        VENV = -1 if len(find_files_with_suffix('venv/*', dirn)) > 0 else 0
-
-        assinfo = {'Name':studinfo['Name'],\
-                  'ID':studinfo['ID'],\
-                  'Email':studinfo['Email'],\
-                  'Tutor':studinfo['Tutor'],\
-                   'PythonPath':pypath,\
-                   'LICENSE':LICENSEmd,\
-                  'README':READMEmd,\
-                  'REPORT':REPORTmd,\
-                   'REPORTWORDCount':REPORTCount,\
-                  'REQUIREMENTS':REQS,\
-                  'InREQ':REQ,\
-                   'InDoc':InDoc,\
-                  'GitM':GitM,\
-                   'CODE':CODE,\
-                   'ARGUCount':ARGUCount,\
-                  'VENV':VENV,\
-                  'DSD':dirstru}
-
-        ### Step 2: Marking
-
-        # ChatGPT markers
-        GitMmark = GitMMarker(assinfo) if GitM != -1 else [0,0,0,0]
-        CODEmark = CODEMarker(assinfo) if (READMEmd != -1) and (CODE != -1) else [0,0]
-        REPORTmark = REPORTMarker(assinfo) if (REPORTmd != -1) else [0,0,0]
-        PANDAmark = PANDAMarker(assinfo) if (CODE != -1) else [0,0]
-
-        marking['1.1 completed "Running Some Code" section i.e hello_world.py'] = 1
-        marking['1.2 completed "Add README.md and LICENSE.md" section'] = 1 if (READMEmd != -1) and (LICENSEmd != -1) else 0
-        marking['1.3 completed "Adding a Dependency" section i.e. added panda3D to requirements.txt'] = 1 if REQ == 1 else 0
-        marking['1.4 [C]completed 3 panda related sections i.e. visual/window, scenery and panda (3 marks)'] = PANDAmark[0]
-        marking['1.5 [C]Git: At least 4 commits i.e. hello_world, README/LICENCE, add some scenery, add a panda'] = GitMmark[0]
-        marking['1.6 [C]Provided meaningful commit messages (about part 1 only)'] = GitMmark[1]
-
-        marking['2.1 Report as a markdown file, found in doc directory'] = InDoc
-        marking['2.2 [C]Good use of markdown e.g. headings'] = int(REPORTmark[0]) if (REPORTmd != -1) else 0
-        marking['2.3 [C]Describe whether you have used any of the tools or equivalent tools in the past'] = REPORTmark[1]
-        marking['2.4 [C]Describe how you think the tools new to you will change your development practice'] = REPORTmark[2]
-        marking['2.5 Report should be between 300-500 words (+10% allowed)'] = 1 if REPORTCount > 250 else 0
-        marking['2.6 [C]Git: committed and provided meaningful commit messages (about part 2 only)'] = GitMmark[2]
-
-        marking['3.1 [C]Updated README.md'] = CODEmark[0]
-        marking['3.2 [C]Included comments in code (e.g. referenced external code)'] = CODEmark[1]
-        if ARGUCount > 4:
-            marking['3.3 a) Argument Implementation (2 marks, 0.5 per option)'] = 2
-        elif ARGUCount < 0:
-            marking['3.3 a) Argument Implementation (2 marks, 0.5 per option)'] = 0
-        else:
-            marking['3.3 a) Argument Implementation (2 marks, 0.5 per option)'] = ARGUCount / 2
-        marking['3.4 [C]A Multi-Media experience (1 mark)'] = PANDAmark[1]
-        marking['3.5 [C]Git: committed and provided meaningful commit messages (about part 3 only)'] = GitMmark[3]
+def scan_folder(dirn):
+    """
+    Checks a submission folder without marking it: compressed submissions are read in place, nothing is extracted.
 
-        marking['4 DO NOT SUBMIT INCORRECT FILES (e.g. venv)'] = VENV
+    Parameters:
+        dirn (str): The directory path containing the student submission.
 
-        ### Step 3: Generate reports and update
+    Returns:
+        dict: 'Folder', 'ID', 'Name', 'Archive', 'Files', 'Report' (a markdown file in doc), 'Git', 'Venv' and
+        'Problem', which is empty when the folder can be marked.
+    """
+    row = {'Folder': os.path.basename(os.path.normpath(dirn)), 'ID': '', 'Name': '', 'Archive': '', 'Files': 0,
+           'Report': 0, 'Git': 0, 'Venv': 0, 'Problem': ''}
+    index = SubmissionIndex(dirn)
+    if index.file_count < 5:
+        all_fns = [os.path.join(dirn, name) for name, is_dir in index.children.get(dirn, [])]
+        non_txt_fns = [f for f in all_fns if not f.endswith('.txt')]
+        if len(non_txt_fns) == 0:
+            row['Problem'] = 'nothing to mark'
+        elif non_txt_fns[0].endswith(ARCHIVE_SUFFIXES):
+            row['Archive'] = os.path.basename(non_txt_fns[0])
+            try:
+                index = SubmissionIndex(dirn, SubmissionFS(dirn, [non_txt_fns[0]]))
+            except Exception as e:
+                row['Problem'] = 'cannot open {}: {}'.format(row['Archive'], e)
+                return row
+    fs = index.fs
+    row['Files'] = index.file_count
+    row['Report'] = int(len(index.find('doc/*.md')) != 0)
+    row['Git'] = int(len(index.git_dirs) != 0)
+    row['Venv'] = len(index.venvs)
+    if len(index.find('StudInfo.txt')) == 0:
+        row['Problem'] = row['Problem'] or 'no StudInfo.txt'
+    else:
+        try:
+            studinfo = parse_student_info(index.find('StudInfo.txt')[0], fs)
+            row['ID'], row['Name'] = studinfo['ID'] or '', studinfo['Name'] or ''
+            if studinfo['ID'] is None:
+                row['Problem'] = row['Problem'] or 'no student ID in StudInfo.txt'
+        except (IndexError, OSError):
+            row['Problem'] = row['Problem'] or 'unreadable StudInfo.txt'
+    fs.close()
+    return row
+
+def run_scan(args):
+    """
+    The scan command: lists the folders of root_dir in scan.csv and prints those that cannot be marked.
+    """
+    dirns = [dirn for dirn in sorted(glob(os.path.join(root_dir, '*'))) if os.path.isdir(dirn)]
+    rows = [scan_folder(dirn) for dirn in dirns]
+    path = os.path.join(output_dir, 'scan.csv')
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        table = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else ['Folder'])
+        table.writeheader()
+        table.writerows(rows)
+    for row in rows:
+        if row['Problem'] != '':
+            print('{}: {}'.format(row['Folder'], row['Problem']))
+    print('Scanned {} folders ({} compressed, {} with a git repository, {} with a virtual environment, {} with problems) to {}'.format(
+        len(rows), sum(1 for row in rows if row['Archive']), sum(row['Git'] for row in rows),
+        sum(1 for row in rows if row['Venv']), sum(1 for row in rows if row['Problem']), path))
+
+def open_engine(args):
+    """
+    Sets up the LLM backends, the grading engine and the response cache of the commands that mark.
 
-        marking['All_marks'] = generate_markdown_report_string(marking, full_marking, studinfo, assinfo, dirn)
+    Returns:
+        tuple: (engine, cache, backends), cache is None with --no_cache and backends is None with --batch.
+    """
+    api_key = None
+    if uses_api(args):
+        api_key = args.apikey if args.apikey != None else read_text_file(os.path.join(prompts_dir, 'APIkey.txt'))
+
+    retry_policy = RetryPolicy(max_attempts=args.max_attempts, base_delay=args.backoff_base, max_delay=args.backoff_max)
+    backends = None
+    if args.batch:
+        import openai
+        client = openai.OpenAI(api_key=api_key, base_url=args.base_url)
+        engine = BatchEngine(client, os.path.join(output_dir, 'batch'), poll_interval=args.batch_poll,
+                             retry_policy=retry_policy, resume=args.batch_resume)
+        if len(args.backend) != 0:
+            print('Warning: --backend is not supported with --batch; every request goes to the Batch API')
+    else:
+        engine = GradingEngine(concurrency=args.concurrency, rpm=args.rpm, tpm=args.tpm, retry_policy=retry_policy)
+        # One pooled connection per call in flight
+        backends = create_backends(args.backend, api_key, args.base_url, timeout=args.timeout, connections=args.concurrency,
+                                   mock_latency=args.mock_latency, mock_script=args.mock_script)
+
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_dir, max_age_days=args.cache_max_age, max_size_mb=args.cache_max_size)
+        if args.clear_cache:
+            cache.clear()
+        cache.evict()
+    if args.combined and args.batch:
+        print('Warning: --combined is not supported with --batch; sending one request per marker')
+    return engine, cache, backends
+
+def marking_options(args, engine, cache, backends):
+    """
+    Returns the keyword arguments of `marking` given by the command line.
+    """
+    return dict(engine=engine, cache=cache, extract=args.extract, workers=args.workers, token_budgets=dict(args.token_budget),
+                combined=args.combined and not args.batch, duplicate_threshold=args.duplicate_threshold, reports=args.reports,
+                rules=not args.no_rules, analysis_dir=args.analysis_dir if not args.no_cache else None, backends=backends)
 
-        assinfo.update(marking)
-        mdreport = MarkdownReport.format(**assinfo)
-        save_txt_file(mdreport, os.path.join(markdown_dir, '{}.md'.format(studinfo['ID'])))
+def open_queue(args):
+    return WorkQueue(args.queue if args.queue is not None else os.path.join(output_dir, 'queue.sqlite'), lease_seconds=args.lease)
 
-        markdowns.append(mdreport)
-        assinfos.append(assinfo)
-    
-    asstable = pd.DataFrame(assinfos)
-    markdownsall = '  \n'.join(markdowns)
-    
-    return asstable, markdownsall
+def run_grade(args):
+    """
+    The grade and merge commands: mark the cohort in this process, or collect the results of the workers, into
+    marks.csv, all.md, the store and the marking table.
+    """
+    from exporter import export_marks
+
+    engine = cache = None
+    store = ResultStore(store_path(args))
+    store.begin_run({key: value for key, value in vars(args).items() if key != 'apikey'})
+    writer = ResultWriter(output_dir, fsync_every=args.fsync_every, store=store, reports=ReportStream(output_dir, args.split))
+    if args.command == 'merge':
+        queue = open_queue(args)
+        counts = queue.counts()
+        if counts['pending'] + counts['leased'] != 0:
+            print('Warning: {} folders are still pending and {} are being marked'.format(counts['pending'], counts['leased']))
+        print('Merged {} students from {}'.format(merge_queue(queue, writer, args.duplicate_threshold), queue.path))
+        store.record_calls(queue.calls())
+        queue.close()
+    else:
+        engine, cache, backends = open_engine(args)
+        manifest = RunManifest(output_dir, incremental=args.incremental)
+        marking(sorted(glob(os.path.join(root_dir, '*'))), manifest=manifest, writer=writer, **marking_options(args, engine, cache, backends))
+        store.record_calls(PROFILE.requests)
+    writer.close()
+    store.finish_run()
+
+    if os.path.exists(marking_table):
+        with PROFILE.stage('export'):
+            changed = export_marks(marking_table, store.rows(store.run_id))
+        print('Updated {} students in {}'.format(changed, marking_table))
+    store.close()
+    return engine, cache, output_dir
+
+def run_queue(args):
+    """
+    The enqueue and worker commands: fill the work queue, or mark the folders claimed from it.
+    """
+    queue = open_queue(args)
+    engine = cache = None
+    profile_dir = output_dir
+    if args.command == 'enqueue':
+        print('Queued {} new folders in {}'.format(queue.enqueue(sorted(glob(os.path.join(root_dir, '*')))), queue.path))
+    else:
+        # Several workers share the queue; each one marks the folders it claims and leaves the output files to `merge`
+        engine, cache, backends = open_engine(args)
+        worker = worker_name()
+        print('Worker {} marked {} folders'.format(worker, work(queue, worker, args.claim_size, **marking_options(args, engine, cache, backends))))
+        profile_dir = os.path.join(output_dir, 'workers', worker.replace(':', '_'))
+        os.makedirs(profile_dir, exist_ok=True)
+    queue.close()
+    return engine, cache, profile_dir
+
+def run_watch(args):
+    """
+    The watch command: marks the folders of root_dir, then marks each one again whenever it changes, keeping
+    marks.csv, all.md, the store and the marking table up to date.
+    """
+    engine, cache, backends = open_engine(args)
+    store = ResultStore(store_path(args))
+    writer = WatchWriter(output_dir, store, marking_table if os.path.exists(marking_table) else None, args.split,
+                         {key: value for key, value in vars(args).items() if key != 'apikey'})
+    # Folders unchanged since the last run keep their marks, so that restarting the watch costs no API calls
+    manifest = RunManifest(output_dir, incremental=True)
+    watcher = FolderWatcher(root_dir, args.debounce, args.poll_interval, args.poll)
+    print('Watching {} (Ctrl+C to stop)'.format(root_dir))
+    watch(watcher, writer, args.backlog, manifest=manifest, **marking_options(args, engine, cache, backends))
+    watcher.close()
+    writer.close()     # Also stores the ChatGPT calls not stored yet
+    store.finish_run()
+    store.close()
+    return engine, cache, output_dir
+
+def run_report(args):
+    """
+    The report command: renders all.md, or the reports of some students, from the results store.
+    """
+    from reports import write_reports
+
+    store = ResultStore(store_path(args))
+    rows = store.rows(args.run)
+    store.close()
+    for path in write_reports(rows, prompts_dir, output_dir, markdown_dir, args.split, args.compact, args.student):
+        print('Wrote {}'.format(path))
+
+def run_export(args):
+    """
+    The export command: fills the marking table from the results store, without marking anything.
+    """
+    from exporter import export_marks
+
+    store = ResultStore(store_path(args))
+    changed = export_marks(marking_table, store.rows(args.run))
+    store.close()
+    print('Updated {} students in {}'.format(changed, marking_table))
+
+# Function running each command; the commands that mark return (engine, cache, profile directory) to wrap up the run
+COMMAND_FUNCTIONS = {'scan': run_scan, 'grade': run_grade, 'merge': run_grade, 'enqueue': run_queue, 'worker': run_queue,
+                     'watch': run_watch, 'report': run_report, 'export': run_export}
 
 if __name__ == '__main__':
 
-    parser = create_parser()
-    args = parser.parse_args()
+    args = parse_args()
     check(args)
     
     root_dir = args.root_dir
     markdown_dir = args.markdown_dir
     prompts_dir = args.prompts_dir
     output_dir = args.output_dir
-    openai.api_key = args.apikey if args.apikey != None else read_text_file(os.path.join(prompts_dir, 'APIkey.txt'))
-    marking_table = args.marking_table
-    
-    dirns = sorted(glob(os.path.join(root_dir, '*')))
-    asstable, markdownsall = marking(dirns)
-    asstable.to_csv(os.path.join(output_dir, 'marks.csv'))
-    save_txt_file(markdownsall, os.path.join(output_dir, 'all.md'))
-
-    if os.path.exists(marking_table):
-        marks = pd.read_csv(os.path.join(output_dir, 'marks.csv'), index_col = 0)
-        workbook = load_workbook(filename=marking_table)
-        markingsheet = workbook['Marking']
-        cols = []
-        for cell in markingsheet[1]:
-            if cell.value == 'Number:':
-                current_col = get_column_letter(cell.column)
-                next_col = get_column_letter(column_index_from_string(current_col) + 1)
-                cols.append(current_col)
-
-        for i in range(len(marks)):
-            next_col = get_column_letter(column_index_from_string(cols[i]) + 1)
-            markingsheet[next_col + str(1)] = marks.iloc[i,1]
-            markingsheet[next_col + str(2)] = marks.iloc[i,0]
-            
-            for j in range(6):
-                markingsheet[cols[i] + str(5+j)] = marks.iloc[i,17+j]
-                
-            for j in range(6):
-                markingsheet[cols[i] + str(13+j)] = marks.iloc[i,23+j]
-                
-            for j in range(5):
-                markingsheet[cols[i] + str(21+j)] = marks.iloc[i,29+j]
-                
-            markingsheet[cols[i] + str(27)] = marks.iloc[i,34]
-
-        workbook.save(marking_table)
-
+    marking_table = getattr(args, 'marking_table', None)
+    profiler = start_cprofile() if getattr(args, 'cprofile', None) is not None else None
+
+    result = COMMAND_FUNCTIONS[args.command](args)
+    if result is not None:
+        engine, cache, profile_dir = result
+        if engine is not None:
+            engine.shutdown()
+        if cache is not None:
+            print(cache.summary())
+            PROFILE.count(cache_hits=cache.hits, cache_misses=cache.misses)
+        print(PROFILE.summary(PROFILE.write(profile_dir)))
+    if profiler is not None:
+        stop_cprofile(profiler, args.cprofile)
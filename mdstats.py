@@ -0,0 +1,125 @@
+import re
+
+FENCE_RE = re.compile(r'^\s{0,3}(`{3,}|~{3,})')
+HEADING_RE = re.compile(r'^\s{0,3}(#{1,6})(?:\s+|$)(.*?)(?:\s+#+\s*)?$')
+SETEXT_RE = re.compile(r'^\s{0,3}(=+|-+)\s*$')
+RULE_RE = re.compile(r'^\s{0,3}([-*_])(\s*\1){2,}\s*$')
+LIST_RE = re.compile(r'^(\s*)([-*+]|\d+[.)])\s+')
+QUOTE_RE = re.compile(r'^\s{0,3}>\s?')
+REFERENCE_RE = re.compile(r'^\s{0,3}\[[^\]]+\]:\s*\S+')
+IMAGE_RE = re.compile(r'!\[([^\]]*)\]\s*(\([^)]*\)|\[[^\]]*\])')
+LINK_RE = re.compile(r'\[([^\]]*)\]\s*(\([^)]*\)|\[[^\]]*\])')
+AUTOLINK_RE = re.compile(r'<((?:https?|ftp)://[^>\s]+|[^>\s@]+@[^>\s@]+)>')
+TAG_RE = re.compile(r'</?[A-Za-z][^>]*>')
+INLINE_CODE_RE = re.compile(r'`+')
+EMPHASIS_RE = re.compile(r'(\*+|(?<!\w)_+|_+(?!\w))')
+
+def analyze_markdown(text):
+    """
+    Analyses a markdown document in one pass over its lines, without rendering it to HTML.
+
+    The word count follows what a reader sees: markup, link targets and images are left out, while link texts,
+    code and raw text are counted, which matches counting the words of the rendered HTML.
+
+    Parameters:
+        text (str): The markdown document.
+
+    Returns:
+        dict: 'words', 'headings', 'heading_levels' (distinct levels used), 'lists' (list items), 'links',
+        'images', 'code_blocks', 'inline_code', 'emphasis' and 'quotes'.
+    """
+    stats = {'words': 0, 'headings': 0, 'heading_levels': 0, 'lists': 0, 'links': 0, 'images': 0,
+             'code_blocks': 0, 'inline_code': 0, 'emphasis': 0, 'quotes': 0}
+    levels = set()
+    fence = None        # Marker of the fenced code block we are in
+    previous = ''       # Previous line, for setext headings and indented code
+    in_list = False
+    indented = False    # Whether we are in an indented code block
+    for line in text.splitlines():
+        if fence is not None:
+            if line.strip().startswith(fence):
+                fence = None
+            else:
+                stats['words'] += len(line.split())
+            previous = line
+            continue
+        match = FENCE_RE.match(line)
+        if match:
+            fence = match.group(1)[0] * len(match.group(1))
+            stats['code_blocks'] += 1
+            previous = line
+            continue
+        if line.strip() == '':
+            previous = line
+            continue
+        if (line.startswith('    ') or line.startswith('\t')) and (indented or previous.strip() == '') and not in_list:
+            if not indented:
+                stats['code_blocks'] += 1
+                indented = True
+            stats['words'] += len(line.split())
+            previous = line
+            continue
+        indented = False
+
+        if QUOTE_RE.match(line):
+            stats['quotes'] += 1
+            line = QUOTE_RE.sub('', line, count=1)
+        match = HEADING_RE.match(line)
+        if match:
+            stats['headings'] += 1
+            levels.add(len(match.group(1)))
+            line = match.group(2)
+        elif SETEXT_RE.match(line) and previous.strip() != '' and not LIST_RE.match(previous):
+            stats['headings'] += 1
+            levels.add(1 if line.strip()[0] == '=' else 2)
+            previous = line
+            continue
+        elif RULE_RE.match(line) or REFERENCE_RE.match(line):
+            previous = line
+            continue
+        else:
+            match = LIST_RE.match(line)
+            if match:
+                stats['lists'] += 1
+                in_list = True
+                line = line[match.end():]
+            elif not line.startswith((' ', '\t')):
+                in_list = False
+
+        stats['words'] += count_inline(line, stats)
+        previous = line
+    stats['heading_levels'] = len(levels)
+    return stats
+
+def count_inline(line, stats):
+    """
+    Strips the inline markup of a line, updating the link, image, code and emphasis counts, and returns its words.
+    """
+    line, images = IMAGE_RE.subn(' ', line)
+    stats['images'] += images
+    line, links = LINK_RE.subn(r'\1', line)
+    line, autolinks = AUTOLINK_RE.subn(r'\1', line)
+    stats['links'] += links + autolinks
+    stats['inline_code'] += len(INLINE_CODE_RE.findall(line)) // 2
+    line = INLINE_CODE_RE.sub('', TAG_RE.sub('', line))
+    line, emphasis = EMPHASIS_RE.subn('', line)
+    stats['emphasis'] += emphasis // 2
+    return len(line.split())
+
+def markdown_precheck(stats):
+    """
+    Decides '2.2 Good use of markdown' from the structure of a report when the answer is clear-cut.
+
+    Parameters:
+        stats (dict): The result of `analyze_markdown`.
+
+    Returns:
+        int: 1 for a report with at least two headings and another kind of markup, 0 for a report without any
+        markup, or None when ChatGPT should judge it.
+    """
+    others = stats['lists'] + stats['links'] + stats['images'] + stats['code_blocks'] + stats['emphasis']
+    if stats['headings'] >= 2 and others > 0:
+        return 1
+    if stats['headings'] == 0 and others == 0 and stats['inline_code'] == 0 and stats['quotes'] == 0:
+        return 0
+    return None
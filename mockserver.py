@@ -0,0 +1,201 @@
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from backends import example_reply
+
+# Reply without any scores, which GPTMarker rejects as invalid
+MALFORMED_REPLY = 'The submission looks good overall, well done.'
+
+class MockOpenAI:
+    def __init__(self, responder=example_reply, latency=0.0, error_rate=0.0, malformed_rate=0.0, seed=None):
+        """
+        In-memory state of a local stand-in for the OpenAI chat completion, files and batch endpoints.
+
+        Args:
+            responder (callable): Function mapping the chat messages of a request to the reply text.
+            latency (float): Mean delay in seconds of a chat completion; each request waits 0.5-1.5 times it.
+            error_rate (float): Fraction of chat completions answered with a 429 or 500 error.
+            malformed_rate (float): Fraction of chat completions whose reply holds no scores.
+            seed (int): Seed of the random faults, for reproducible runs.
+        """
+        self.responder = responder
+        self.latency = latency
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.random = random.Random(seed)
+        self.files = {}      # File id -> (metadata, content bytes)
+        self.batches = {}    # Batch id -> batch object
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.malformed = 0
+
+    def _roll(self):
+        with self.lock:
+            return self.random.random()
+
+    def fault(self):
+        """
+        Decides whether a chat completion fails.
+
+        Returns:
+            tuple: (HTTP status, error body, extra headers) of the injected error, or None.
+        """
+        if self.error_rate <= 0 or self._roll() >= self.error_rate:
+            return None
+        with self.lock:
+            self.requests += 1
+            self.errors += 1
+        if self._roll() < 0.5:
+            return 429, {'error': {'message': 'Rate limit reached (mock)', 'type': 'requests', 'code': 'rate_limit_exceeded'}}, {'retry-after-ms': '50'}
+        return 500, {'error': {'message': 'The server had an error (mock)', 'type': 'server_error', 'code': None}}, {}
+
+    def chat_completion(self, body):
+        if self.latency > 0:
+            time.sleep(self.latency * (0.5 + self._roll()))
+        with self.lock:
+            self.requests += 1
+        content = self.responder(body['messages'])
+        if self.malformed_rate > 0 and self._roll() < self.malformed_rate:
+            content = MALFORMED_REPLY
+            with self.lock:
+                self.malformed += 1
+        prompt_tokens = sum(len(message['content']) for message in body['messages']) // 4
+        return {'id': 'chatcmpl-' + uuid.uuid4().hex, 'object': 'chat.completion', 'created': int(time.time()),
+                'model': body.get('model', 'mock'),
+                'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': 4, 'total_tokens': prompt_tokens + 4}}
+
+    def add_file(self, filename, purpose, content):
+        file_id = 'file-' + uuid.uuid4().hex
+        metadata = {'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': int(time.time()),
+                    'filename': filename, 'purpose': purpose, 'status': 'processed'}
+        with self.lock:
+            self.files[file_id] = (metadata, content)
+        return metadata
+
+    def create_batch(self, body):
+        batch_id = 'batch_' + uuid.uuid4().hex
+        batch = {'id': batch_id, 'object': 'batch', 'endpoint': body['endpoint'], 'input_file_id': body['input_file_id'],
+                 'completion_window': body['completion_window'], 'status': 'validating', 'created_at': int(time.time()),
+                 'output_file_id': None, 'error_file_id': None, 'request_counts': {'total': 0, 'completed': 0, 'failed': 0}}
+        with self.lock:
+            self.batches[batch_id] = batch
+        threading.Thread(target=self.run_batch, args=(batch_id,), daemon=True).start()
+        return batch
+
+    def run_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        batch['status'] = 'in_progress'
+        lines = self.files[batch['input_file_id']][1].decode('utf-8').splitlines()
+        outputs = []
+        for line in lines:
+            if line.strip() == '':
+                continue
+            request = json.loads(line)
+            body = self.chat_completion(request['body'])
+            outputs.append({'id': 'batch_req_' + uuid.uuid4().hex, 'custom_id': request['custom_id'], 'error': None,
+                            'response': {'status_code': 200, 'request_id': uuid.uuid4().hex, 'body': body}})
+        content = ''.join(json.dumps(output) + '\n' for output in outputs).encode('utf-8')
+        batch['output_file_id'] = self.add_file('batch_output.jsonl', 'batch_output', content)['id']
+        batch['request_counts'] = {'total': len(outputs), 'completed': len(outputs), 'failed': 0}
+        batch['completed_at'] = int(time.time())
+        batch['status'] = 'completed'
+
+class MockHandler(BaseHTTPRequestHandler):
+    state = None  # MockOpenAI shared by all requests, set by `serve`
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path.endswith('/chat/completions'):
+            body = json.loads(self._body())
+            fault = self.state.fault()
+            if fault is not None:
+                status, payload, headers = fault
+                self._send_json(payload, status, headers)
+            else:
+                self._send_json(self.state.chat_completion(body))
+        elif path.endswith('/files'):
+            # Multipart upload: parse it as a MIME message
+            raw = b'Content-Type: ' + self.headers['Content-Type'].encode('utf-8') + b'\r\n\r\n' + self._body()
+            fields = {}
+            for part in BytesParser().parsebytes(raw).get_payload():
+                fields[part.get_param('name', header='content-disposition')] = (part.get_filename(), part.get_payload(decode=True))
+            filename, content = fields['file']
+            self._send_json(self.state.add_file(filename or 'upload.jsonl', fields['purpose'][1].decode('utf-8'), content))
+        elif path.endswith('/batches'):
+            self._send_json(self.state.create_batch(json.loads(self._body())))
+        else:
+            self._send_json({'error': {'message': 'Unknown endpoint ' + path}}, 404)
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        parts = path.split('/')
+        if len(parts) >= 2 and parts[-1] == 'content' and parts[-2] in self.state.files:
+            content = self.state.files[parts[-2]][1]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        elif parts[-1] in self.state.batches:
+            self._send_json(self.state.batches[parts[-1]])
+        elif parts[-1] in self.state.files:
+            self._send_json(self.state.files[parts[-1]][0])
+        else:
+            self._send_json({'error': {'message': 'Unknown endpoint ' + path}}, 404)
+
+def serve(host='127.0.0.1', port=0, state=None):
+    """
+    Starts the stand-in server in a background thread.
+
+    Parameters:
+        host (str): The address to listen on.
+        port (int): The port to listen on, 0 for any free port.
+        state (MockOpenAI): The server state (default: a new MockOpenAI with example replies).
+
+    Returns:
+        tuple: (the server, its base URL to pass as --base_url).
+    """
+    handler = type('Handler', (MockHandler,), {'state': state if state is not None else MockOpenAI()})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://{}:{}/v1/'.format(host, server.server_address[1])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI chat completion and batch endpoints.")
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on (default: 8765)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Mean delay in seconds of a chat completion (default: 0)')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of chat completions failing with 429/500 (default: 0)')
+    parser.add_argument('--malformed_rate', type=float, default=0.0, help='Fraction of replies holding no scores (default: 0)')
+    args = parser.parse_args()
+    server, base_url = serve(args.host, args.port, MockOpenAI(latency=args.latency, error_rate=args.error_rate,
+                                                              malformed_rate=args.malformed_rate))
+    print(f"Mock OpenAI server listening on {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
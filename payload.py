@@ -0,0 +1,144 @@
+import re
+import hashlib
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding('o200k_base')
+except Exception:  # tiktoken is optional, fall back to a regex approximation
+    _encoding = None
+
+# Without tiktoken a token is approximated by up to four word characters or one punctuation character
+TOKEN_RE = re.compile(r'\w{1,4}|[^\w\s]')
+PANDA_IMPORT_RE = re.compile(r'^\s*(?:from|import)\s+(?:panda3d|direct)\b', re.MULTILINE)
+# A line made only of numbers, quotes, brackets and separators, e.g. a row of a vertex table or a byte array
+DATA_LINE_RE = re.compile(r'^[\s\[\](){},:;0-9.eExXa-fA-F+\-\'"]*$')
+MAX_LINE_LENGTH = 400
+MAX_DATA_LINES = 20
+NOTE_TOKENS = 16  # Room kept for the truncation note
+
+def count_tokens(text):
+    """
+    Counts the tokens of a text with tiktoken if it is installed, otherwise approximately.
+
+    Parameters:
+        text (str): The text to count.
+
+    Returns:
+        int: The number of tokens.
+    """
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return sum(1 for _ in TOKEN_RE.finditer(text))
+
+def truncate_to_tokens(text, budget):
+    """
+    Cuts a text down to at most `budget` tokens.
+
+    Parameters:
+        text (str): The text to cut.
+        budget (int): The maximum number of tokens.
+
+    Returns:
+        str: The text itself if it fits, otherwise its first `budget` tokens followed by a truncation note.
+    """
+    if _encoding is not None:
+        tokens = _encoding.encode(text, disallowed_special=())
+        if len(tokens) <= budget:
+            return text
+        return _encoding.decode(tokens[:budget]) + '\n# ... truncated to {} tokens'.format(budget)
+    for count, match in enumerate(TOKEN_RE.finditer(text)):
+        if count == budget:
+            return text[:match.start()] + '\n# ... truncated to {} tokens'.format(budget)
+    return text
+
+def strip_data_literals(code):
+    """
+    Replaces large data literals in Python source with a short note: lines longer than MAX_LINE_LENGTH
+    characters and runs of more than MAX_DATA_LINES lines that only hold numbers, strings and brackets.
+
+    Parameters:
+        code (str): The Python source.
+
+    Returns:
+        str: The source with the data removed.
+    """
+    lines = code.split('\n')
+    result = []
+    run = []
+
+    def flush():
+        if len(run) > MAX_DATA_LINES:
+            result.extend(run[:2])
+            result.append('# ... {} lines of data removed'.format(len(run) - 2))
+        else:
+            result.extend(run)
+        run.clear()
+
+    for line in lines:
+        if line.strip() != '' and DATA_LINE_RE.match(line):
+            run.append(line)
+            continue
+        flush()
+        if len(line) > MAX_LINE_LENGTH:
+            line = line[:80] + '  # ... {} characters of data removed'.format(len(line) - 80)
+        result.append(line)
+    flush()
+    return '\n'.join(result)
+
+def rank_code_file(path, text):
+    """
+    Sort key putting walking_panda.py first, then the files that import panda3d, then the smallest files.
+    """
+    name = path.replace('\\', '/').rsplit('/', 1)[-1]
+    return (name != 'walking_panda.py', PANDA_IMPORT_RE.search(text) is None, len(text), path)
+
+def build_code_payload(files, budget):
+    """
+    Builds the CODE text sent to ChatGPT from the Python files of a submission.
+
+    Identical files are sent once, large data literals are removed, files are ranked by relevance and the
+    payload is cut off once it reaches the token budget.
+
+    Parameters:
+        files (list): (path, source) pairs of the Python files.
+        budget (int): The maximum number of tokens of the payload, None for no limit.
+
+    Returns:
+        tuple: (payload text, number of tokens of the payload).
+    """
+    seen = {}
+    unique = []
+    for path, text in files:
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        if digest in seen:
+            seen[digest].append(path)
+            continue
+        seen[digest] = []
+        unique.append((path, text, seen[digest]))
+    unique.sort(key=lambda item: rank_code_file(item[0], item[1]))
+
+    parts = []
+    tokens = 0
+    omitted = []
+    for k, (path, text, copies) in enumerate(unique):
+        header = '\n# Path:' + path + ''.join('\n# Identical copy: ' + copy for copy in copies)
+        part = header + '\n' + strip_data_literals(text)
+        part_tokens = count_tokens(part)
+        if budget is None or tokens + part_tokens <= budget:
+            parts.append(part)
+            tokens += part_tokens
+            continue
+        # The budget is spent: keep the head of this file if there is room, and list the rest without content
+        if len(parts) == 0 or budget - tokens > 200:
+            part = truncate_to_tokens(part, max(0, budget - tokens - NOTE_TOKENS))
+            parts.append(part)
+            tokens += count_tokens(part)
+            k += 1
+        omitted = [path for path, _, _ in unique[k:]]
+        break
+    payload = ' '.join(parts)
+    if len(omitted) != 0:
+        note = '\n# Not included (token budget reached): ' + ', '.join(omitted)
+        payload += note
+        tokens += count_tokens(note)
+    return payload, tokens
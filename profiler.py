@@ -0,0 +1,176 @@
+import os
+import io
+import csv
+import json
+import math
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+def percentile(values, fraction):
+    """
+    Returns the value below which `fraction` of the sorted values fall (nearest rank), or 0 for no values.
+    """
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+class RunProfile:
+    def __init__(self):
+        """
+        Collects the timings and counters of a run: the duration of every stage per student, the latency and
+        tokens of every ChatGPT request, and free-form counters such as the bytes read.
+
+        Recording is cheap and thread-safe. Worker processes record into their own profile and hand it to the
+        parent with `take`, which merges it with `merge`.
+        """
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets everything recorded so far and restarts the wall clock.
+        """
+        self.started = time.time()
+        self.stages = {}     # Stage -> list of durations
+        self.students = {}   # Student folder -> {stage: seconds}
+        self.requests = []   # (marker, seconds, prompt tokens, completion tokens, ok)
+        self.counters = {}
+        self.markers = {}    # Marker name -> GPTMarker.stats
+        self.rules = {}      # Rule label -> RuleEngine.stats
+
+    def record(self, name, seconds, student=None):
+        with self.lock:
+            self.stages.setdefault(name, []).append(seconds)
+            if student is not None:
+                timings = self.students.setdefault(student, {})
+                timings[name] = timings.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name, student=None):
+        """
+        Times the enclosed block as one run of stage `name`, attributed to `student` if given.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, student)
+
+    def request(self, marker, seconds, prompt_tokens=0, completion_tokens=0, ok=True):
+        with self.lock:
+            self.requests.append((marker, seconds, prompt_tokens, completion_tokens, ok))
+
+    def count(self, **increments):
+        with self.lock:
+            for key, value in increments.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def take(self):
+        """
+        Returns the data recorded so far and clears it; used by worker processes.
+        """
+        with self.lock:
+            data = {'stages': self.stages, 'students': self.students, 'requests': self.requests, 'counters': self.counters}
+            self.stages, self.students, self.requests, self.counters = {}, {}, [], {}
+        return data
+
+    def merge(self, data):
+        with self.lock:
+            for name, durations in data['stages'].items():
+                self.stages.setdefault(name, []).extend(durations)
+            for student, timings in data['students'].items():
+                own = self.students.setdefault(student, {})
+                for name, seconds in timings.items():
+                    own[name] = own.get(name, 0.0) + seconds
+            self.requests.extend(data['requests'])
+            for key, value in data['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def latency(self, marker=None):
+        """
+        Returns the count and the p50/p90/p99/max latency in seconds of the requests of a marker (default: all).
+        """
+        seconds = [request[1] for request in self.requests if marker is None or request[0] == marker]
+        return {'requests': len(seconds), 'p50': percentile(seconds, 0.5), 'p90': percentile(seconds, 0.9),
+                'p99': percentile(seconds, 0.99), 'max': max(seconds) if seconds else 0.0}
+
+    def report(self):
+        """
+        Returns the profile as a JSON-serialisable dict.
+        """
+        with self.lock:
+            stages = {name: {'count': len(durations), 'total': sum(durations), 'mean': sum(durations) / len(durations),
+                             'p90': percentile(durations, 0.9), 'max': max(durations)}
+                      for name, durations in self.stages.items()}
+            names = sorted(set(request[0] for request in self.requests))
+            return {'started': self.started, 'wall_time': time.time() - self.started, 'stages': stages,
+                    'api': {'all': self.latency(),
+                            'markers': {name: self.latency(name) for name in names},
+                            'failed_requests': sum(1 for request in self.requests if not request[4]),
+                            'prompt_tokens': sum(request[2] for request in self.requests),
+                            'completion_tokens': sum(request[3] for request in self.requests)},
+                    'markers': self.markers, 'rules': self.rules, 'counters': self.counters, 'students': self.students}
+
+    def write(self, output_dir):
+        """
+        Writes profile.json (the whole profile) and profile.csv (one row of stage durations per student).
+
+        Returns:
+            dict: The profile written to profile.json.
+        """
+        report = self.report()
+        with open(os.path.join(output_dir, 'profile.json'), 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=1)
+        stages = sorted(set(name for timings in report['students'].values() for name in timings))
+        with open(os.path.join(output_dir, 'profile.csv'), 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['student'] + stages)
+            for student, timings in report['students'].items():
+                writer.writerow([student] + ['{:.4f}'.format(timings[name]) if name in timings else '' for name in stages])
+        return report
+
+    def summary(self, report=None):
+        """
+        Returns a table of the stage durations, API latencies and counters.
+        """
+        report = report if report is not None else self.report()
+        lines = ['{:<16}{:>8}{:>11}{:>10}{:>10}{:>10}'.format('stage', 'count', 'total (s)', 'mean', 'p90', 'max')]
+        for name, stage in sorted(report['stages'].items(), key=lambda item: -item[1]['total']):
+            lines.append('{:<16}{:>8}{:>11.2f}{:>10.3f}{:>10.3f}{:>10.3f}'.format(
+                name, stage['count'], stage['total'], stage['mean'], stage['p90'], stage['max']))
+        lines.append('{:<16}{:>8}{:>11}{:>10}{:>10}{:>10}'.format('API latency', 'requests', '', 'p50', 'p90', 'p99'))
+        for name, latency in [('all', report['api']['all'])] + sorted(report['api']['markers'].items()):
+            lines.append('{:<16}{:>8}{:>11}{:>10.3f}{:>10.3f}{:>10.3f}'.format(
+                name, latency['requests'], '', latency['p50'], latency['p90'], latency['p99']))
+        lines.append('Tokens: {} prompt, {} completion; {} failed requests'.format(
+            report['api']['prompt_tokens'], report['api']['completion_tokens'], report['api']['failed_requests']))
+        retries = sum(stats.get('retries', 0) for stats in report['markers'].values())
+        lines.append('Retries: {}; {}'.format(retries, ', '.join('{}: {}'.format(key, value) for key, value in sorted(report['counters'].items()))))
+        lines.append('Wall time: {:.2f}s'.format(report['wall_time']))
+        return '\n'.join(lines)
+
+# Profile of the current process, filled by marking.py, utils.py and vfs.py
+PROFILE = RunProfile()
+
+def start_cprofile():
+    """
+    Starts the standard library profiler for a deep dive into a run.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def stop_cprofile(profiler, path, top=25):
+    """
+    Stops the profiler, saves its statistics to `path` (readable with `python -m pstats`) and prints the
+    functions with the largest cumulative time.
+    """
+    profiler.disable()
+    profiler.dump_stats(path)
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+    print(stream.getvalue())
@@ -0,0 +1,116 @@
+import os
+import argparse
+from writers import BULKY_FIELDS, ReportStream
+from utils import read_text_file, save_txt_file
+from args import parse_split
+
+# Fields replaced by a link to their text file in the compact reports; the others are small enough to inline
+LINKED_FIELDS = ['LICENSE', 'README', 'REPORT', 'REQUIREMENTS', 'CODE']
+
+def load_template(prompts_dir, compact=False):
+    """
+    Reads the report template: MarkdownReportCompact.txt for compact reports if it exists, MarkdownReport.txt otherwise.
+    """
+    if compact and os.path.isfile(os.path.join(prompts_dir, 'MarkdownReportCompact.txt')):
+        return read_text_file(os.path.join(prompts_dir, 'MarkdownReportCompact.txt'))
+    return read_text_file(os.path.join(prompts_dir, 'MarkdownReport.txt'))
+
+def render_report(template, row, compact=False, link_dir=None):
+    """
+    Renders the report of a student from a stored row, whose bulky fields are the paths of their text files
+    (see ResultWriter.slim). The text files are only read when they are inlined.
+
+    Parameters:
+        template (str): The report template.
+        row (dict): The stored results of the student.
+        compact (bool): Link to the text files of LINKED_FIELDS instead of inlining them.
+        link_dir (str): The directory of the report, which the links are relative to (default: absolute links).
+
+    Returns:
+        str: The markdown report.
+    """
+    fields = dict(row)
+    for field in BULKY_FIELDS:
+        path = fields.get(field)
+        if not isinstance(path, str) or not os.path.isfile(path):
+            continue
+        if compact and field in LINKED_FIELDS:
+            target = os.path.relpath(path, link_dir) if link_dir is not None else os.path.abspath(path)
+            fields[field] = '[{}]({})'.format(os.path.basename(path), target.replace(os.sep, '/'))
+        else:
+            fields[field] = read_text_file(path)
+    return template.format(**fields)
+
+def build_reports(rows, template, output_dir, split=None, compact=False, name='all'):
+    """
+    Writes the combined reports of a cohort, rendering and writing one student at a time.
+
+    Parameters:
+        rows (iterable): The stored results of each student, e.g. from ResultStore.rows.
+        template (str): The report template.
+        output_dir (str): The directory of the combined reports.
+        split: None, 'tutor' or a number of students per file, as for ReportStream.
+        compact (bool): Link to the source files instead of inlining them.
+        name (str): The base name of the files (default: 'all').
+
+    Returns:
+        list: The paths of the files written.
+    """
+    stream = ReportStream(output_dir, split, name)
+    for row in rows:
+        stream.write(row, render_report(template, row, compact, output_dir))
+    stream.close()
+    return stream.paths
+
+def write_reports(rows, prompts_dir, output_dir, markdown_dir, split=None, compact=False, students=None):
+    """
+    Renders stored results: the combined reports of the cohort, or only the reports of some students to
+    <markdown_dir>/<ID>.md.
+
+    Parameters:
+        rows (iterable): The stored results of each student, e.g. from ResultStore.rows.
+        prompts_dir (str): The directory of the report templates.
+        output_dir (str): The directory of the combined reports.
+        markdown_dir (str): The directory of the per-student reports.
+        split: None, 'tutor' or a number of students per file, as for ReportStream.
+        compact (bool): Link to the source files instead of inlining them.
+        students (list): IDs of the students to render, None for the combined reports.
+
+    Returns:
+        list: The paths of the files written.
+    """
+    template = load_template(prompts_dir, compact)
+    if students is None:
+        os.makedirs(output_dir, exist_ok=True)
+        return build_reports(rows, template, output_dir, split, compact)
+    os.makedirs(markdown_dir, exist_ok=True)
+    paths = []
+    for row in rows:
+        if str(row['ID']) in students:
+            path = os.path.join(markdown_dir, '{}.md'.format(row['ID']))
+            save_txt_file(render_report(template, row, compact, markdown_dir), path)
+            paths.append(path)
+    return paths
+
+if __name__ == '__main__':
+    from store import ResultStore
+
+    parser = argparse.ArgumentParser(description="Render markdown reports from the results store written by marking.py.")
+    parser.add_argument('--db', type=str, default='./results.sqlite', help='Path of the results store (default: ./results.sqlite)')
+    parser.add_argument('--run', type=int, default=None, help='Run to render (default: the last finished run)')
+    parser.add_argument('--prompts_dir', type=str, default='./prompts', help='Directory containing the report templates (default: ./prompts)')
+    parser.add_argument('--output_dir', type=str, default='.', help='Directory of the combined reports (default: .)')
+    parser.add_argument('--student', type=str, nargs='*', default=None, help='Only render the reports of these student IDs, to MarkDowns/<ID>.md')
+    parser.add_argument('--markdown_dir', type=str, default='./MarkDowns', help='Directory of the per-student reports (default: ./MarkDowns)')
+    parser.add_argument('--split', type=parse_split, default=None, help="Split the combined report per 'tutor' or every N students")
+    parser.add_argument('--compact', action='store_true', help='Link to the source files instead of inlining them')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.db):
+        print(f"Error: no results store at '{args.db}'")
+        raise SystemExit(1)
+    store = ResultStore(args.db)
+    rows = store.rows(args.run)
+    store.close()
+    for path in write_reports(rows, args.prompts_dir, args.output_dir, args.markdown_dir, args.split, args.compact, args.student):
+        print('Wrote {}'.format(path))
@@ -0,0 +1,131 @@
+import re
+import time
+import random
+import threading
+from collections import deque
+
+class RetryPolicy:
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0, jitter=0.5):
+        """
+        Initializes how often and how patiently a failed ChatGPT call is retried.
+
+        Args:
+            max_attempts (int): Maximum number of requests per marker call, including the first one.
+            base_delay (float): Delay in seconds before the first retry; it doubles on every retry.
+            max_delay (float): Upper bound of the delay in seconds.
+            jitter (float): Fraction of the delay that is randomised so that workers do not retry in lockstep.
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt, hint=None):
+        """
+        Computes the delay before the next attempt.
+
+        Parameters:
+            attempt (int): The number of the attempt that just failed, starting at 1.
+            hint (float): Seconds the server asked us to wait (e.g. from a Retry-After header), if any.
+
+        Returns:
+            float: The number of seconds to sleep.
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        delay = random.uniform(delay * (1 - self.jitter), delay)
+        if hint is not None:
+            delay = max(delay, min(hint, self.max_delay))
+        return delay
+
+class CircuitBreaker:
+    def __init__(self, window=20, threshold=0.5, cooldown=30.0):
+        """
+        Initializes a breaker that pauses every worker when too many recent ChatGPT calls have failed.
+
+        Args:
+            window (int): Number of recent calls considered.
+            threshold (float): Failure rate over the window that opens the breaker.
+            cooldown (float): Seconds the breaker stays open before calls are allowed again.
+        """
+        self.window = window
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.results = deque(maxlen=window)
+        self.open_until = 0.0
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    def record(self, success):
+        """
+        Records the outcome of a call and opens the breaker if the failure rate spikes.
+
+        Parameters:
+            success (bool): Whether the API answered the request.
+        """
+        with self.lock:
+            self.results.append(success)
+            failures = self.results.count(False)
+            if len(self.results) >= self.window // 2 and failures / len(self.results) >= self.threshold:
+                self.open_until = time.monotonic() + self.cooldown
+                self.trips += 1
+                self.results.clear()
+                print(f"Circuit breaker open: {failures} recent ChatGPT calls failed, pausing all workers for {self.cooldown:.0f}s")
+
+    def wait(self):
+        """
+        Blocks while the breaker is open.
+
+        Returns:
+            float: The number of seconds spent waiting.
+        """
+        with self.lock:
+            remaining = self.open_until - time.monotonic()
+        if remaining <= 0:
+            return 0.0
+        time.sleep(remaining)
+        return remaining
+
+def parse_duration(value):
+    """
+    Parses a rate-limit reset hint such as '20', '1.5s', '250ms' or '6m0s'.
+
+    Parameters:
+        value (str): The header value.
+
+    Returns:
+        float: The duration in seconds, or None if it cannot be parsed.
+    """
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not parts or ''.join(number + unit for number, unit in parts) != value:
+        return None
+    scale = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+def retry_after(error):
+    """
+    Reads the delay requested by the server from the headers of a failed API response.
+
+    Parameters:
+        error (Exception): The exception raised by the API client.
+
+    Returns:
+        float: The requested delay in seconds, or None if the response carries no hint.
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    if headers.get('retry-after-ms'):
+        delay = parse_duration(headers['retry-after-ms'])
+        return delay / 1000 if delay is not None else None
+    for header in ['retry-after', 'x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens']:
+        if headers.get(header):
+            delay = parse_duration(headers[header])
+            if delay is not None:
+                return delay
+    return None
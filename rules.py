@@ -0,0 +1,212 @@
+import os
+import re
+import json
+from concurrent.futures import Future
+from utils import MarkerResult
+
+def is_empty(value):
+    return value is None or value == -1 or (isinstance(value, str) and value.strip() == '')
+
+def rule_empty(text, score=0):
+    """
+    Gives `score` when the field is missing or blank.
+    """
+    return score if is_empty(text) else None
+
+def rule_count_lines(text, minimum, score=1):
+    """
+    Gives `score` when the field has at least `minimum` non-blank lines and 0 otherwise, e.g. commits in GitM.
+    """
+    if not isinstance(text, str):
+        return None
+    return score if len([line for line in text.splitlines() if line.strip() != '']) >= minimum else 0
+
+def rule_all_lines_match(text, pattern, score=0):
+    """
+    Gives `score` when every non-blank line of the field matches `pattern`.
+    """
+    if not isinstance(text, str):
+        return None
+    lines = [line.strip() for line in text.splitlines() if line.strip() != '']
+    if len(lines) == 0 or not all(re.search(pattern, line) for line in lines):
+        return None
+    return score
+
+def rule_contains(text, score, any_of=None, all_of=None):
+    """
+    Gives `score` when the field contains any of the strings of `any_of`, or every string of `all_of`.
+    """
+    if not isinstance(text, str):
+        return None
+    if any_of is not None and not any(token in text for token in any_of):
+        return None
+    if all_of is not None and not all(token in text for token in all_of):
+        return None
+    return score
+
+def rule_lacks(text, any_of, score=0):
+    """
+    Gives `score` when the field contains none of the strings of `any_of` (case-insensitive).
+    """
+    if not isinstance(text, str):
+        return None
+    text = text.lower()
+    return score if not any(token.lower() in text for token in any_of) else None
+
+def rule_at_least(value, minimum, score=1):
+    """
+    Gives `score` when a numeric field is at least `minimum`, e.g. the comment lines of the code.
+    """
+    if not isinstance(value, (int, float)):
+        return None
+    return score if value >= minimum else None
+
+def rule_at_most(value, maximum, score=0):
+    """
+    Gives `score` when a numeric field is at most `maximum`.
+    """
+    if not isinstance(value, (int, float)):
+        return None
+    return score if value <= maximum else None
+
+def rule_value(value):
+    """
+    Gives the value of the field itself, e.g. a check computed in Step 1, unless it is None.
+    """
+    return value
+
+# Rules available in Rules.json; each one reads one field of the assessment information
+RULES = {'empty': rule_empty,
+         'count_lines': rule_count_lines,
+         'all_lines_match': rule_all_lines_match,
+         'contains': rule_contains,
+         'lacks': rule_lacks,
+         'at_least': rule_at_least,
+         'at_most': rule_at_most,
+         'value': rule_value}
+
+class RuleEngine:
+    def __init__(self, config, criteria, fullmarks):
+        """
+        Scores the clear-cut cases of the ChatGPT criteria locally.
+
+        The configuration maps each prompt file to the rules of its criteria, keyed by criterion number, with '*'
+        for the rules applying to all of them. The rules of a criterion are tried in order and the first one
+        giving a score decides it, e.g.
+
+            {"GitM": {"*": [{"rule": "empty", "field": "GitM"}],
+                      "1.5": [{"rule": "count_lines", "field": "GitM", "minimum": 4}]}}
+
+        A marker whose criteria are all decided is not sent to ChatGPT; otherwise the decided criteria override
+        the scores ChatGPT returns.
+
+        Args:
+            config (dict): The rules of each prompt file.
+            criteria (dict): The criterion numbers scored by each marker, in the order of its scores.
+            fullmarks (dict): The maximum score of each criterion of each marker.
+        """
+        self.criteria = criteria
+        self.fullmarks = fullmarks
+        self.rules = {}     # Marker -> list (one per score) of [(label, function, field, options)]
+        self.stats = {}     # Label -> {'decided': criteria decided, 'saved': ChatGPT calls skipped}
+        self.saved = {}     # Marker -> ChatGPT calls skipped
+        for name, sections in config.items():
+            if name not in criteria:
+                raise ValueError('Unknown prompt file in the rules: {}'.format(name))
+            self.rules[name] = [[] for _ in criteria[name]]
+            for criterion, entries in sections.items():
+                if criterion != '*' and criterion not in criteria[name]:
+                    raise ValueError('{} does not score criterion {}'.format(name, criterion))
+                for entry in entries:
+                    options = dict(entry)
+                    rule = options.pop('rule')
+                    if rule not in RULES:
+                        raise ValueError('Unknown rule: {}'.format(rule))
+                    field = options.pop('field')
+                    label = options.pop('name', '{} {} {}'.format(name, criterion, rule))
+                    self.stats.setdefault(label, {'decided': 0, 'saved': 0})
+                    for index, number in enumerate(criteria[name]):
+                        if criterion in ('*', number):
+                            self.rules[name][index].append((label, RULES[rule], field, options))
+
+    @classmethod
+    def load(cls, path, criteria, fullmarks):
+        """
+        Reads the rules from a JSON file; a missing file gives an engine without rules.
+        """
+        config = {}
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        return cls(config, criteria, fullmarks)
+
+    def config_of(self, name):
+        """
+        Returns a description of the rules of a marker, to tell when they changed between two runs.
+        """
+        return [[(label, field, options) for label, _, field, options in rules] for rules in self.rules.get(name, [])]
+
+    def decide(self, name, assinfo):
+        """
+        Applies the rules of a marker to a submission.
+
+        Parameters:
+            name (str): The name of the marker.
+            assinfo (dict): The assessment information of the student.
+
+        Returns:
+            list: The score decided for each criterion of the marker, None for the ones left to ChatGPT.
+        """
+        scores = []
+        deciders = []
+        for index, rules in enumerate(self.rules.get(name, [[]] * len(self.criteria[name]))):
+            score = None
+            for label, function, field, options in rules:
+                score = function(assinfo.get(field), **options)
+                if score is not None:
+                    score = min(score, self.fullmarks[name][index])
+                    deciders.append(label)
+                    break
+            scores.append(score)
+        for label in deciders:
+            self.stats[label]['decided'] += 1
+        if len(deciders) != 0 and None not in scores:
+            self.saved[name] = self.saved.get(name, 0) + 1
+            for label in set(deciders):
+                self.stats[label]['saved'] += 1
+        return scores
+
+    def summary(self):
+        """
+        Returns the ChatGPT calls saved per marker, then one line per rule with the criteria it decided and the
+        calls it helped to skip.
+        """
+        lines = ['Rules saved {} ChatGPT calls ({})'.format(
+            sum(self.saved.values()), ', '.join('{}: {}'.format(name, count) for name, count in self.saved.items()) or 'none')]
+        lines += ['  {}: decided {}, saved {} calls'.format(label, stats['decided'], stats['saved'])
+                  for label, stats in self.stats.items()]
+        return lines
+
+def overlay(scores, decided):
+    """
+    Replaces the scores of a marker by the ones decided by the rules, keeping the attributes of the result.
+    """
+    result = MarkerResult([score if rule is None else rule for score, rule in zip(scores, decided)])
+    result.manual_review = getattr(scores, 'manual_review', False)
+    result.tokens = getattr(scores, 'tokens', 0)
+    return result
+
+def overlay_future(future, decided):
+    """
+    Turns the future of a marker call into a future of its scores with the decided criteria replaced.
+    """
+    overlaid = Future()
+
+    def resolve(done):
+        try:
+            overlaid.set_result(overlay(done.result(), decided))
+        except Exception as e:
+            overlaid.set_exception(e)
+
+    future.add_done_callback(resolve)
+    return overlaid
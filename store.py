@@ -0,0 +1,331 @@
+import os
+import csv
+import json
+import time
+import sqlite3
+import argparse
+from args import full_marking
+from manifest import hash_text
+from exporter import criterion_number
+from writers import BULKY_FIELDS
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    finished REAL,
+    settings TEXT,
+    columns TEXT
+);
+CREATE TABLE IF NOT EXISTS students (
+    student_id TEXT PRIMARY KEY,
+    name TEXT,
+    email TEXT,
+    tutor TEXT
+);
+CREATE TABLE IF NOT EXISTS submissions (
+    submission_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    position INTEGER NOT NULL,
+    student_id TEXT REFERENCES students(student_id),
+    folder TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    info TEXT NOT NULL,
+    report TEXT NOT NULL,
+    UNIQUE (run_id, position)
+);
+CREATE TABLE IF NOT EXISTS marks (
+    submission_id INTEGER NOT NULL REFERENCES submissions(submission_id),
+    criterion TEXT NOT NULL,
+    score REAL,
+    full_mark REAL NOT NULL,
+    PRIMARY KEY (submission_id, criterion)
+);
+CREATE TABLE IF NOT EXISTS llm_calls (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    marker TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    ok INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS submissions_student ON submissions(student_id);
+CREATE INDEX IF NOT EXISTS marks_criterion ON marks(criterion, score);
+CREATE INDEX IF NOT EXISTS llm_calls_run ON llm_calls(run_id, marker);
+'''
+
+def content_hash(row, mdreport):
+    """
+    Hashes the results of a student. The bulky fields of the row only hold the paths of their text files, so
+    those are read back and their contents are hashed instead.
+    """
+    contents = dict(row)
+    for field in BULKY_FIELDS:
+        value = contents.get(field)
+        if isinstance(value, str) and os.path.isfile(value):
+            with open(value, 'r', encoding='utf-8', errors='replace') as f:
+                contents[field] = f.read()
+    return hash_text(json.dumps(contents, default=str) + mdreport)
+
+def number(value):
+    """
+    Turns a mark read from the REAL columns back into an int when it is a whole number, as it was written.
+    """
+    return int(value) if isinstance(value, float) and value.is_integer() else value
+
+class ResultStore:
+    def __init__(self, path):
+        """
+        Opens (or creates) the SQLite store of marking results: runs, students, submissions, the mark of every
+        criterion of `full_marking`, and the ChatGPT calls of each run.
+
+        Submissions are buffered and written in one transaction per `flush`, so adding a student costs no disk
+        write of its own.
+
+        Args:
+            path (str): Path of the database file.
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.run_id = None
+        self.columns = None
+        self.pending = []
+
+    def begin_run(self, settings=None):
+        """
+        Starts recording a run.
+
+        Parameters:
+            settings (dict): Options of the run worth keeping, e.g. the parsed command-line arguments.
+
+        Returns:
+            int: The id of the run.
+        """
+        with self.connection:
+            cursor = self.connection.execute('INSERT INTO runs (started, settings) VALUES (?, ?)',
+                                             (time.time(), json.dumps(settings or {}, default=str)))
+        self.run_id = cursor.lastrowid
+        self.columns = None
+        return self.run_id
+
+    def add(self, position, dirn, row, mdreport):
+        """
+        Buffers the results of one student.
+
+        Parameters:
+            position (int): The position of the folder in the run.
+            dirn (str): The directory path containing the student submission.
+            row (dict): The row written to marks.csv.
+            mdreport (str): The markdown report of the student.
+        """
+        if self.columns is None:
+            self.columns = list(row)
+        info = {key: value for key, value in row.items() if key not in full_marking}
+        info_text = json.dumps(info, default=str)
+        self.pending.append((position, dirn, row, info_text, mdreport, content_hash(row, mdreport)))
+
+    def flush(self):
+        """
+        Writes the buffered students in one transaction.
+        """
+        if len(self.pending) == 0:
+            return
+        with self.connection:
+            for position, dirn, row, info_text, mdreport, digest in self.pending:
+                student = str(row['ID']) if row.get('ID') is not None else None
+                if student is not None:
+                    self.connection.execute('INSERT INTO students (student_id, name, email, tutor) VALUES (?, ?, ?, ?) '
+                                            'ON CONFLICT(student_id) DO UPDATE SET name=excluded.name, email=excluded.email, tutor=excluded.tutor',
+                                            (student, row.get('Name'), row.get('Email'), row.get('Tutor')))
+                # A student written again keeps their submission_id, so their marks rows are replaced, not orphaned
+                self.connection.execute(
+                    'INSERT INTO submissions (run_id, position, student_id, folder, content_hash, info, report) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(run_id, position) DO UPDATE SET student_id=excluded.student_id, '
+                    'folder=excluded.folder, content_hash=excluded.content_hash, info=excluded.info, report=excluded.report',
+                    (self.run_id, position, student, dirn, digest, info_text, mdreport))
+                submission_id = self.connection.execute('SELECT submission_id FROM submissions WHERE run_id = ? AND position = ?',
+                                                        (self.run_id, position)).fetchone()[0]
+                self.connection.executemany('INSERT OR REPLACE INTO marks (submission_id, criterion, score, full_mark) VALUES (?, ?, ?, ?)',
+                                            [(submission_id, key, row.get(key), full) for key, full in full_marking.items()])
+        self.pending = []
+
+    def make_room(self, position):
+        """
+        Moves the submissions of the run from `position` on one place down, so that a student can be inserted
+        there in folder order.
+        """
+        self.flush()
+        with self.connection:
+            # Through negative positions, as UNIQUE (run_id, position) is checked row by row
+            self.connection.execute('UPDATE submissions SET position = -position - 1 WHERE run_id = ? AND position >= ?',
+                                    (self.run_id, position))
+            self.connection.execute('UPDATE submissions SET position = -position WHERE run_id = ? AND position < 0',
+                                    (self.run_id,))
+
+    def record_calls(self, requests):
+        """
+        Stores the ChatGPT requests of the run, as recorded by the run profile: (marker, seconds, prompt tokens,
+        completion tokens, ok).
+        """
+        with self.connection:
+            self.connection.executemany('INSERT INTO llm_calls (run_id, marker, seconds, prompt_tokens, completion_tokens, ok) '
+                                        'VALUES (?, ?, ?, ?, ?, ?)',
+                                        [(self.run_id, marker, seconds, prompt, completion, int(ok))
+                                         for marker, seconds, prompt, completion, ok in requests])
+
+    def finish_run(self):
+        self.flush()
+        with self.connection:
+            self.connection.execute('UPDATE runs SET finished = ?, columns = ? WHERE run_id = ?',
+                                    (time.time(), json.dumps(self.columns), self.run_id))
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def latest_run(self, finished=True):
+        """
+        Returns the id of the last (finished) run, or None.
+        """
+        query = 'SELECT MAX(run_id) FROM runs' + (' WHERE finished IS NOT NULL' if finished else '')
+        return self.connection.execute(query).fetchone()[0]
+
+    def rows(self, run_id=None):
+        """
+        Rebuilds the rows of marks.csv of a run, in folder order.
+
+        Parameters:
+            run_id (int): The run (default: the last finished run).
+
+        Returns:
+            list: One dict per student, with the same keys as marks.csv.
+        """
+        run_id = run_id if run_id is not None else self.latest_run()
+        marks = {}
+        for submission_id, criterion, score in self.connection.execute(
+                'SELECT m.submission_id, m.criterion, m.score FROM marks m JOIN submissions s USING (submission_id) '
+                'WHERE s.run_id = ?', (run_id,)):
+            marks.setdefault(submission_id, {})[criterion] = number(score)
+        rows = []
+        for submission_id, info in self.connection.execute(
+                'SELECT submission_id, info FROM submissions WHERE run_id = ? ORDER BY position', (run_id,)):
+            row = json.loads(info)
+            row.update(marks.get(submission_id, {}))
+            rows.append(row)
+        return rows
+
+    def results(self, run_id=None):
+        """
+        Returns (folder, row, report) of every student of a run, in folder order.
+        """
+        run_id = run_id if run_id is not None else self.latest_run()
+        folders = self.connection.execute('SELECT folder, report FROM submissions WHERE run_id = ? ORDER BY position',
+                                          (run_id,)).fetchall()
+        return [(folder, row, report) for (folder, report), row in zip(folders, self.rows(run_id))]
+
+    def columns_of(self, run_id):
+        columns = self.connection.execute('SELECT columns FROM runs WHERE run_id = ?', (run_id,)).fetchone()
+        return json.loads(columns[0]) if columns and columns[0] else None
+
+    def export_csv(self, path, run_id=None):
+        """
+        Writes marks.csv of a run, laid out like the one written during the run.
+        """
+        run_id = run_id if run_id is not None else self.latest_run()
+        rows = self.rows(run_id)
+        columns = self.columns_of(run_id) or (list(rows[0]) if rows else [])
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=[''] + columns, restval='', extrasaction='ignore')
+            writer.writeheader()
+            for i, row in enumerate(rows):
+                writer.writerow(dict(row, **{'': i}))
+
+    def export_markdown(self, path, run_id=None):
+        """
+        Writes all.md of a run.
+        """
+        run_id = run_id if run_id is not None else self.latest_run()
+        with open(path, 'w', encoding='utf-8') as f:
+            for i, (report,) in enumerate(self.connection.execute(
+                    'SELECT report FROM submissions WHERE run_id = ? ORDER BY position', (run_id,))):
+                if i > 0:
+                    f.write('  \n')
+                f.write(report)
+
+    def lost_marks(self, criterion, run_id=None):
+        """
+        Lists the students who did not get full marks for a criterion.
+
+        Parameters:
+            criterion (str): A key of `full_marking` or its number, e.g. '2.5'.
+            run_id (int): The run (default: the last finished run).
+
+        Returns:
+            list: (student ID, name, score, full mark) sorted by student ID.
+        """
+        run_id = run_id if run_id is not None else self.latest_run()
+        keys = [key for key in full_marking if key == criterion or criterion_number(key) == criterion]
+        if len(keys) == 0:
+            raise ValueError('Unknown criterion: {}'.format(criterion))
+        return [(student, name, number(score), number(full)) for student, name, score, full in self.connection.execute(
+            'SELECT s.student_id, st.name, m.score, m.full_mark FROM marks m JOIN submissions s USING (submission_id) '
+            'LEFT JOIN students st ON st.student_id = s.student_id '
+            'WHERE s.run_id = ? AND m.criterion = ? AND (m.score IS NULL OR m.score < m.full_mark) ORDER BY s.student_id',
+            (run_id, keys[0]))]
+
+    def changed(self, run_id=None, previous=None):
+        """
+        Lists the students whose results differ between two runs.
+
+        Parameters:
+            run_id (int): The newer run (default: the last finished run).
+            previous (int): The older run (default: the finished run before `run_id`).
+
+        Returns:
+            list: (student ID, status) with status 'new', 'changed' or 'removed'.
+        """
+        run_id = run_id if run_id is not None else self.latest_run()
+        if previous is None:
+            previous = self.connection.execute('SELECT MAX(run_id) FROM runs WHERE run_id < ? AND finished IS NOT NULL',
+                                               (run_id,)).fetchone()[0]
+        new = dict(self.connection.execute('SELECT student_id, content_hash FROM submissions WHERE run_id = ?', (run_id,)))
+        old = dict(self.connection.execute('SELECT student_id, content_hash FROM submissions WHERE run_id = ?', (previous,)))
+        result = [(student, 'new') for student in new if student not in old]
+        result += [(student, 'changed') for student in new if student in old and new[student] != old[student]]
+        result += [(student, 'removed') for student in old if student not in new]
+        return sorted(result, key=lambda item: str(item[0]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query the results store written by marking.py.")
+    parser.add_argument('--db', type=str, default='./results.sqlite', help='Path of the results store (default: ./results.sqlite)')
+    parser.add_argument('--run', type=int, default=None, help='Run to query (default: the last finished run)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('runs', help='List the runs')
+    commands.add_parser('csv', help='Write marks.csv of a run').add_argument('path', type=str)
+    commands.add_parser('markdown', help='Write all.md of a run').add_argument('path', type=str)
+    commands.add_parser('lost', help='List the students who lost marks on a criterion, e.g. 2.5').add_argument('criterion', type=str)
+    commands.add_parser('changed', help='List the students whose results changed since the previous run')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.db):
+        print(f"Error: no results store at '{args.db}'")
+        raise SystemExit(1)
+    store = ResultStore(args.db)
+    if args.command == 'runs':
+        for run_id, started, finished, count in store.connection.execute(
+                'SELECT r.run_id, r.started, r.finished, COUNT(s.submission_id) FROM runs r '
+                'LEFT JOIN submissions s USING (run_id) GROUP BY r.run_id ORDER BY r.run_id'):
+            print('{}\t{}\t{}\t{} students'.format(run_id, time.strftime('%Y-%m-%d %H:%M', time.localtime(started)),
+                                                   'finished' if finished else 'interrupted', count))
+    elif args.command == 'csv':
+        store.export_csv(args.path, args.run)
+    elif args.command == 'markdown':
+        store.export_markdown(args.path, args.run)
+    elif args.command == 'lost':
+        for student, name, score, full in store.lost_marks(args.criterion, args.run):
+            print('{}\t{}\t{} / {}'.format(student, name, score, full))
+    elif args.command == 'changed':
+        for student, status in store.changed(args.run):
+            print('{}\t{}'.format(student, status))
+    store.close()
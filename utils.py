@@ -1,74 +1,234 @@
 import os
 import re
+import time
+import threading
 from glob import glob
-import openai
 import zipfile as zf
 import tarfile as tf
-import rarfile as rf
+from grading import estimate_tokens
+from retry import RetryPolicy
+from backends import BackendError, default_backend
+from payload import count_tokens, truncate_to_tokens
+from profiler import PROFILE
+
+SYSTEM_MESSAGE = "You are an teaching assistant grading for the Programming Portfolio 1 course."
+
+class MarkerResult(list):
+    """
+    The scores returned by a GPTMarker. `manual_review` is set when ChatGPT never gave a valid answer
+    and the scores are a zero fallback that a marker has to check by hand.
+    """
+    manual_review = False
+    tokens = 0  # Number of prompt tokens sent to the API for this result
+
+def parse_scores(content, fullmark):
+    """
+    Parses a ChatGPT reply into a list of scores.
+
+    Parameters:
+        content (str): The text of the reply, e.g. '1,0,2'.
+        fullmark (list): A list of maximum scores for each criterion.
+
+    Returns:
+        list: The integer scores, or None if the reply does not contain exactly one valid score per criterion.
+    """
+    reply = content.strip().split(',')
+    # Verify if the response has the expected number of scores
+    if len(reply) != len(fullmark):
+        return None
+    for i in range(len(fullmark)):
+        if reply[i].isdigit() and int(reply[i]) <= fullmark[i]:
+            reply[i] = int(reply[i])  # Convert valid scores to integers
+        else:
+            return None
+    return reply
 
 class GPTMarker:
-    def __init__(self, prompt, fullmark, chatmodel = "gpt-4o"):
+    def __init__(self, prompt, fullmark, chatmodel = "gpt-4o", limiter = None, cache = None, retry_policy = None, breaker = None, budgets = None, name = None, backend = None):
         """
         Initializes the GPTMarker with maximum scores and the prompt.
 
         Args:
             prompt (str): The initial prompt message to send to the ChatGPT model.
             fullmark (list): A list of maximum scores for each criterion.
+            limiter (RateLimiter): Optional limiter shared by all markers to respect per-minute budgets.
+            cache (ResponseCache): Optional persistent cache of validated scores.
+            retry_policy (RetryPolicy): How failed calls and invalid replies are retried (default: RetryPolicy()).
+            breaker (CircuitBreaker): Optional breaker shared by all markers that pauses them when the API keeps failing.
+            budgets (dict): Optional maximum number of tokens per message field, e.g. {'CODE': 8000}.
+            name (str): Name of the marker in the run profile (default: the model name).
+            backend: The LLM backend answering the requests, e.g. an OpenAIBackend or a MockBackend
+                (default: an OpenAIBackend keyed by the OPENAI_API_KEY environment variable).
         """
         self.prompt = prompt
+        self.name = name if name is not None else chatmodel
         self.fullmark = fullmark
         self.chatmodel = chatmodel
+        self.limiter = limiter
+        self.cache = cache
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.breaker = breaker
+        self.budgets = budgets if budgets is not None else {}
+        self.backend = backend
+        self.stats = {'calls': 0, 'requests': 0, 'retries': 0, 'api_errors': 0, 'invalid_replies': 0, 'manual_reviews': 0, 'backoff_seconds': 0.0, 'prompt_tokens': 0}
+        self.stats_lock = threading.Lock()
+
+    def _count(self, **increments):
+        with self.stats_lock:
+            for key, value in increments.items():
+                self.stats[key] += value
+
+    def model_key(self):
+        """
+        Names the model and backend of this marker in the keys of the response cache and the manifest.
+        """
+        return self.backend.key(self.chatmodel) if self.backend is not None else self.chatmodel
+
+    def ask(self, content, **options):
+        """
+        Sends one request to the backend, waiting for the circuit breaker and the rate limiter first.
+
+        Args:
+            content (str): The user message.
+            **options: Extra arguments of the chat completion request, e.g. response_format.
+
+        Returns:
+            tuple: (reply text or None if the request failed, prompt tokens sent, seconds the server asked us to
+            wait before retrying or None).
+        """
+        # Wait while the circuit breaker is open and for room in the per-minute budgets
+        if self.breaker is not None:
+            self._count(backoff_seconds=self.breaker.wait())
+        if self.limiter is not None:
+            self.limiter.acquire(estimate_tokens(SYSTEM_MESSAGE + content))
+
+        # Send a request to the chat completion API
+        tokens = count_tokens(SYSTEM_MESSAGE + content)
+        self._count(requests=1, prompt_tokens=tokens)
+        backend = self.backend if self.backend is not None else default_backend()
+        start = time.perf_counter()
+        try:
+            text, prompt_tokens, completion_tokens = backend.complete(
+                self.chatmodel,
+                [
+                    {"role": "system", "content": SYSTEM_MESSAGE},
+                    {"role": "user", "content": content}
+                ],
+                **options
+            )
+        except BackendError as e:
+            self._count(api_errors=1)
+            PROFILE.request(self.name, time.perf_counter() - start, tokens, ok=False)
+            if self.breaker is not None:
+                self.breaker.record(False)
+            print('ChatGPT request failed: {}'.format(e))
+            return None, tokens, e.retry_after
+        PROFILE.request(self.name, time.perf_counter() - start, prompt_tokens or tokens, completion_tokens or 0)
+        if self.breaker is not None:
+            self.breaker.record(True)
+        return text, tokens, None
+
+    def render(self, message):
+        """
+        Fills the prompt with the assessment information, cutting budgeted fields down to their token budget.
+
+        Args:
+            message (dict): The assessment information of the student.
+
+        Returns:
+            str: The prompt to send.
+        """
+        if len(self.budgets) != 0:
+            message = dict(message)
+            for field, budget in self.budgets.items():
+                if isinstance(message.get(field), str):
+                    message[field] = truncate_to_tokens(message[field], budget)
+        return self.prompt.format(**message)
 
     def __call__(self, message):
         """
         Enables the GPTMarker instance to be called as a function and processes the grading.
 
+        Invalid replies and API errors are retried with exponential backoff up to `retry_policy.max_attempts`
+        requests. If no attempt succeeds, zero scores flagged for manual review are returned instead.
+
         Args:
             message (str): The message or query for which ChatGPT will provide a score.
 
         Returns:
-            list: A list of integer scores for each evaluation criterion.
+            MarkerResult: A list of integer scores for each evaluation criterion.
         """
-        while True:
-            # Send a request to OpenAI's chat completion API
-            response = openai.chat.completions.create(
-                model=self.chatmodel,
-                messages=[
-                    {"role": "system", "content": "You are an teaching assistant grading for the Programming Portfolio 1 course."},
-                    {"role": "user", "content": self.prompt.format(**message)}
-                ]
-            )
-            # Parse the response to get the scores as a list
-            reply = response.choices[0].message.content.strip().split(',')
-            print('ChatGPT is marking: {}; Full mark: {}'.format(response.choices[0].message.content.strip(), self.fullmark))
-            
-            # Verify if the response has the expected number of scores
-            if len(reply) == len(self.fullmark):
-                is_valid = True  # Flag to check if all scores are valid
-                for i in range(len(self.fullmark)):
-                    if reply[i].isdigit() and int(reply[i]) <= self.fullmark[i]:
-                        reply[i] = int(reply[i])  # Convert valid scores to integers
-                    else:
-                        is_valid = False  # Set flag to False if any score is invalid
-                        break
-                if is_valid:
-                    break  # Exit the loop if all scores are valid
+        self._count(calls=1)
+        content = self.render(message)
+        # Reuse the scores of an identical request from a previous run
+        if self.cache is not None:
+            cache_key = self.cache.key(self.model_key(), SYSTEM_MESSAGE, content, self.fullmark)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return MarkerResult(cached)
+
+        policy = self.retry_policy
+        sent_tokens = 0
+        for attempt in range(1, policy.max_attempts + 1):
+            if attempt > 1:
+                self._count(retries=1)
+            text, tokens, hint = self.ask(content)
+            sent_tokens += tokens
+            if text is not None:
+                # Parse the response to get the scores as a list
+                print('ChatGPT is marking: {}; Full mark: {}'.format(text.strip(), self.fullmark))
+                reply = parse_scores(text, self.fullmark)
+                if reply is not None:
+                    if self.cache is not None:
+                        self.cache.put(cache_key, reply)
+                    reply = MarkerResult(reply)
+                    reply.tokens = sent_tokens
+                    return reply
+                self._count(invalid_replies=1)
+
+            if attempt < policy.max_attempts:
+                delay = policy.delay(attempt, hint)
+                self._count(backoff_seconds=delay)
+                time.sleep(delay)
+
+        # Give up and let a human check this criterion
+        print('ChatGPT gave no valid score after {} attempts; flagged for manual review'.format(policy.max_attempts))
+        self._count(manual_reviews=1)
+        reply = MarkerResult([0] * len(self.fullmark))
+        reply.manual_review = True
+        reply.tokens = sent_tokens
         return reply
 
+    def summary(self):
+        """
+        Returns a one-line description of the calls, retries and backoff of this marker.
+        """
+        stats = self.stats
+        return '{} calls, {} requests, {} prompt tokens, {} retries ({} API errors, {} invalid replies), {:.1f}s backing off, {} flagged for manual review'.format(
+            stats['calls'], stats['requests'], stats['prompt_tokens'], stats['retries'], stats['api_errors'], stats['invalid_replies'], stats['backoff_seconds'], stats['manual_reviews'])
+
 
-def read_text_file(file_path):
+def read_text_file(file_path, fs=None):
     """
     Reads the entire content of a text file and returns it as a string.
     
     Parameters:
     file_path (str): The path to the text file.
+    fs (SubmissionFS): Optional view of a submission, used to read files that are still inside an archive.
 
     Returns:
     str: The contents of the file as a single string, or None if an error occurs.
     """
+    if fs is not None:
+        try:
+            return fs.read_text(file_path)
+        except (OSError, KeyError) as e:
+            print(f"Error: Could not read the file at '{file_path}': {e}")
+            return None
     try:
         with open(file_path, 'r', encoding='utf-8') as file:
             content = file.read()  # Read the entire file content
+            PROFILE.count(bytes_read=os.fstat(file.fileno()).st_size)
         return content
     except FileNotFoundError:
         print(f"Error: The file at '{file_path}' was not found.")  # Handle file not found error
@@ -139,6 +299,7 @@ def extract_file(file_path, extract_to=None):
             with tf.open(file_path, 'r:*') as tar_ref:
                 tar_ref.extractall(extract_to)
         elif file_path.endswith('.rar'):
+            import rarfile as rf
             with rf.RarFile(file_path, 'r') as rar_ref:
                 rar_ref.extractall(extract_to)
         else:
@@ -206,18 +367,22 @@ def find_files_with_suffix(suffix, search_path='.'):
     
     return matching_files
 
-def parse_student_info(file_path):
+def parse_student_info(file_path, fs=None):
     """
     Parses student information from a specified file and extracts relevant details.
     
     Parameters:
         file_path (str): The path to the file containing student information.
+        fs (SubmissionFS): Optional view of a submission to read the file through.
         
     Returns:
         dict: A dictionary containing the student's Name, ID, Email, and Tutor, or None if not found.
     """
-    with open(file_path, 'r') as file:
-        lines = file.readlines()  # Read all lines from the file
+    if fs is not None:
+        lines = fs.read_text(file_path).splitlines(keepends=True)
+    else:
+        with open(file_path, 'r') as file:
+            lines = file.readlines()  # Read all lines from the file
 
     # Use regular expressions to extract information
     name_match = re.search(r'^(.*?)(?=\s\(\d{9}\))', lines[0])  # Match name up to student ID
@@ -238,12 +403,13 @@ def parse_student_info(file_path):
         'Tutor': tutor
     }
 
-def extract_commit_info(head_path):
+def extract_commit_info(head_path, fs=None):
     """
     Reads commit information from the .git/HEAD file and extracts 'commit: xxx' format records.
 
     Parameters:
         head_path (str): The path to the .git/HEAD file.
+        fs (SubmissionFS): Optional view of a submission to read the file through.
 
     Returns:
         list: A list of commit information records that match the criteria.
@@ -251,8 +417,11 @@ def extract_commit_info(head_path):
     commit_messages = []
     
     # Read the content of the HEAD file
-    with open(head_path, 'r') as file:
-        head_content = file.read()  # Read the entire content
+    if fs is not None:
+        head_content = fs.read_text(head_path)
+    else:
+        with open(head_path, 'r') as file:
+            head_content = file.read()  # Read the entire content
 
     # Use regular expressions to extract records in the 'commit: xxx' format
     matches = re.findall(r'\b(commit: .+)', head_content)  # Find all matches for commit records
@@ -0,0 +1,235 @@
+import os
+import mmap
+import shutil
+import tempfile
+import posixpath
+import zipfile as zf
+import tarfile as tf
+from profiler import PROFILE
+
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz')
+ARCHIVE_SUFFIXES = ('.zip', '.rar') + TAR_SUFFIXES
+
+def mount_point(archive_path):
+    """
+    Returns the folder an archive's members appear under, i.e. where `extract_file` would extract them:
+    zip files into their own folder, tar and rar files into a subfolder named after the file.
+
+    Parameters:
+        archive_path (str): The path to the compressed file.
+
+    Returns:
+        str: The mount point.
+    """
+    file_dir = os.path.dirname(archive_path)
+    if archive_path.endswith('.zip'):
+        return file_dir
+    return os.path.join(file_dir, os.path.splitext(os.path.basename(archive_path))[0])
+
+def spill(archive_path):
+    """
+    Decompresses a gzip, bzip2 or xz compressed tar in one pass into an anonymous temporary file, in which the
+    members can then be found by seeking. A compressed stream can only be read forwards, so reading its members
+    in place would decompress it again from the start for every member read out of order.
+
+    Parameters:
+        archive_path (str): The path to the tar file.
+
+    Returns:
+        file: The uncompressed tar, positioned at its start, or None if the file is not compressed.
+    """
+    with open(archive_path, 'rb') as f:
+        magic = f.read(6)
+    if magic[:2] == b'\x1f\x8b':
+        import gzip as codec
+    elif magic[:3] == b'BZh':
+        import bz2 as codec
+    elif magic == b'\xfd7zXZ\x00':
+        import lzma as codec
+    else:
+        return None
+    spilled = tempfile.TemporaryFile()
+    try:
+        with codec.open(archive_path, 'rb') as f:
+            shutil.copyfileobj(f, spilled, 1 << 20)
+    except (OSError, EOFError) as e:
+        spilled.close()
+        raise tf.ReadError('Cannot decompress {}: {}'.format(archive_path, e))
+    spilled.seek(0)
+    return spilled
+
+class ArchiveFS:
+    def __init__(self, archive_path, mount=None):
+        """
+        Exposes the members of a zip, tar or rar file as read-only files under a mount point.
+        Only the member list is read when the archive is opened; a member is decompressed when it is read.
+
+        A tar file has no index, so a compressed tar cannot be listed without decompressing it: it is
+        decompressed once, when opened, into a temporary file (see `spill`), which takes as much disk space
+        as the uncompressed submission until the archive is closed.
+
+        Args:
+            archive_path (str): The path to the compressed file.
+            mount (str): The folder the members appear under (default: `mount_point(archive_path)`).
+        """
+        self.archive_path = archive_path
+        self.mount = mount if mount is not None else mount_point(archive_path)
+        self.dirs = {'': {}}   # Relative folder path -> {entry name: is_dir}
+        self.members = {}      # Relative file path -> archive member
+        self.spilled = None    # Uncompressed copy of a compressed tar
+        if archive_path.endswith('.zip'):
+            self.handle = zf.ZipFile(archive_path, 'r')
+            for info in self.handle.infolist():
+                self._add(info.filename, info.is_dir(), info)
+        elif archive_path.endswith(TAR_SUFFIXES):
+            self.spilled = spill(archive_path)
+            self.handle = tf.open(fileobj=self.spilled, mode='r:') if self.spilled is not None else tf.open(archive_path, 'r:')
+            for member in self.handle.getmembers():
+                if member.isdir() or member.isfile():
+                    self._add(member.name, member.isdir(), member)
+        elif archive_path.endswith('.rar'):
+            import rarfile as rf
+            self.handle = rf.RarFile(archive_path, 'r')
+            for info in self.handle.infolist():
+                self._add(info.filename, info.is_dir(), info)
+        else:
+            raise ValueError(f"Unsupported file format: {archive_path}")
+
+    def _add(self, name, is_dir, member):
+        parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+        if len(parts) == 0 or '..' in parts:
+            return  # Never expose members outside the mount point
+        for depth in range(len(parts)):
+            parent = '/'.join(parts[:depth])
+            last = depth == len(parts) - 1
+            self.dirs.setdefault(parent, {})[parts[depth]] = is_dir or not last
+            if not last or is_dir:
+                self.dirs.setdefault('/'.join(parts[:depth + 1]), {})
+        if not is_dir:
+            self.members['/'.join(parts)] = member
+
+    def _relative(self, path):
+        if path == self.mount:
+            return ''
+        if not path.startswith(self.mount + os.sep):
+            return None
+        return path[len(self.mount) + 1:].replace(os.sep, '/')
+
+    def contains(self, path):
+        """
+        Returns True if the path is the mount point or lies below it.
+        """
+        return self._relative(path) is not None
+
+    def scandir(self, path):
+        """
+        Lists a folder of the archive.
+
+        Returns:
+            dict: {entry name: is_dir}, empty if the folder does not exist in the archive.
+        """
+        return dict(self.dirs.get(self._relative(path), {}))
+
+    def isfile(self, path):
+        return self._relative(path) in self.members
+
+    def isdir(self, path):
+        return self._relative(path) in self.dirs
+
+    def read_bytes(self, path):
+        """
+        Decompresses and returns the content of a member.
+        """
+        member = self.members.get(self._relative(path))
+        if member is None:
+            raise FileNotFoundError(path)
+        if isinstance(self.handle, tf.TarFile):
+            return self.handle.extractfile(member).read()
+        return self.handle.read(member)
+
+    def close(self):
+        self.handle.close()
+        if self.spilled is not None:
+            self.spilled.close()
+
+class SubmissionFS:
+    def __init__(self, root, archives=()):
+        """
+        A read-only view of a submission folder with compressed files mounted where they would be extracted.
+
+        Args:
+            root (str): The submission folder.
+            archives (list): Paths of the compressed files to mount.
+        """
+        self.root = root
+        self.mounts = [ArchiveFS(archive) for archive in archives]
+
+    def _archive(self, path):
+        for archive in self.mounts:
+            if archive.contains(path):
+                return archive
+        return None
+
+    def scandir(self, path):
+        """
+        Lists a folder, merging the files on disk with the members of mounted archives.
+
+        Parameters:
+            path (str): The folder to list.
+
+        Returns:
+            list: Sorted list of (name, is_dir) tuples.
+        """
+        entries = {}
+        if os.path.isdir(path):
+            with os.scandir(path) as it:
+                for entry in it:
+                    entries[entry.name] = entry.is_dir()
+        for archive in self.mounts:
+            if archive.contains(path):
+                entries.update(archive.scandir(path))
+            elif os.path.dirname(archive.mount) == path:
+                entries[os.path.basename(archive.mount)] = True
+        return sorted(entries.items())
+
+    def isfile(self, path):
+        archive = self._archive(path)
+        if archive is not None and archive.isfile(path):
+            return True
+        return os.path.isfile(path)
+
+    def read_bytes(self, path):
+        """
+        Reads a file from a mounted archive, or from disk if no archive holds it.
+        """
+        archive = self._archive(path)
+        if archive is not None and archive.isfile(path):
+            data = archive.read_bytes(path)
+        else:
+            with open(path, 'rb') as f:
+                data = f.read()
+        PROFILE.count(bytes_read=len(data))
+        return data
+
+    def map(self, path):
+        """
+        Maps a file on disk into memory, so that large files (e.g. git packs) are paged in only where they are read.
+        Members of mounted archives, and empty files, are read into memory instead.
+        """
+        archive = self._archive(path)
+        if archive is not None and archive.isfile(path):
+            return self.read_bytes(path)
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read_text(self, path):
+        """
+        Reads a file as UTF-8 text; undecodable bytes are replaced rather than failing the whole submission.
+        """
+        return self.read_bytes(path).decode('utf-8', errors='replace')
+
+    def close(self):
+        for archive in self.mounts:
+            archive.close()
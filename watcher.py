@@ -0,0 +1,314 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from indexer import SKIP_DIRS
+from writers import ResultWriter, ReportStream
+from profiler import PROFILE
+
+# inotify event masks (see inotify(7))
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT = struct.Struct('iIII')
+
+def skipped(name, parent):
+    """
+    Whether a folder is left out of the watches: virtual environments, SKIP_DIRS and the objects of .git.
+    """
+    return 'venv' in name or name in SKIP_DIRS or (name == 'objects' and os.path.basename(parent) == '.git')
+
+def quick_fingerprint(dirn):
+    """
+    Fingerprints a folder from the size and modification time of its files, without reading them, so that it
+    can be taken every few seconds. Skipped folders only contribute their own modification time.
+    """
+    entries = []
+    for root, dirs, files in os.walk(dirn):
+        dirs.sort()
+        for name in list(dirs):
+            if skipped(name, root):
+                dirs.remove(name)
+                try:
+                    entries.append((os.path.join(root, name), os.stat(os.path.join(root, name)).st_mtime_ns))
+                except OSError:
+                    pass
+        for name in sorted(files):
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            entries.append((os.path.join(root, name), stat.st_size, stat.st_mtime_ns))
+    return hash(tuple(entries))
+
+class InotifySource:
+    def __init__(self, root):
+        """
+        Reports the folders of `root` in which files change, from the inotify events of every folder below it.
+        inotify is called through ctypes, so no package is needed; it raises OSError where it is not available.
+        """
+        self.root = root
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}   # Watch descriptor -> folder
+        self._add_tree(root)
+
+    def _add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'Cannot watch {} (see fs.inotify.max_user_watches)'.format(path))
+        self.watches[wd] = path
+
+    def _add_tree(self, path):
+        self._add(path)
+        for root, dirs, _ in os.walk(path):
+            dirs[:] = [name for name in dirs if not skipped(name, root)]
+            for name in dirs:
+                self._add(os.path.join(root, name))
+
+    def folder_of(self, path):
+        relative = os.path.relpath(path, self.root)
+        if relative == '.' or relative.startswith('..'):
+            return None
+        return os.path.join(self.root, relative.split(os.sep)[0])
+
+    def read(self, timeout):
+        """
+        Waits up to `timeout` seconds for events.
+
+        Returns:
+            set: The folders of `root` touched, or None if events were lost and every folder must be checked.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        touched = set()
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                break
+            position = 0
+            while position < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, position)
+                name = data[position + EVENT.size:position + EVENT.size + length].rstrip(b'\0')
+                position += EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                folder = self.watches.get(wd)
+                if folder is None:
+                    continue
+                path = os.path.join(folder, os.fsdecode(name)) if name else folder
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and not skipped(os.path.basename(path), folder):
+                    try:
+                        self._add_tree(path)
+                    except OSError as e:
+                        print('Warning: {}'.format(e))
+                touched.add(self.folder_of(path))
+        touched.discard(None)
+        return touched
+
+    def close(self):
+        os.close(self.fd)
+
+class PollSource:
+    def __init__(self, root, interval=2.0):
+        """
+        Reports the folders of `root` that changed by comparing their fingerprints every `interval` seconds, for
+        systems without inotify and network filesystems, whose remote changes raise no events.
+        """
+        self.root = root
+        self.interval = interval
+        self.snapshot = self._snapshot()
+        self.next_poll = time.monotonic() + interval
+
+    def _snapshot(self):
+        snapshot = {}
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isdir(path):
+                snapshot[path] = quick_fingerprint(path)
+        return snapshot
+
+    def read(self, timeout):
+        wait = self.next_poll - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(0.0, wait))
+        self.next_poll = time.monotonic() + self.interval
+        snapshot = self._snapshot()
+        touched = set(path for path, fingerprint in snapshot.items() if self.snapshot.get(path) != fingerprint)
+        self.snapshot = snapshot
+        return touched
+
+    def close(self):
+        pass
+
+class FolderWatcher:
+    def __init__(self, root, debounce=5.0, poll_interval=2.0, poll=False):
+        """
+        Watches the student folders of a root directory and hands out each one once its files have settled.
+
+        A folder is handed out when no file in it has changed for `debounce` seconds (a zip still being copied
+        or extracted keeps raising events) and its fingerprint differs from when it was last handed out, so
+        touching a file does not mark the student again. Every folder is handed out once at the start.
+
+        Args:
+            root (str): The root directory of the submissions.
+            debounce (float): Seconds without changes before a folder is handed out (default: 5).
+            poll_interval (float): Seconds between two scans when polling (default: 2).
+            poll (bool): Poll instead of using inotify (default: inotify where available).
+        """
+        self.root = root
+        self.debounce = debounce
+        self.source = None
+        if not poll:
+            try:
+                self.source = InotifySource(root)
+            except OSError as e:
+                print('Cannot use inotify ({}), polling every {}s instead'.format(e, poll_interval))
+        if self.source is None:
+            self.source = PollSource(root, poll_interval)
+
+    def folders(self):
+        return [os.path.join(self.root, name) for name in sorted(os.listdir(self.root)) if os.path.isdir(os.path.join(self.root, name))]
+
+    def changes(self, stopped=None):
+        """
+        Yields the folders to mark, in folder order when several settle together, until `stopped` is set.
+        """
+        dirty = dict((folder, float('-inf')) for folder in self.folders())   # Folder -> time of its last change
+        handed = {}     # Folder -> fingerprint when it was last handed out
+        while stopped is None or not stopped.is_set():
+            now = time.monotonic()
+            for folder in sorted(folder for folder, last in dirty.items() if now - last >= self.debounce):
+                del dirty[folder]
+                if not os.path.isdir(folder):
+                    handed.pop(folder, None)
+                    continue
+                fingerprint = quick_fingerprint(folder)
+                if handed.get(folder) != fingerprint:
+                    handed[folder] = fingerprint
+                    yield folder
+            now = time.monotonic()
+            wait = min([self.debounce - (now - last) for last in dirty.values()] + [1.0])
+            touched = self.source.read(max(0.05, wait))
+            if touched is None:
+                print('Missed file events; checking every folder')
+                touched = self.folders()
+            now = time.monotonic()
+            for folder in touched:
+                dirty[folder] = now
+
+    def close(self):
+        self.source.close()
+
+class WatchWriter(ResultWriter):
+    def __init__(self, output_dir, store, marking_table=None, split=None, settings=None):
+        """
+        Stands in for the ResultWriter of the watch command: a student marked again replaces their results
+        instead of being appended.
+
+        A new run of the store starts with the results of the last run, and each student marked replaces their
+        submission in it. `sync` then publishes the students written since the last call: marks.csv and all.md
+        are rebuilt from the store (marks.csv is replaced atomically) and only their columns of the marking
+        table are rewritten. The table is opened again for each sync, so that edits made by the tutors in the
+        meantime are kept.
+
+        Args:
+            output_dir (str): The output directory.
+            store (ResultStore): The results store.
+            marking_table (str): Path of the marking table, None if there is none.
+            split: As for ReportStream.
+            settings (dict): Options of the run kept in the store.
+        """
+        super().__init__(output_dir, store=store, stream=False)
+        self.pairs_file = None  # Near-duplicates are only compared within a batch; `grade` writes duplicates.csv
+        self.marking_table = marking_table
+        self.unsaved = []       # Rows not yet in the marking table
+        self.split = split
+        self.positions = {}     # Folder -> position in the run
+        self.changed = []
+        self.written = set()    # Folders written in the current round of `watch`
+        previous = store.latest_run()
+        store.begin_run(settings)
+        if previous is not None:
+            for position, (dirn, row, report) in enumerate(store.results(previous)):
+                store.add(position, dirn, row, report)
+                self.positions[os.path.abspath(dirn)] = position
+        store.flush()
+
+    def write(self, dirn, assinfo, mdreport, row=None):
+        if row is None:
+            row = self.slim(dirn, assinfo)
+        key = os.path.abspath(dirn)
+        if key not in self.positions:
+            # A new folder takes its place in folder order, as in a full run
+            position = sum(1 for other in self.positions if other < key)
+            self.store.make_room(position)
+            for other in self.positions:
+                if self.positions[other] >= position:
+                    self.positions[other] += 1
+            self.positions[key] = position
+        self.store.add(self.positions[key], dirn, row, mdreport if mdreport is not None else '')
+        self.changed.append(row)
+        self.written.add(dirn)
+        return row
+
+    def sync(self):
+        """
+        Publishes the students written since the last call to marks.csv, all.md and the marking table.
+
+        The ChatGPT calls recorded since the last call are moved to the store, and the profile is cleared so that
+        it does not grow for as long as the watch runs.
+
+        Returns:
+            int: The number of students published.
+        """
+        self.store.record_calls(PROFILE.take()['requests'])
+        if len(self.changed) == 0:
+            return 0
+        self.store.finish_run()     # Also marks the run as the latest one for `report` and `export`
+        path = os.path.join(self.output_dir, 'marks.csv')
+        self.store.export_csv(path + '.tmp', self.store.run_id)
+        os.replace(path + '.tmp', path)
+        reports = ReportStream(self.output_dir, self.split)
+        for _, row, report in self.store.results(self.store.run_id):
+            if report != '':
+                reports.write(row, report)
+        reports.close()
+        count = len(self.changed)
+        self.unsaved += self.changed
+        self.changed = []
+        if self.marking_table is not None:
+            from exporter import export_marks
+            try:
+                print('Updated {} students in {}'.format(export_marks(self.marking_table, self.unsaved), self.marking_table))
+                self.unsaved = []
+            except OSError as e:
+                # e.g. the sheet is open in Excel on Windows; the columns are saved with the next students
+                print('Cannot save the marking table, retrying later: {}'.format(e))
+        return count
+
+    def close(self):
+        self.sync()
@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from writers import ResultWriter
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    position INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL UNIQUE,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    row TEXT,
+    report TEXT,
+    error TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS calls (
+    worker TEXT NOT NULL,
+    marker TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    ok INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks(status, lease_until);
+'''
+
+def worker_name():
+    """
+    Names this worker process after its host and process id, e.g. 'lab-03:4121'.
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+class WorkQueue:
+    def __init__(self, path, lease_seconds=300, max_attempts=3):
+        """
+        Opens (or creates) a queue of submission folders shared by several marking workers, stored in SQLite.
+
+        Each folder is a task. A worker claims tasks with a lease, which it renews with heartbeats while it marks
+        them; when a worker dies its leases run out and the tasks are claimed again by another worker. A task
+        failing `max_attempts` times is given up. The results (the row of marks.csv and the report) are kept in
+        the queue until the merge step writes the output files.
+
+        Args:
+            path (str): Path of the database file, e.g. on a filesystem shared by the lab machines.
+            lease_seconds (float): How long a claimed task stays with its worker without a heartbeat (default: 300).
+            max_attempts (int): Number of claims of a task before it is marked as failed (default: 3).
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.connection = self._connect()
+        self.connection.executescript(SCHEMA)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA busy_timeout = 60000')
+        return connection
+
+    def enqueue(self, dirns):
+        """
+        Adds folders to the queue, keeping the tasks already there.
+
+        Returns:
+            int: The number of folders added.
+        """
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            # Read within the transaction, so that concurrent calls never number their folders from the same start
+            start = self.connection.execute('SELECT COALESCE(MAX(position) + 1, 0) FROM tasks').fetchone()[0]
+            added = 0
+            for dirn in dirns:
+                cursor = self.connection.execute('INSERT OR IGNORE INTO tasks (position, folder, updated) VALUES (?, ?, ?)',
+                                                 (start + added, dirn, time.time()))
+                added += cursor.rowcount
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        return added
+
+    def claim(self, worker, count=1):
+        """
+        Leases up to `count` tasks that are pending or whose lease ran out, in folder order.
+
+        Returns:
+            list: The folders claimed, empty when there is nothing left to claim.
+        """
+        now = time.time()
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self.connection.execute(
+                "SELECT position, folder FROM tasks WHERE (status = 'pending' OR (status = 'leased' AND lease_until < ?)) "
+                'AND attempts < ? ORDER BY position LIMIT ?', (now, self.max_attempts, count)).fetchall()
+            self.connection.executemany(
+                "UPDATE tasks SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? WHERE position = ?",
+                [(worker, now + self.lease_seconds, now, position) for position, _ in rows])
+            # Tasks whose last lease ran out after their final attempt are given up
+            self.connection.execute("UPDATE tasks SET status = 'failed', error = COALESCE(error, 'lease expired') "
+                                    "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?", (now, self.max_attempts))
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        return [folder for _, folder in rows]
+
+    def heartbeat(self, worker, connection=None):
+        """
+        Renews the leases of all the tasks held by a worker.
+        """
+        connection = connection if connection is not None else self.connection
+        connection.execute("UPDATE tasks SET lease_until = ? WHERE worker = ? AND status = 'leased'",
+                           (time.time() + self.lease_seconds, worker))
+
+    def complete(self, folder, worker, row, report):
+        """
+        Records the result of a task. A result arriving after the task was handed to another worker is still
+        kept, since both workers marked the same folder.
+
+        Parameters:
+            folder (str): The folder of the task.
+            worker (str): The worker reporting the result.
+            row (dict): The row of marks.csv, None if the folder had nothing to mark.
+            report (str): The markdown report, None if it was not rendered.
+        """
+        self.connection.execute(
+            "UPDATE tasks SET status = 'done', worker = ?, row = ?, report = ?, error = NULL, updated = ? WHERE folder = ? AND status != 'done'",
+            (worker, json.dumps(row, default=str) if row is not None else None, report, time.time(), folder))
+
+    def release(self, folder, worker, error):
+        """
+        Hands a task that failed back to the queue, or gives it up after `max_attempts` claims.
+        """
+        self.connection.execute(
+            "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL, "
+            "lease_until = NULL, error = ?, updated = ? WHERE folder = ? AND worker = ? AND status = 'leased'",
+            (self.max_attempts, error, time.time(), folder, worker))
+
+    def record_calls(self, worker, requests):
+        """
+        Keeps the ChatGPT requests of a worker, as recorded by its run profile, for the merge step.
+        """
+        self.connection.executemany('INSERT INTO calls (worker, marker, seconds, prompt_tokens, completion_tokens, ok) '
+                                    'VALUES (?, ?, ?, ?, ?, ?)',
+                                    [(worker, marker, seconds, prompt, completion, int(ok))
+                                     for marker, seconds, prompt, completion, ok in requests])
+
+    def calls(self):
+        return self.connection.execute('SELECT marker, seconds, prompt_tokens, completion_tokens, ok FROM calls').fetchall()
+
+    def counts(self):
+        """
+        Returns the number of tasks of each status.
+        """
+        counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+        counts.update(dict(self.connection.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status')))
+        return counts
+
+    def results(self):
+        """
+        Yields (folder, row, report) of the finished tasks in folder order, skipping folders with nothing to mark.
+        """
+        for folder, row, report in self.connection.execute(
+                "SELECT folder, row, report FROM tasks WHERE status = 'done' AND row IS NOT NULL ORDER BY position"):
+            yield folder, json.loads(row), report
+
+    def failures(self):
+        return self.connection.execute("SELECT folder, attempts, error FROM tasks WHERE status = 'failed' ORDER BY position").fetchall()
+
+    def close(self):
+        self.connection.close()
+
+class Heartbeat:
+    def __init__(self, queue, worker, interval=None):
+        """
+        Renews the leases of a worker from a background thread, every third of the lease by default.
+        """
+        self.queue = queue
+        self.worker = worker
+        self.interval = interval if interval is not None else max(1.0, queue.lease_seconds / 3)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        connection = self.queue._connect()
+        while not self.stopped.wait(self.interval):
+            try:
+                self.queue.heartbeat(self.worker, connection)
+            except sqlite3.OperationalError as e:
+                print('Heartbeat failed, retrying: {}'.format(e))
+        connection.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+class QueueWriter(ResultWriter):
+    def __init__(self, queue, worker, output_dir):
+        """
+        Stands in for the ResultWriter of a worker: the bulky fields are still saved to texts/ in the shared
+        output directory, while the rows and reports go to the queue instead of marks.csv and all.md.
+
+        Args:
+            queue (WorkQueue): The queue the tasks were claimed from.
+            worker (str): The name of the worker.
+            output_dir (str): The output directory shared by the workers and the merge step.
+        """
+        self.queue = queue
+        self.worker = worker
+        self.output_dir = output_dir
+        self.texts_dir = os.path.join(output_dir, 'texts')
+        self.pairs_file = None  # The duplicates of the cohort are written by the merge step
+        self.written = set()
+
+    def write(self, dirn, assinfo, mdreport, row=None):
+        if row is None:
+            row = self.slim(dirn, assinfo)
+        self.queue.complete(dirn, self.worker, row, mdreport)
+        self.written.add(dirn)
+        return row
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
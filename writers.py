@@ -0,0 +1,173 @@
+import os
+import re
+import csv
+
+# Fields holding whole files; they are saved next to the outputs and referenced by path in marks.csv
+BULKY_FIELDS = ['LICENSE', 'README', 'REPORT', 'REQUIREMENTS', 'GitM', 'CODE', 'CODEFeatures', 'CODEComments', 'DSD']
+
+class ReportStream:
+    def __init__(self, output_dir, split=None, name='all'):
+        """
+        Streams markdown reports to the combined report files, one report at a time.
+
+        Args:
+            output_dir (str): The directory of the combined reports.
+            split: None for a single all.md, 'tutor' for one file per tutor (all_<tutor>.md), or a number N to
+                start a new file every N students (all_001.md, all_002.md, ...).
+            name (str): The base name of the files (default: 'all').
+        """
+        self.output_dir = output_dir
+        self.split = split
+        self.name = name
+        self.files = {}      # File name -> open file
+        self.count = 0
+        self.paths = []
+        if split is None:
+            self._open(name + '.md')
+
+    def _open(self, file_name):
+        path = os.path.join(self.output_dir, file_name)
+        self.files[file_name] = open(path, 'w', encoding='utf-8')
+        self.paths.append(path)
+        return self.files[file_name]
+
+    def _file_name(self, row):
+        if self.split is None:
+            return self.name + '.md'
+        if self.split == 'tutor':
+            tutor = re.sub(r'[^\w.-]+', '_', str(row.get('Tutor') or 'no_tutor')).strip('_')
+            return '{}_{}.md'.format(self.name, tutor)
+        return '{}_{:03d}.md'.format(self.name, self.count // int(self.split) + 1)
+
+    def write(self, row, mdreport):
+        """
+        Appends the report of a student to the file it belongs to.
+
+        Parameters:
+            row (dict): The results of the student; 'Tutor' selects the file when splitting per tutor.
+            mdreport (str): The rendered markdown report.
+        """
+        file_name = self._file_name(row)
+        f = self.files.get(file_name)
+        if f is None:
+            if self.split not in (None, 'tutor'):
+                # Pages are filled in order, so the previous page is complete
+                for old in self.files.values():
+                    old.close()
+                self.files = {}
+            f = self._open(file_name)
+        elif f.tell() > 0:
+            f.write('  \n')
+        f.write(mdreport)
+        f.flush()
+        self.count += 1
+
+    def sync(self):
+        for f in self.files.values():
+            os.fsync(f.fileno())
+
+    def close(self):
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        self.files = {}
+
+class ResultWriter:
+    def __init__(self, output_dir, fsync_every=10, store=None, reports=None, stream=True):
+        """
+        Streams the results of each student to marks.csv and all.md as soon as the student is marked.
+
+        Both files are flushed after every student and synced to disk every `fsync_every` students, so a crash
+        only loses the students still in flight. The bulky text fields are written to texts/<folder>/<FIELD>.txt
+        and marks.csv refers to them by path, which keeps the rows (and the table built from them) small.
+
+        With a ResultStore, every student is also added to the store, and the buffered students are committed
+        in one transaction at each checkpoint.
+
+        Args:
+            output_dir (str): The output directory.
+            fsync_every (int): Number of students between two fsync checkpoints.
+            store (ResultStore): Optional results store with a run begun.
+            reports (ReportStream): Where the reports are streamed (default: a single all.md in `output_dir`).
+            stream (bool): Open marks.csv and the reports for streaming; False for the subclasses that publish
+                them in their own way, so the files of an earlier run are not truncated.
+        """
+        self.output_dir = output_dir
+        self.texts_dir = os.path.join(output_dir, 'texts')
+        self.fsync_every = max(1, fsync_every)
+        self.csv_file = None
+        self.reports = None
+        if stream:
+            self.csv_file = open(os.path.join(output_dir, 'marks.csv'), 'w', encoding='utf-8', newline='')
+            self.reports = reports if reports is not None else ReportStream(output_dir)
+        self.csv_writer = None
+        self.store = store
+        self.count = 0
+        self.pairs_file = 'duplicates.csv'
+
+    def slim(self, dirn, assinfo):
+        """
+        Saves the bulky text fields of a student to texts/<folder>/<FIELD>.txt.
+
+        Returns:
+            dict: A copy of `assinfo` with the bulky fields replaced by the paths of their text files.
+        """
+        row = dict(assinfo)
+        folder = os.path.join(self.texts_dir, os.path.basename(os.path.normpath(dirn)))
+        for field in BULKY_FIELDS:
+            if isinstance(row.get(field), str):
+                os.makedirs(folder, exist_ok=True)
+                path = os.path.join(folder, field + '.txt')
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(row[field])
+                row[field] = path
+        return row
+
+    def write(self, dirn, assinfo, mdreport, row=None):
+        """
+        Appends one student to marks.csv and all.md.
+
+        Parameters:
+            dirn (str): The directory path containing the student submission.
+            assinfo (dict): The assessment information and marks of the student.
+            mdreport (str): The rendered markdown report of the student, None to leave it out of all.md.
+            row (dict): The result of `slim` if it was already called for this student.
+
+        Returns:
+            dict: The row written to marks.csv, with bulky fields replaced by the paths of their text files.
+        """
+        if row is None:
+            row = self.slim(dirn, assinfo)
+
+        # Same layout as DataFrame.to_csv: an unnamed index column followed by the fields
+        if self.csv_writer is None:
+            self.csv_writer = csv.DictWriter(self.csv_file, fieldnames=[''] + list(row), restval='', extrasaction='ignore')
+            self.csv_writer.writeheader()
+        self.csv_writer.writerow(dict(row, **{'': self.count}))
+
+        if mdreport is not None:
+            self.reports.write(row, mdreport)
+        if self.store is not None:
+            self.store.add(self.count, dirn, row, mdreport if mdreport is not None else '')
+
+        self.count += 1
+        self.csv_file.flush()
+        if self.count % self.fsync_every == 0:
+            self.sync()
+        return row
+
+    def sync(self):
+        """
+        Forces both files to disk and commits the buffered students to the store.
+        """
+        os.fsync(self.csv_file.fileno())
+        self.reports.sync()
+        if self.store is not None:
+            self.store.flush()
+
+    def close(self):
+        self.csv_file.flush()
+        self.sync()
+        self.csv_file.close()
+        self.reports.close()